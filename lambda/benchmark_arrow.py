@@ -0,0 +1,98 @@
+import logging
+import os
+import argparse
+import tracemalloc
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Compare the DataFrame and Arrow export paths (memory and time)
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--ext',
+	type=str,
+	default='csv.gz',
+	required=False,
+	help='The file format to write'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+# nothing should leave the machine
+os.environ['WRITE_FILE_LOCATION'] = 'local'
+if 'LOCAL_SAVE_DIRECTORY' not in os.environ.keys():
+    os.environ['LOCAL_SAVE_DIRECTORY'] = 'benchmark'
+
+import pyarrow as pa
+from open_data_export.main import (
+    get_measurement_data_n,
+    reshape,
+    write_file,
+    EXPORT_FIELDS,
+)
+
+exports = [
+	{"node":61936, "day":"2023-07-15"},
+	{"node":61941, "day":"2023-07-15"},
+	{"node":61948, "day":"2023-07-15"},
+	{"node":61949, "day":"2023-07-15"},
+	{"node":61950, "day":"2023-07-15"},
+	{"node":61952, "day":"2023-07-15"},
+	{"node":61964, "day":"2023-07-15"},
+	{"node":61965, "day":"2023-07-15"},
+	{"node":61975, "day":"2023-07-15"},
+	{"node":61982, "day":"2023-07-15"},
+	]
+
+f = open(f"benchmark_arrow_output_{args.name}.csv", "w")
+f.writelines("name,format,get_ms,write_ms,peak_kb,count\n")
+
+for export in exports:
+	node = export["node"]
+	day = datetime.fromisoformat(export["day"]).date()
+	for response_format in ['DataFrame', 'Arrow']:
+		# tracemalloc will not see the arrow buffers so we add
+		# what the arrow pool is holding onto as well
+		pool = pa.default_memory_pool()
+		arrow_start = pool.bytes_allocated()
+		tracemalloc.start()
+		rows, get_ms = get_measurement_data_n(node, day, response_format=response_format)
+		df = reshape(rows, fields=EXPORT_FIELDS)
+		filepath = f"{args.name}/{response_format}/location-{node}-{day.strftime('%Y%m%d')}"
+		fpath, write_ms, stats = write_file(df, filepath, ext=args.ext)
+		current, peak = tracemalloc.get_traced_memory()
+		tracemalloc.stop()
+		peak_kb = round((peak + pool.bytes_allocated() - arrow_start)/1024)
+		f.writelines(f"'{node}-{day}','{response_format}',{get_ms},{write_ms},{peak_kb},{len(rows)}\n")
+		logger.info(f"{node}-{day} {response_format}: get {get_ms}ms, write {write_ms}ms, peak {peak_kb}kb, {len(rows)} rows")
+		del rows, df
+
+f.close()
@@ -0,0 +1,79 @@
+import logging
+import os
+import argparse
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Compare the threaded and asyncio export engines. Meant to be run
+against a local database and a local s3 stand-in (e.g. minio) by
+setting DATABASE_HOST and S3_ENDPOINT_URL in the env file
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--limit',
+	type=int,
+	default=500,
+	required=False,
+	help='The number of location/days to export in each run'
+	)
+parser.add_argument(
+	'--repeat',
+	type=int,
+	default=1,
+	required=False,
+	help='How many times to run each engine'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+from open_data_export.config import settings
+from open_data_export import main, aio
+
+if settings.S3_ENDPOINT_URL is None:
+	logger.warning('S3_ENDPOINT_URL is not set, files will be written to aws')
+
+f = open(f"benchmark_async_output_{args.name}.csv", "w")
+f.writelines("name,engine,time_ms,count\n")
+
+for i in range(args.repeat):
+	for engine in ['threads', 'asyncio']:
+		# put everything back in the queue so both engines do the same work
+		main.reset_queue()
+		start = time()
+		if engine == 'threads':
+			n = main.export_pending(args.limit)
+		else:
+			n = aio.run(aio.export_pending(args.limit))
+		time_ms = round((time() - start)*1000)
+		f.writelines(f"'{args.name}-{i}','{engine}',{time_ms},{n}\n")
+		logger.info(f"{engine}: exported {n} in {time_ms}ms")
+
+f.close()
@@ -0,0 +1,150 @@
+import logging
+import os
+import argparse
+from time import time, sleep
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Run a few workers against one (test) database, all claiming pending
+location/days with leases at the same time, and make sure that no
+location/day was claimed twice and that none were lost. With --kill
+the first worker claims a batch and quits without releasing it and the
+others have to pick it up once the lease runs out. Nothing is exported,
+every claim is released again at the end. Needs schema/leases.sql
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--workers',
+	type=int,
+	default=4,
+	required=False,
+	help='How many workers to run'
+	)
+parser.add_argument(
+	'--limit',
+	type=int,
+	default=25,
+	required=False,
+	help='How many location/days each worker claims at a time'
+	)
+parser.add_argument(
+	'--lease',
+	type=float,
+	default=5,
+	required=False,
+	help='Lease seconds'
+	)
+parser.add_argument(
+	'--kill',
+	action="store_true",
+	help='Have the first worker quit without releasing its claim'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+from multiprocessing import Process, Queue
+# main sets up the logging
+from open_data_export.main import DB
+from open_data_export.leases import Leases, PENDING_COUNT_SQL
+
+
+def worker(n: int, results: Queue):
+	"""
+	Claim until there is nothing left, holding on to everything we
+	claim (like a long export) until the end
+	"""
+	db = DB()
+	leases = Leases(db, seconds=args.lease)
+	claimed = []
+	claims = 0
+	start = time()
+	if args.kill and n == 0:
+		rows, ms = leases.claim(args.limit)
+		results.put((n, leases.worker, [(r[0], r[1]) for r in rows], 1, round((time() - start)*1000), True))
+		db.close()
+		return
+	if args.kill:
+		# give the first one a head start and then wait for its lease
+		sleep(1)
+	with leases.heartbeat(lambda: claimed, interval=args.lease/3):
+		while True:
+			rows, ms = leases.claim(args.limit)
+			claims += 1
+			claimed.extend([(r[0], r[1]) for r in rows])
+			if len(rows) == 0:
+				if args.kill and time() - start < args.lease + 2:
+					sleep(1)
+					continue
+				break
+	time_ms = round((time() - start)*1000)
+	results.put((n, leases.worker, claimed, claims, time_ms, False))
+	db.close()
+
+
+# how many there should be
+db = DB()
+pending = db.rows(PENDING_COUNT_SQL)[0][0][0]
+# so that the workers do not fork with an open pool
+db.close()
+logger.info(f"{pending} location/days are pending")
+
+results = Queue()
+workers = [Process(target=worker, args=(n, results)) for n in range(args.workers)]
+for w in workers:
+	w.start()
+done = [results.get() for w in workers]
+for w in workers:
+	w.join()
+
+f = open(f"benchmark_claims_output_{args.name}.csv", "w")
+f.writelines("name,worker,claims,rows,time_ms,killed\n")
+killed = set()
+claimed_by = []
+for n, name, claimed, claims, time_ms, was_killed in sorted(done):
+	f.writelines(f"'{args.name}','{name}',{claims},{len(claimed)},{time_ms},{was_killed}\n")
+	if was_killed:
+		killed.update(claimed)
+	else:
+		claimed_by.extend(claimed)
+f.close()
+
+# the ones from the killed worker should have been claimed again
+claimed = set(claimed_by)
+duplicates = len(claimed_by) - len(claimed)
+missing = pending - len(claimed)
+logger.info(f"{args.workers} workers claimed {len(claimed)} (of {pending}) location/days, {duplicates} duplicates, {missing} missing, {len(killed - claimed)} not reclaimed")
+
+# put it all back
+db = DB()
+leases = Leases(db)
+for n, name, claimed, claims, time_ms, was_killed in done:
+	leases.worker = name
+	leases.release(claimed)
+db.close()
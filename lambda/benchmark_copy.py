@@ -0,0 +1,131 @@
+import logging
+import os
+import csv
+import argparse
+from io import StringIO
+from time import time
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Time the csv written by postgres (COPY), arrow and pandas for the same
+location/days. Each file is compared with the pandas one byte for byte
+(after sorting the lines, neither query has an order). tests/test_copy.py
+does the same check as a test
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--day',
+	type=str,
+	required=True,
+	help='The day to export, in YYYY-MM-DD'
+	)
+parser.add_argument(
+	'--nodes',
+	type=int,
+	default=20,
+	required=False,
+	help='How many nodes to export'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+from open_data_export.main import (
+    get_database,
+    get_measurement_data_n,
+    get_measurement_csv,
+    reshape,
+    EXPORT_FIELDS,
+    CSV_HEADER,
+)
+from open_data_export.writer import write_arrow
+
+
+def lines(body: bytes):
+	"""
+	The header and the sorted rows, as they were written
+	"""
+	rows = body.split(b"\r\n")
+	return rows[0], sorted(rows[1:])
+
+
+def as_pandas(node, day):
+	rows, ms = get_measurement_data_n(node, day, response_format='DataFrame')
+	out = StringIO()
+	reshape(rows, fields=EXPORT_FIELDS).to_csv(out, index=False, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\r\n")
+	return out.getvalue().encode()
+
+
+def as_arrow(node, day):
+	rows, ms = get_measurement_data_n(node, day, response_format='Arrow')
+	return write_arrow(reshape(rows, fields=EXPORT_FIELDS), 'csv')
+
+
+def as_copy(node, day):
+	return CSV_HEADER + b"".join(get_measurement_csv(node, day))
+
+
+day = datetime.fromisoformat(args.day).date()
+db = get_database()
+rows, ms = db.rows(
+	"""
+	SELECT sensor_nodes_id
+	FROM open_data_export_logs
+	WHERE day = :day
+	AND records > 0
+	ORDER BY sensor_nodes_id
+	LIMIT :limit
+	""",
+	day=day,
+	limit=args.nodes,
+	)
+nodes = [r[0] for r in rows]
+
+f = open(f"benchmark_copy_output_{args.name}.csv", "w")
+f.writelines("name,method,node,time_ms,bytes,identical\n")
+
+mismatched = 0
+for node in nodes:
+	results = {}
+	for method, fn in [('pandas', as_pandas), ('arrow', as_arrow), ('copy', as_copy)]:
+		start = time()
+		results[method] = fn(node, day)
+		results[f"{method}_ms"] = round((time() - start)*1000)
+	expected = lines(results['pandas'])
+	for method in ['pandas', 'arrow', 'copy']:
+		body = results[method]
+		identical = lines(body) == expected
+		if not identical:
+			mismatched += 1
+			logger.warning(f"{method} does not match pandas for {node} on {day}")
+		f.writelines(f"'{args.name}','{method}',{node},{results[method + '_ms']},{len(body)},{identical}\n")
+
+f.close()
+logger.info(f"Compared {len(nodes)} location/days, {mismatched} did not match")
@@ -0,0 +1,108 @@
+import logging
+import os
+import argparse
+from time import time
+from datetime import datetime
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Compare fetching one node at a time with fetching a batch of nodes
+in one query. Best run against the synthetic data in schema/testing.sql
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--day',
+	type=str,
+	required=True,
+	help='The day to fetch, in YYYY-MM-DD'
+	)
+parser.add_argument(
+	'--nodes',
+	type=int,
+	default=100,
+	required=False,
+	help='How many nodes to fetch'
+	)
+parser.add_argument(
+	'--batch',
+	type=int,
+	default=20,
+	required=False,
+	help='How many nodes to fetch in each batch'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+from open_data_export.main import (
+    get_database,
+    get_measurement_data_n,
+    get_measurement_data_batch,
+)
+
+day = datetime.fromisoformat(args.day).date()
+db = get_database()
+rows, ms = db.rows(
+	"""
+	SELECT sensor_nodes_id
+	FROM open_data_export_logs
+	WHERE day = :day
+	ORDER BY sensor_nodes_id
+	LIMIT :limit
+	""",
+	day=day,
+	limit=args.nodes,
+	)
+nodes = [r[0] for r in rows]
+
+f = open(f"benchmark_fetch_output_{args.name}.csv", "w")
+f.writelines("name,method,nodes,time_ms,count\n")
+
+start = time()
+n = 0
+for node in nodes:
+	data, get_ms = get_measurement_data_n(node, day, response_format='Arrow')
+	n += len(data)
+time_ms = round((time() - start)*1000)
+f.writelines(f"'{args.name}','per-node',{len(nodes)},{time_ms},{n}\n")
+logger.info(f"per-node: {len(nodes)} nodes, {n} rows in {time_ms}ms")
+
+start = time()
+n = 0
+for i in range(0, len(nodes), args.batch):
+	data, get_ms = get_measurement_data_batch(nodes[i:i + args.batch], day)
+	if data is None:
+		logger.warning('batch was over the row budget')
+		continue
+	n += len(data)
+time_ms = round((time() - start)*1000)
+f.writelines(f"'{args.name}','batch-{args.batch}',{len(nodes)},{time_ms},{n}\n")
+logger.info(f"batch of {args.batch}: {len(nodes)} nodes, {n} rows in {time_ms}ms")
+
+f.close()
@@ -0,0 +1,106 @@
+import logging
+import os
+import argparse
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Compare the file size and write time of the default pandas parquet
+output with the tuned writer. Uses the simulated data in tests/file_test
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--file',
+	type=str,
+	default='../tests/file_test/testfile.csv',
+	required=False,
+	help='The csv file to use'
+	)
+parser.add_argument(
+	'--repeat',
+	type=int,
+	default=10,
+	required=False,
+	help='How many copies of the file to put in the table, to get a bigger file'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from io import BytesIO
+from open_data_export.config import settings
+from open_data_export.main import EXPORT_FIELDS
+from open_data_export.writer import write_parquet
+
+
+# the test file has the older column names
+df = pd.read_csv(args.file).rename(columns={
+	'sensor_id': 'sensors_id',
+	'measurand': 'parameter',
+	})
+df['units'] = 'µg/m³'
+df = pd.concat([df] * args.repeat, ignore_index=True)[EXPORT_FIELDS]
+logger.info(f"{len(df)} rows from {args.file}")
+
+
+def pandas_default():
+	out = BytesIO()
+	df.to_parquet(out, index=False)
+	return out.getvalue()
+
+
+def tuned(codec: str):
+	def write():
+		settings.PARQUET_COMPRESSION = codec
+		out = pa.BufferOutputStream()
+		write_parquet(df, out)
+		return out.getvalue().to_pybytes()
+	return write
+
+
+f = open(f"benchmark_parquet_output_{args.name}.csv", "w")
+f.writelines("name,method,rows,time_ms,bytes,row_groups\n")
+
+for method, fn in [
+		('pandas', pandas_default),
+		('tuned-snappy', tuned('snappy')),
+		('tuned-gzip', tuned('gzip')),
+		('tuned-zstd', tuned('zstd')),
+		]:
+	start = time()
+	body = fn()
+	time_ms = round((time() - start)*1000)
+	row_groups = pq.ParquetFile(BytesIO(body)).metadata.num_row_groups
+	f.writelines(f"'{args.name}','{method}',{len(df)},{time_ms},{len(body)},{row_groups}\n")
+	logger.info(f"{method}: {len(body)} bytes in {time_ms}ms ({row_groups} row groups)")
+
+f.close()
@@ -0,0 +1,120 @@
+import logging
+import os
+import argparse
+from time import time
+
+
+logger = logging.getLogger(__name__)
+
+parser = argparse.ArgumentParser(
+    description="""
+Serialize the same set of files on threads only and then with a
+process pool of 1 to N processes, to see how the serialization scales
+with the cores. Uses the simulated data in tests/file_test
+    """)
+
+parser.add_argument(
+	'--name',
+	type=str,
+	required=False,
+	default="test",
+	help='Name to use for the test'
+	)
+parser.add_argument(
+	'--env',
+	type=str,
+	default='.env',
+	required=False,
+	help='The dot env file to use'
+	)
+parser.add_argument(
+	'--file',
+	type=str,
+	default='../tests/file_test/testfile.csv',
+	required=False,
+	help='The csv file to use'
+	)
+parser.add_argument(
+	'--format',
+	type=str,
+	default='csv.gz',
+	required=False,
+	help='The file format to write'
+	)
+parser.add_argument(
+	'--files',
+	type=int,
+	default=50,
+	required=False,
+	help='How many files to serialize for each test'
+	)
+parser.add_argument(
+	'--processes',
+	type=int,
+	default=os.cpu_count(),
+	required=False,
+	help='The most processes to test with'
+	)
+parser.add_argument(
+	'--threads',
+	type=int,
+	default=os.cpu_count() + 4,
+	required=False,
+	help='Number of threads handing out the work (same as export_pending)'
+	)
+parser.add_argument(
+	'--debug',
+	action="store_true",
+	help='Output at DEBUG level'
+	)
+args = parser.parse_args()
+
+if 'DOTENV' not in os.environ.keys() and args.env is not None:
+    os.environ['DOTENV'] = args.env
+
+if args.debug:
+    os.environ['LOG_LEVEL'] = 'DEBUG'
+
+import pandas as pd
+import pyarrow as pa
+from concurrent.futures import ThreadPoolExecutor
+from open_data_export.main import EXPORT_FIELDS
+from open_data_export.writer import write_arrow
+from open_data_export.serialize import SerializePool
+
+
+# the test file has the older column names
+df = pd.read_csv(args.file).rename(columns={
+	'sensor_id': 'sensors_id',
+	'measurand': 'parameter',
+	})
+df['units'] = 'µg/m³'
+tbl = pa.Table.from_pandas(df[EXPORT_FIELDS], preserve_index=False)
+logger.info(f"{args.files} files of {tbl.num_rows} rows from {args.file}")
+
+
+def run(fn):
+	start = time()
+	with ThreadPoolExecutor(max_workers=args.threads) as exe:
+		sizes = list(exe.map(fn, range(args.files)))
+	return round((time() - start)*1000), sum(sizes)
+
+
+f = open(f"benchmark_serialize_output_{args.name}.csv", "w")
+f.writelines("name,method,processes,files,time_ms,bytes,files_per_sec,speedup\n")
+
+baseline_ms, nbytes = run(lambda i: len(write_arrow(tbl, args.format)))
+f.writelines(f"'{args.name}','threads',0,{args.files},{baseline_ms},{nbytes},{round(args.files/(baseline_ms/1000), 1)},1.0\n")
+logger.info(f"threads: {baseline_ms}ms")
+
+for processes in range(1, args.processes + 1):
+	pool = SerializePool(processes)
+	# do not count starting the workers
+	pool.start()
+	time_ms, nbytes = run(lambda i: len(pool.serialize(tbl, args.format)[0]))
+	pool.shutdown()
+	speedup = round(baseline_ms/time_ms, 2)
+	f.writelines(f"'{args.name}','processes',{processes},{args.files},{time_ms},{nbytes},{round(args.files/(time_ms/1000), 1)},{speedup}\n")
+	logger.info(f"{processes} processes: {time_ms}ms ({speedup}x)")
+
+f.close()
@@ -0,0 +1,343 @@
+import asyncio
+import logging
+import time
+
+from open_data_export.config import settings
+from open_data_export.db import DB
+from open_data_export.batch import ExportLogBatch, ErrorBatch
+from open_data_export.metadata import attach, params
+from open_data_export.compression import compressor
+from open_data_export.writer import write_arrow, write_stats, content_hash
+from open_data_export.main import (
+    FILE_FORMAT_VERSION,
+    EXPORT_FIELDS,
+    MEASUREMENT_DATA_SQL,
+    get_metadata,
+    load_export_hashes,
+    previous_hash,
+    export_hashes,
+    export_fingerprints,
+    export_records,
+    skip_unchanged,
+    check_objects_claim,
+    move_objects_claim,
+    split_key,
+    export_filepath,
+    reshape,
+    write_file,
+)
+from datetime import datetime
+import aioboto3
+
+logger = logging.getLogger('aio')
+
+db = None
+loop = None
+
+
+def get_database():
+    global db
+    if db is None:
+        db = DB()
+    return db
+
+
+def run(coro):
+    """
+    Run on the same loop every time so that the database pool,
+    which is tied to the loop, survives between warm invocations
+    """
+    global loop
+    if loop is None or loop.is_closed():
+        loop = asyncio.new_event_loop()
+    return loop.run_until_complete(coro)
+
+
+def s3_client():
+    session = aioboto3.Session()
+    return session.client("s3", endpoint_url=settings.S3_ENDPOINT_URL)
+
+
+class Limits:
+    """
+    Separate concurrency limits for the database and s3 so that
+    a slow bucket does not hold up the database or the other way around
+    """
+    def __init__(
+            self,
+            db: int = settings.ASYNC_DB_CONCURRENCY,
+            s3: int = settings.ASYNC_S3_CONCURRENCY,
+    ):
+        self.db = asyncio.Semaphore(db)
+        self.s3 = asyncio.Semaphore(s3)
+
+
+async def write_batch(batch, force: bool = False):
+    """
+    Write what the batch has collected using the async database.
+    The batches are only used to collect the rows here and, like
+    Batch.flush, rows that could not be written are put back to
+    try again with the next write
+    """
+    if not force and not batch.ready():
+        return 0
+    items = batch.take()
+    if len(items) == 0:
+        return 0
+    start = time.time()
+    try:
+        await get_database().rows(batch.sql, **batch.params(list(items.values())))
+        batch.statements += 1
+        batch.rows += len(items)
+    except Exception as e:
+        logger.error(f"Could not write {len(items)} rows: {e}")
+        batch.restore(items)
+    ms = round((time.time() - start)*1000)
+    batch.time_ms += ms
+    return ms
+
+
+async def export_data(day, node, s3, limits: Limits, log: ExportLogBatch):
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day).date()
+
+    ext = settings.WRITE_FILE_FORMAT
+
+    # the cache is warmed before the jobs are started so this
+    # should not have to go to the database
+    nodes = await asyncio.to_thread(get_metadata().get, [node])
+    async with limits.db:
+        rows, get_ms = await get_database().rows(
+            MEASUREMENT_DATA_SQL,
+            **params(nodes, day),
+            response_format='Arrow',
+        )
+    rows = attach(rows, nodes)
+
+    bucket = None
+    fpath = None
+    write_ms = 0
+    stats = None
+    if len(rows) > 0:
+        start = time.time()
+        tbl = reshape(rows, fields=EXPORT_FIELDS)
+        bucket = settings.OPEN_DATA_BUCKET
+        filepath = export_filepath(day, node, ext)
+        if settings.WRITE_FILE_LOCATION == 's3':
+            # serializing is cpu work so keep it off of the loop
+            codec = compressor(ext)
+            body = await asyncio.to_thread(write_arrow, tbl, ext, codec)
+            fpath = f"{filepath}.{ext}"
+            digest = content_hash()
+            digest.update(body)
+            skipped = previous_hash(day, node, f"s3://{bucket}/{fpath}") == digest.hexdigest()
+            stats = {**codec.stats(), 'hash': digest.hexdigest(), 'skipped': skipped}
+            write_stats.add(skipped, len(body))
+            if not skipped:
+                async with limits.s3:
+                    await s3.put_object(
+                        Bucket=bucket,
+                        Key=fpath,
+                        ACL='public-read',
+                        Body=body,
+                    )
+        else:
+            fpath, ms, stats = await asyncio.to_thread(write_file, tbl, filepath)
+        write_ms = round((time.time() - start)*1000)
+
+    fingerprint = export_fingerprints.pop((node, day), None)
+    if fingerprint is not None:
+        stats = {**(stats or {}), 'fingerprint': fingerprint}
+    log.append(
+        day,
+        node,
+        len(rows),
+        get_ms + write_ms,
+        f"s3://{bucket}/{fpath}",
+        FILE_FORMAT_VERSION,
+        metadata=stats,
+    )
+    return len(rows), get_ms, write_ms
+
+
+async def export_data_safe(row, s3, limits: Limits, log: ExportLogBatch, errors: ErrorBatch):
+    try:
+        return await export_data(row[1], row[0], s3, limits, log)
+    except Exception as e:
+        errors.append(row[1], row[0], e)
+        return -1, 0, 0
+
+
+async def export_and_log(row, s3, limits: Limits, log: ExportLogBatch, errors: ErrorBatch):
+    """
+    Export one location/day and write out the log/error batches if
+    they are ready
+    """
+    n, get_ms, write_ms = await export_data_safe(row, s3, limits, log, errors)
+    update_ms = await write_batch(log)
+    await write_batch(errors)
+    return n, get_ms, write_ms, update_ms
+
+
+async def export_pending(limit=settings.LIMIT, limits: Limits = None):
+    """
+    Export the pending location/days as tasks on one event loop
+    instead of one thread per job
+    """
+    start = time.time()
+    if limits is None:
+        limits = Limits()
+    db = get_database()
+    days, query_ms = await db.rows("SELECT * FROM get_pending(:limit)", limit=limit)
+    # the metadata cache uses the threaded database
+    get_metadata().reset_stats()
+    await asyncio.to_thread(get_metadata().get, list({row[0] for row in days}))
+    cache = get_metadata().stats()
+    write_stats.reset()
+    export_hashes.clear()
+    export_records.clear()
+    await asyncio.to_thread(load_export_hashes, days)
+
+    log = ExportLogBatch()
+    errors = ErrorBatch()
+    claimed = len(days)
+    days = await asyncio.to_thread(skip_unchanged, days, log)
+    count = claimed - len(days)
+    getting_ms = 0
+    writing_ms = 0
+    updating_ms = 0
+    async with s3_client() as s3:
+        # one job failing should not stop the others from being awaited
+        results = await asyncio.gather(
+            *[export_and_log(row, s3, limits, log, errors) for row in days],
+            return_exceptions=True,
+        )
+    for result in results:
+        if isinstance(result, BaseException):
+            logger.error(f"Export job failed: {result}")
+            continue
+        n, get_ms, write_ms, update_ms = result
+        count += int(n >= 0)
+        getting_ms += get_ms
+        writing_ms += write_ms
+        updating_ms += update_ms
+
+    updating_ms += await write_batch(log, force=True)
+    await write_batch(errors, force=True)
+    if len(log.items) > 0 or len(errors.items) > 0:
+        logger.error(f"Could not write {len(log.items)} export log and {len(errors.items)} error rows")
+
+    sec = round(time.time() - start)
+    logger.info(f'Exported {count} (of {claimed}) in {sec} seconds (get: {getting_ms}, write: {writing_ms}, log: {updating_ms}, query: {query_ms}, db: {settings.ASYNC_DB_CONCURRENCY}, s3: {settings.ASYNC_S3_CONCURRENCY}, metadata hit rate: {cache["hit_rate"]}, writes: {write_stats.snapshot()}, errors: {dict(errors.codes)})')
+    return count
+
+
+async def check_object(row, s3, limits: Limits):
+    key = row[2]
+    if key is None:
+        logger.warning('Missing key')
+        return None
+    bucket, key = split_key(key)
+    async with limits.s3:
+        acl = await s3.get_object_acl(Bucket=bucket, Key=key)
+        for grant in acl.get('Grants', []):
+            grantee = grant.get('Grantee')
+            if grantee.get('URI') == 'http://acs.amazonaws.com/groups/global/AllUsers':
+                if grant.get('Permission') == 'READ':
+                    return None
+        logger.warning(f'Updating object acl - {key}')
+        await s3.put_object_acl(Bucket=bucket, Key=key, ACL='public-read')
+    return None
+
+
+async def move_object(row, s3, limits: Limits):
+    from_key, to_key = row[2], row[3]
+    bucket, from_key = split_key(from_key)
+    async with limits.s3:
+        if bucket != settings.OPEN_DATA_BUCKET or from_key != to_key:
+            await s3.copy_object(
+                Bucket=settings.OPEN_DATA_BUCKET,
+                Key=to_key,
+                ACL='public-read',
+                CopySource={
+                    'Bucket': bucket,
+                    'Key': from_key,
+                },
+            )
+        else:
+            await s3.put_object_acl(
+                Bucket=settings.OPEN_DATA_BUCKET,
+                Key=to_key,
+                ACL='public-read',
+            )
+    return from_key
+
+
+async def run_objects(method, rows, limits: Limits, move: bool = False):
+    """
+    Run the s3 method for each row and collect the errors
+    """
+    batch = ErrorBatch()
+    count = 0
+    async with s3_client() as s3:
+        async def run_one(row):
+            try:
+                await method(row, s3, limits)
+                return 1
+            except Exception as e:
+                if 'without changing' in str(e):
+                    return 1
+                key = split_key(row[2])[1] if move else None
+                batch.append(row[0], row[1], e, key=key, move=move)
+                return 0
+
+        for n in await asyncio.gather(*[run_one(row) for row in rows], return_exceptions=True):
+            if isinstance(n, BaseException):
+                logger.error(f"Object job failed: {n}")
+                continue
+            count += n
+
+    await write_batch(batch, force=True)
+    return count, batch
+
+
+async def check_objects(day=None, node=None, limit=10, limits: Limits = None):
+    start = time.time()
+    if limits is None:
+        limits = Limits()
+    sql, args = check_objects_claim(day, node, limit)
+    keys, time_ms = await get_database().rows(sql, **args)
+    count, errors = await run_objects(check_object, keys, limits)
+    sec = time.time() - start
+    logger.info(f'Checked {count} objects (of {len(keys)}) in {sec} seconds (query: {time_ms/1000}, s3: {settings.ASYNC_S3_CONCURRENCY}, errors: {dict(errors.codes)})')
+    return count
+
+
+async def move_objects_handler(event, context=None, limits: Limits = None):
+    start = time.time()
+    if limits is None:
+        limits = Limits()
+    sql, args = move_objects_claim(event)
+    # the query is written for psycopg which needs the % escaped
+    sql = sql.replace('%%', '%')
+    days, time_ms = await get_database().rows(sql, **args)
+    count, errors = await run_objects(move_object, days, limits, move=True)
+    sec = time.time() - start
+    logger.info(f'Moved {count} files (of {len(days)}) in {sec} seconds (query: {time_ms/1000}, s3: {settings.ASYNC_S3_CONCURRENCY}, errors: {dict(errors.codes)})')
+    return count
+
+
+def handler(event={}, context={}):
+    """
+    Same as main.handler but runs the export, check and move
+    methods on an event loop
+    """
+    if 'method' in event.keys():
+        args = event.get('args', {})
+        if event['method'] == 'move':
+            return run(move_objects_handler(args))
+        elif event['method'] == 'check':
+            return run(check_objects(**args))
+        elif event['method'] == 'export':
+            return run(export_pending(**args))
+    return run(export_pending())
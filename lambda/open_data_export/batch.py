@@ -0,0 +1,291 @@
+import time
+import logging
+import threading
+from abc import ABC, abstractmethod
+
+from open_data_export.config import settings
+from datetime import datetime
+from collections import Counter
+from botocore.exceptions import ClientError
+import orjson
+import re
+
+
+logger = logging.getLogger('batch')
+
+
+def error_code(error):
+    """
+    Reduce an error down to something we can count (e.g. NoSuchKey)
+    """
+    if isinstance(error, ClientError):
+        code = error.response['Error']['Code']
+        # head_object returns different code than get_object_acl
+        if code == '404':
+            code = 'NoSuchKey'
+        return code
+    if match := re.search(r'\(([A-Za-z]+)\) when calling', f"{error}"):
+        return match.group(1)
+    if isinstance(error, Exception):
+        return error.__class__.__name__
+    return 'Other'
+
+
+class Batch(ABC):
+    """
+    Collect rows from the worker threads and write them to the database
+    in one statement once we have enough of them or enough time has
+    passed since the last write. Rows are keyed by location/day and
+    a newer row will replace one that has not been written yet.
+    Subclasses set the `sql` and turn the rows into its `params`
+    """
+    size = 50
+    seconds = 5
+    sql = None
+    tag = None
+
+    def __init__(self, db=None, size: int = None, seconds: float = None):
+        self.db = db
+        if size is not None:
+            self.size = size
+        if seconds is not None:
+            self.seconds = seconds
+        self.items = {}
+        self.lock = threading.Lock()
+        self.flush_lock = threading.Lock()
+        self.last_flush = time.time()
+        self.statements = 0
+        self.rows = 0
+        self.duplicates = 0
+        self.time_ms = 0
+
+    def add(self, key, item):
+        """
+        Add an item and flush if we hit one of the thresholds.
+        Returns the time spent, in ms, flushing. Without a db
+        the items are only collected and the caller is expected
+        to check `ready` and `take` them
+        """
+        with self.lock:
+            if key in self.items:
+                self.duplicates += 1
+                item = self.merge(self.items[key], item)
+            self.items[key] = item
+        if self.db is not None and self.ready():
+            return self.flush()
+        return 0
+
+    def ready(self):
+        with self.lock:
+            return len(self.items) > 0 and (
+                len(self.items) >= self.size
+                or time.time() - self.last_flush >= self.seconds
+            )
+
+    def take(self):
+        """
+        Remove and return everything that has not been written yet
+        """
+        with self.lock:
+            items = self.items
+            self.items = {}
+            self.last_flush = time.time()
+        return items
+
+    def restore(self, items: dict):
+        """
+        Put back items that could not be written, anything newer
+        that was added in the meantime wins
+        """
+        with self.lock:
+            for key, item in items.items():
+                if key in self.items:
+                    self.items[key] = self.merge(item, self.items[key])
+                else:
+                    self.items[key] = item
+
+    def merge(self, previous, item):
+        """
+        The item to keep when one with the same key has not been
+        written yet. Called with the lock held
+        """
+        return item
+
+    def flush(self):
+        with self.flush_lock:
+            items = self.take()
+            if len(items) == 0:
+                return 0
+            start = time.time()
+            try:
+                self.write(list(items.values()))
+                self.statements += 1
+                self.rows += len(items)
+            except Exception as e:
+                # put them back and try again with the next flush
+                logger.error(f"Could not write {len(items)} rows: {e}")
+                self.restore(items)
+            ms = round((time.time() - start)*1000)
+            self.time_ms += ms
+            return ms
+
+    @abstractmethod
+    def params(self, items: list) -> dict:
+        """
+        The parameters for `sql` from a list of rows
+        """
+
+    def write(self, items: list):
+        self.db.rows(self.sql, tag=self.tag, **self.params(items))
+
+    def stats(self):
+        return {
+            "statements": self.statements,
+            "rows": self.rows,
+            "duplicates": self.duplicates,
+            "ms": self.time_ms,
+            "pending": len(self.items),
+        }
+
+
+class ExportLogBatch(Batch):
+    """
+    Mark location/days as exported, many at a time
+    """
+    size = settings.EXPORT_LOG_BATCH_SIZE
+    seconds = settings.EXPORT_LOG_BATCH_SECONDS
+    tag = 'log-update'
+    sql = """
+        UPDATE public.open_data_export_logs l
+        SET exported_on = now()
+        , records = u.n
+        , key = u.key
+        , has_error = u.error
+        , version = u.version
+        , metadata = u.metadata::jsonb
+        FROM unnest(
+          (:days)::date[]
+        , (:nodes)::int[]
+        , (:records)::int[]
+        , (:keys)::text[]
+        , (:errors)::boolean[]
+        , (:versions)::int[]
+        , (:metadata)::text[]
+        ) as u(day, sensor_nodes_id, n, key, error, version, metadata)
+        WHERE l.day = u.day
+        AND l.sensor_nodes_id = u.sensor_nodes_id
+        RETURNING TRUE
+        """
+
+    def append(
+            self,
+            day,
+            node: int,
+            n: int,
+            msec: int,
+            key: str,
+            version: int,
+            error: bool = False,
+            metadata: dict = None,
+    ):
+        if isinstance(day, str):
+            day = datetime.fromisoformat(day).date()
+        meta = {'msec': msec}
+        if metadata is not None:
+            meta.update(metadata)
+        return self.add((day, node), (day, node, n, key, error, version, meta))
+
+    @staticmethod
+    def params(items: list):
+        days, nodes, records, keys, errors, versions, metadata = zip(*items)
+        return {
+            "days": list(days),
+            "nodes": list(nodes),
+            "records": list(records),
+            "keys": list(keys),
+            "errors": list(errors),
+            "versions": list(versions),
+            "metadata": [orjson.dumps(m).decode() for m in metadata],
+        }
+
+
+class ErrorBatch(Batch):
+    """
+    Mark location/days with an error message, many at a time.
+    Repeats of the same location/day are only written once
+    and we keep a count of the errors by code for the summary
+    """
+    size = settings.ERROR_BATCH_SIZE
+    seconds = settings.ERROR_BATCH_SECONDS
+    tag = 'error'
+    sql = """
+        UPDATE open_data_export_logs l
+        SET metadata = (COALESCE(l.metadata::jsonb, '{}'::jsonb)||jsonb_build_object(
+          'error', true
+        , 'message', u.error
+        , 'count', u.count
+        , 'at', current_timestamp::text
+        ))::json
+        , has_error = CASE WHEN u.move THEN l.has_error ELSE true END
+        , key = CASE WHEN u.move THEN u.key ELSE l.key END
+        FROM unnest(
+          (:days)::date[]
+        , (:nodes)::int[]
+        , (:errors)::text[]
+        , (:keys)::text[]
+        , (:moves)::boolean[]
+        , (:counts)::int[]
+        ) as u(day, sensor_nodes_id, error, key, move, count)
+        WHERE l.day = u.day
+        AND l.sensor_nodes_id = u.sensor_nodes_id
+        RETURNING TRUE
+        """
+
+    def __init__(self, db=None, size: int = None, seconds: float = None):
+        super().__init__(db, size, seconds)
+        self.codes = Counter()
+
+    def append(
+            self,
+            day,
+            node: int,
+            error,
+            key: str = None,
+            move: bool = False,
+    ):
+        """
+        Add an error. Move errors will also revert the key and
+        do not set the has_error flag
+        """
+        code = error_code(error)
+        if isinstance(error, ClientError):
+            error = code
+        else:
+            error = f"{error}"
+        if isinstance(day, str):
+            day = datetime.fromisoformat(day).date()
+        logger.error(f"error: {node} on {day} - {error}")
+        with self.lock:
+            self.codes[code] += 1
+        return self.add((day, node), (day, node, error, key, move, 1))
+
+    def merge(self, previous, item):
+        # keep the latest error and count them all
+        return item[:5] + (previous[5] + item[5],)
+
+    @staticmethod
+    def params(items: list):
+        days, nodes, errors, keys, moves, counts = zip(*items)
+        return {
+            "days": list(days),
+            "nodes": list(nodes),
+            "errors": list(errors),
+            "keys": list(keys),
+            "moves": list(moves),
+            "counts": list(counts),
+        }
+
+    def stats(self):
+        stats = super().stats()
+        stats['codes'] = dict(self.codes)
+        return stats
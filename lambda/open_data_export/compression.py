@@ -0,0 +1,193 @@
+import os
+import time
+import zlib
+import logging
+
+from open_data_export.config import settings
+from concurrent.futures import ThreadPoolExecutor
+from collections import deque
+
+
+logger = logging.getLogger('compression')
+
+
+class Codec:
+    """
+    No compression. The codecs all keep track of the bytes in and out
+    and the time spent compressing so that we can log the ratio
+    """
+    name = 'none'
+
+    def __init__(self):
+        self.raw = 0
+        self.compressed = 0
+        self.seconds = 0
+
+    def compress(self, data) -> bytes:
+        start = time.time()
+        out = self._compress(data)
+        self.raw += len(data)
+        self.compressed += len(out)
+        self.seconds += time.time() - start
+        return out
+
+    def flush(self) -> bytes:
+        start = time.time()
+        out = self._flush()
+        self.compressed += len(out)
+        self.seconds += time.time() - start
+        return out
+
+    def _compress(self, data):
+        return bytes(data)
+
+    def _flush(self):
+        return b''
+
+    def stats(self):
+        return {
+            'compression': self.name,
+            'raw_bytes': self.raw,
+            'bytes': self.compressed,
+            'ratio': round(self.raw/self.compressed, 2) if self.compressed > 0 else None,
+            'compress_ms': round(self.seconds*1000),
+        }
+
+
+class Gzip(Codec):
+    name = 'gzip'
+
+    def __init__(self, level: int = None):
+        super().__init__()
+        self.level = level if level is not None else settings.GZIP_LEVEL
+        self.gzip = zlib.compressobj(self.level, wbits=31)
+
+    def _compress(self, data):
+        return self.gzip.compress(data)
+
+    def _flush(self):
+        return self.gzip.flush()
+
+
+class ParallelGzip(Codec):
+    """
+    Compress blocks of GZIP_BLOCK_SIZE as separate gzip members on a
+    few threads (zlib lets go of the GIL). Any gzip reader will read the
+    members back as one file. Anything smaller than a block ends up as
+    a single member so small files are the same as with Gzip
+    """
+    name = 'gzip-parallel'
+
+    def __init__(self, level: int = None, threads: int = None, block_size: int = None):
+        super().__init__()
+        self.level = level if level is not None else settings.GZIP_LEVEL
+        self.threads = threads or settings.GZIP_THREADS
+        self.block_size = block_size or settings.GZIP_BLOCK_SIZE
+        self.block = bytearray()
+        self.queue = deque()
+        self.executor = None
+
+    def member(self, block):
+        gz = zlib.compressobj(self.level, wbits=31)
+        return gz.compress(block) + gz.flush()
+
+    def submit(self):
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.threads)
+        self.queue.append(self.executor.submit(self.member, bytes(self.block)))
+        self.block = bytearray()
+
+    def done(self, wait: bool = False):
+        """
+        Return the finished members, in order
+        """
+        out = []
+        # hold at most two blocks per thread
+        while self.queue and (wait or self.queue[0].done() or len(self.queue) > self.threads*2):
+            out.append(self.queue.popleft().result())
+        return b''.join(out)
+
+    def _compress(self, data):
+        self.block += data
+        if len(self.block) >= self.block_size:
+            self.submit()
+        return self.done()
+
+    def _flush(self):
+        if len(self.block) > 0 or (self.raw == 0 and not self.queue):
+            self.submit()
+        out = self.done(wait=True)
+        if self.executor is not None:
+            self.executor.shutdown()
+        return out
+
+
+class Zstd(Codec):
+    """
+    zstd, with a trained dictionary if ZSTD_DICTIONARY is set. Files
+    written with a dictionary need the same dictionary to be read
+    """
+    name = 'zstd'
+    dictionaries = {}
+
+    def __init__(self, level: int = None, dictionary: str = None):
+        super().__init__()
+        import zstandard
+        self.level = level if level is not None else settings.ZSTD_LEVEL
+        path = dictionary or settings.ZSTD_DICTIONARY
+        params = {'level': self.level}
+        if path:
+            params['dict_data'] = self.load_dictionary(path)
+            self.name = f"zstd-{os.path.basename(path)}"
+        self.zstd = zstandard.ZstdCompressor(**params).compressobj()
+
+    @classmethod
+    def load_dictionary(cls, path: str):
+        import zstandard
+        if path not in cls.dictionaries:
+            with open(path, 'rb') as f:
+                cls.dictionaries[path] = zstandard.ZstdCompressionDict(f.read())
+        return cls.dictionaries[path]
+
+    def _compress(self, data):
+        return self.zstd.compress(data)
+
+    def _flush(self):
+        return self.zstd.flush()
+
+
+def train_dictionary(samples: list, size: int = 112640):
+    """
+    Train a zstd dictionary from a list of (uncompressed) files. Write
+    the result to a file and point ZSTD_DICTIONARY at it
+    """
+    import zstandard
+    return zstandard.train_dictionary(size, samples).as_bytes()
+
+
+def gzip_codec() -> Codec:
+    """
+    Gzip, on a few threads if GZIP_THREADS is set
+    """
+    if settings.GZIP_THREADS > 1:
+        return ParallelGzip()
+    return Gzip()
+
+
+# the codec for each compressed file extension
+CODECS = {
+    'gz': gzip_codec,
+    'zst': Zstd,
+}
+
+# the file formats that can be written, parquet compresses itself
+CSV_FORMATS = ('csv',) + tuple(f"csv.{ext}" for ext in CODECS)
+FILE_FORMATS = CSV_FORMATS + ('parquet',)
+
+
+def compressor(ext: str) -> Codec:
+    """
+    The codec for a file extension (e.g. csv.gz)
+    """
+    codec = CODECS.get(ext.rsplit('.', 1)[-1])
+    return codec() if codec is not None else Codec()
@@ -0,0 +1,225 @@
+import time
+import logging
+import threading
+
+from open_data_export.config import settings
+from open_data_export.batch import error_code
+
+
+logger = logging.getLogger('concurrency')
+
+# errors that mean we are asking too much of s3 or the database
+OVERLOAD_CODES = {
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'RequestLimitExceeded',
+    'ServiceUnavailable',
+    '503',
+    'RequestTimeout',
+    'PoolTimeout',
+    'OperationalError',
+    'QueryCanceled',
+    'TooManyConnections',
+}
+
+
+class AdaptiveConcurrency:
+    """
+    Limit the number of jobs running at once and adjust that limit as
+    we go (additive increase, multiplicative decrease). After every
+    CONCURRENCY_WINDOW jobs the limit goes up by one unless the window
+    had an overload error (e.g. SlowDown), an error rate over
+    CONCURRENCY_ERROR_RATE or a db/s3 latency more than
+    CONCURRENCY_LATENCY_FACTOR times the best we have seen this run,
+    in which case it is cut in half. Overload errors cut it right away,
+    but only once per window.
+
+        with controller.slot():
+            ...
+        controller.record(db_ms=120, s3_ms=300)
+
+    Setting CONCURRENCY_MIN and CONCURRENCY_MAX to the same value
+    turns it into a fixed limit
+    """
+
+    def __init__(self, initial: int = None, minimum: int = None, maximum: int = None):
+        self.minimum = max(minimum or settings.CONCURRENCY_MIN, 1)
+        self.maximum = max(maximum or settings.CONCURRENCY_MAX, self.minimum)
+        self.initial = initial
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self, initial: int = None):
+        """
+        Start a new run
+        """
+        initial = initial or self.initial or self.minimum
+        with self.condition:
+            self.limit = min(max(initial, self.minimum), self.maximum)
+            self.inflight = 0
+            self.started = time.time()
+            self.jobs = 0
+            self.errors = 0
+            self.overloads = 0
+            self.increases = 0
+            self.decreases = 0
+            self.baseline = {}
+            self.trace = []
+            self.new_window()
+            self.adjust_trace('start')
+            self.condition.notify_all()
+
+    def new_window(self):
+        self.window = {'jobs': 0, 'errors': 0, 'overloads': 0, 'db': [], 's3': []}
+        self.decreased = False
+
+    def acquire(self):
+        with self.condition:
+            while self.inflight >= self.limit:
+                self.condition.wait()
+            self.inflight += 1
+
+    def release(self):
+        with self.condition:
+            self.inflight -= 1
+            self.condition.notify()
+
+    def slot(self):
+        return Slot(self)
+
+    def run(self, fn, *args, kind: str = None, **kwargs):
+        """
+        Run fn once there is room. If `kind` (db or s3) is passed the
+        time it took is recorded as that kind, otherwise the caller
+        should call record with the times it got back
+        """
+        with self.slot():
+            start = time.time()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                self.record(error=e)
+                raise
+        if kind is not None:
+            self.record(**{f"{kind}_ms": (time.time() - start)*1000})
+        return result
+
+    def record(self, db_ms: float = None, s3_ms: float = None, error=None):
+        """
+        Add a finished job
+        """
+        with self.condition:
+            self.jobs += 1
+            self.window['jobs'] += 1
+            if db_ms is not None:
+                self.window['db'].append(db_ms)
+            if s3_ms is not None:
+                self.window['s3'].append(s3_ms)
+            if error is not None:
+                self.add_error(error)
+            if self.window['jobs'] >= settings.CONCURRENCY_WINDOW:
+                self.end_window()
+
+    def failed(self, error):
+        """
+        Add an error without finishing a job, e.g. from a job that
+        handles its own errors
+        """
+        with self.condition:
+            self.add_error(error)
+
+    def add_error(self, error):
+        code = error_code(error)
+        self.errors += 1
+        self.window['errors'] += 1
+        if code in OVERLOAD_CODES:
+            self.overloads += 1
+            self.window['overloads'] += 1
+            if not self.decreased:
+                self.decrease(code)
+
+    def end_window(self):
+        reason = None
+        window = self.window
+        if window['overloads'] > 0:
+            reason = 'overload'
+        elif window['errors']/window['jobs'] > settings.CONCURRENCY_ERROR_RATE:
+            reason = 'errors'
+        for kind in ('db', 's3'):
+            if len(window[kind]) == 0:
+                continue
+            avg = sum(window[kind])/len(window[kind])
+            baseline = self.baseline.get(kind)
+            if baseline is None or avg < baseline:
+                self.baseline[kind] = avg
+                continue
+            if reason is None and avg > baseline*settings.CONCURRENCY_LATENCY_FACTOR:
+                reason = f"{kind}-latency"
+            # drift up so that a slow day does not keep us at the minimum
+            self.baseline[kind] = baseline + (avg - baseline)*0.1
+        if reason is None:
+            self.increase()
+        elif not self.decreased:
+            self.decrease(reason)
+        self.new_window()
+
+    def increase(self):
+        if self.limit < self.maximum:
+            self.limit += 1
+            self.increases += 1
+            self.adjust_trace('increase')
+            self.condition.notify()
+
+    def decrease(self, reason: str):
+        limit = max(self.minimum, self.limit//2)
+        self.decreased = True
+        if limit < self.limit:
+            self.limit = limit
+            self.decreases += 1
+            self.adjust_trace(reason)
+
+    def adjust_trace(self, reason: str):
+        window = self.window
+        self.trace.append({
+            't': round(time.time() - self.started, 1),
+            'limit': self.limit,
+            'inflight': self.inflight,
+            'db_ms': round(sum(window['db'])/len(window['db'])) if len(window['db']) > 0 else None,
+            's3_ms': round(sum(window['s3'])/len(window['s3'])) if len(window['s3']) > 0 else None,
+            'errors': window['errors'],
+            'reason': reason,
+        })
+        logger.debug(f"Concurrency {reason}: {self.trace[-1]}")
+
+    def stats(self):
+        limits = [t['limit'] for t in self.trace]
+        return {
+            'limit': self.limit,
+            'min': min(limits),
+            'max': max(limits),
+            'jobs': self.jobs,
+            'errors': self.errors,
+            'overloads': self.overloads,
+            'increases': self.increases,
+            'decreases': self.decreases,
+        }
+
+    def trace_summary(self):
+        """
+        The trace as `seconds:limit(reason)` so it fits on one log line
+        """
+        return ' '.join([f"{t['t']}:{t['limit']}({t['reason']})" for t in self.trace])
+
+
+class Slot:
+    def __init__(self, controller: AdaptiveConcurrency):
+        self.controller = controller
+
+    def __enter__(self):
+        self.controller.acquire()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self.controller.release()
+        return False
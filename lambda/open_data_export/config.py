@@ -1,4 +1,4 @@
-from typing import Optional
+from typing import Optional, List
 from pydantic import BaseSettings, validator
 from pathlib import Path
 import os
@@ -11,7 +11,9 @@ class Settings(BaseSettings):
     LOCAL_SAVE_DIRECTORY: str = ''
     WRITE_FILE_LOCATION: str = 's3'  # local
     WRITE_FILE_FORMAT: str = 'csv'  # parquet, json
+    EXPORT_RESPONSE_FORMAT: str = 'Arrow'  # DataFrame
     OPEN_DATA_BUCKET: str = 'openaq-open-data-testing'
+    S3_ENDPOINT_URL: Optional[str] = None
     LAMBDA_FUNCTION_ARN: str = None
     DB_BACKUP_BUCKET: str = 'openaq-db-backups'
     DATABASE_READ_USER: str = 'postgres'
@@ -23,9 +25,78 @@ class Settings(BaseSettings):
     DATABASE_DB: str = 'postgres'
     DATABASE_READ_URL: Optional[str]
     DATABASE_WRITE_URL: Optional[str]
+    DATABASE_POOL_MIN_SIZE: int = 1
+    DATABASE_POOL_MAX_SIZE: int = 10
+    DATABASE_POOL_MAX_IDLE: int = 300
+    DATABASE_POOL_TIMEOUT: int = 30
+    DATABASE_POOL_WAIT_WARNING: float = 1.0
+    DATABASE_STATEMENT_CACHE_SIZE: int = 100
+    DATABASE_PREPARE_THRESHOLD: Optional[int] = 2
+    DATABASE_STREAM_CHUNK_SIZE: int = 10000
+    DATABASE_REPLICA_MAX_LAG: float = 60
+    DATABASE_REPLICA_LAG_CHECK: float = 30
+    DATABASE_SLOW_QUERY_MS: int = 5000
+    EXPORT_BATCH_NODES: int = 20
+    EXPORT_BATCH_ROW_BUDGET: int = 1000000
+    EXPORT_LARGEST_FIRST: bool = True
+    EXPORT_LARGE_RECORDS: int = 100000
+    EXPORT_MEMORY_BUDGET: int = 0
+    EXPORT_MEMORY_PER_JOB: int = 5242880
+    EXPORT_MEMORY_PER_RECORD: float = 500
+    GZIP_LEVEL: int = 6
+    GZIP_THREADS: int = 1
+    GZIP_BLOCK_SIZE: int = 4194304
+    ZSTD_LEVEL: int = 3
+    ZSTD_DICTIONARY: Optional[str] = None
+    DUMP_FILE_FORMAT: str = 'csv.gz'
+    PARQUET_COMPRESSION: str = 'zstd'
+    PARQUET_COMPRESSION_LEVEL: Optional[int] = None
+    PARQUET_ROW_GROUP_SIZE: int = 100000
+    PARQUET_PAGE_SIZE: int = 1048576
+    PARQUET_STATISTICS: List[str] = ['datetime', 'value']
+    EXPORT_CSV_COPY: bool = False
+    EXPORT_FINGERPRINT: bool = True
+    EXPORT_FINGERPRINT_NEW: bool = False
+    EXPORT_SERIALIZE_PROCESSES: int = 0
+    WRITE_PART_SIZE: int = 8388608
+    WRITE_SPILL_SIZE: int = 12582912
+    WRITE_SPILL_DIRECTORY: str = '/tmp'
+    METADATA_CACHE_SIZE: int = 20000
+    METADATA_CACHE_TTL: float = 3600
+    METADATA_CACHE_CHECK: float = 300
+    METADATA_VERSION: int = 1
+    EXPORT_LOG_BATCH_SIZE: int = 50
+    EXPORT_LOG_BATCH_SECONDS: float = 5
+    ERROR_BATCH_SIZE: int = 100
+    ERROR_BATCH_SECONDS: float = 10
+    EXPORT_DEADLINE_BUFFER: float = 20
+    EXPORT_AUTO_LIMIT: bool = True
+    EXPORT_LIMIT_MIN: int = 10
+    EXPORT_LIMIT_MAX: int = 5000
+    EXPORT_LIMIT_SAFETY: float = 0.8
+    EXPORT_ESTIMATE_ROWS: int = 5000
+    EXPORT_ESTIMATE_MIN_ROWS: int = 50
+    EXPORT_ESTIMATE_WINDOW: float = 86400
+    EXPORT_LEASES: bool = False
+    EXPORT_LEASE_SECONDS: float = 900
+    EXPORT_LEASE_HEARTBEAT: float = 60
+    EXPORT_JOB_TIMEOUT: float = 120
+    EXPORT_JOB_ESTIMATE: float = 5
+    CONCURRENCY_MIN: int = 2
+    CONCURRENCY_MAX: int = 32
+    CONCURRENCY_WINDOW: int = 10
+    CONCURRENCY_LATENCY_FACTOR: float = 2.0
+    CONCURRENCY_ERROR_RATE: float = 0.2
+    ASYNC_DB_CONCURRENCY: int = 10
+    ASYNC_S3_CONCURRENCY: int = 50
+    ASYNC_COMMAND_TIMEOUT: int = 60
     TESTLOCAL: bool = True
 
 
+    @validator('DATABASE_PREPARE_THRESHOLD', 'PARQUET_COMPRESSION_LEVEL', 'ZSTD_DICTIONARY', pre=True, allow_reuse=True)
+    def empty_is_none(cls, v):
+        return None if v == '' else v
+
     @validator('DATABASE_READ_URL', allow_reuse=True)
     def get_read_url(cls, v, values):
         return v or f"postgresql://{values['DATABASE_READ_USER']}:{values['DATABASE_READ_PASSWORD']}@{values['DATABASE_HOST']}:{values['DATABASE_PORT']}/{values['DATABASE_DB']}"
@@ -4,7 +4,9 @@ import logging
 
 from open_data_export.config import settings
 from buildpg import render
+from open_data_export.pgdb import arrow_field, csv_table
 from pandas import DataFrame
+import pyarrow as pa
 import orjson
 
 logger = logging.getLogger(__name__)
@@ -22,10 +24,10 @@ class DB:
         if self.pg_pool is None:
             self.pg_pool = await asyncpg.create_pool(
                 settings.DATABASE_WRITE_URL,
-                command_timeout=14,
-                max_inactive_connection_lifetime=15,
-                min_size=1,
-                max_size=10,
+                command_timeout=settings.ASYNC_COMMAND_TIMEOUT,
+                max_inactive_connection_lifetime=settings.DATABASE_POOL_MAX_IDLE,
+                min_size=min(settings.DATABASE_POOL_MIN_SIZE, settings.ASYNC_DB_CONCURRENCY),
+                max_size=settings.ASYNC_DB_CONCURRENCY,
             )
         return self.pg_pool
 
@@ -42,25 +44,36 @@ class DB:
         async with pool.acquire() as con:
             try:
                 stm = await con.prepare(rquery)
-                fields = [a.name for a in stm.get_attributes()]
-                if method == 'row':
+                attributes = stm.get_attributes()
+                fields = [a.name for a in attributes]
+                if method == 'arrow':
+                    schema = [arrow_field(a.name, a.type.name) for a in attributes]
+                    # postgres writes the rows as csv and pyarrow reads
+                    # them so the values never become python objects
+                    chunks = []
+
+                    async def collect(chunk):
+                        chunks.append(chunk)
+
+                    async with con.transaction():
+                        if any(pa.types.is_timestamp(f.type) for f in schema):
+                            await con.execute("SELECT set_config('TimeZone', 'UTC', true)")
+                        await con.copy_from_query(rquery, *args, output=collect, format='csv')
+                    data = csv_table(b''.join(chunks), schema)
+                elif method == 'row':
                     data = await stm.fetchrow(*args)
                 elif method == 'value':
                     data = await stm.fetchval(*args)
                 else:
                     data = await stm.fetch(*args)
-                n = len(data)
+                n = len(data) if data is not None and method != 'value' else 1
                 dur = time.time() - start
                 self.query_time += dur
-                logger.info("query rows: seconds: %0.4f, results: %s", dur, n)
-                logger.debug(dur)
+                logger.debug("query rows: seconds: %0.4f, results: %s", dur, n)
                 return data, fields, n, round(dur*1000)
             except Exception as e:
                 logger.warning(f"Query error: {e}");
                 raise ValueError(f"{e}") from None
-            finally:
-                logger.warning("releasing connection")
-                await pool.release(con)
 
     async def rows(
             self,
@@ -68,6 +81,9 @@ class DB:
             response_format: str = 'default',
             **kwargs
     ):
+        if response_format == 'Arrow' or self.response_format == 'Arrow':
+            data, fields, n, time_ms = await self.__query(query, params = kwargs, method='arrow')
+            return data, time_ms
         data, fields, n, time_ms = await self.__query(query, params = kwargs, method='rows')
         if response_format == 'DataFrame' or self.response_format == 'DataFrame':
             data = DataFrame(data, columns=fields)
@@ -96,6 +112,11 @@ class DB:
         logger.debug(time_ms)
         return data, time_ms
 
+    async def close(self):
+        if self.pg_pool is not None:
+            await self.pg_pool.close()
+            self.pg_pool = None
+
     async def stream(
             self,
             query: str,
@@ -0,0 +1,145 @@
+import time
+import logging
+import threading
+
+from open_data_export.config import settings
+
+
+logger = logging.getLogger('deadline')
+
+# the deadline for the job running on this thread
+local = threading.local()
+
+
+class DeadlineExceeded(Exception):
+    pass
+
+
+def check_deadline():
+    """
+    Raise DeadlineExceeded if the job on this thread is out of time.
+    Called between the steps of a job (e.g. after the fetch and before
+    each chunk is written) since we cannot stop a thread from outside
+    """
+    end = getattr(local, 'end', None)
+    if end is not None and time.time() > end:
+        raise DeadlineExceeded(f"Job ran past its deadline by {round(time.time() - end, 1)} seconds")
+
+
+def time_left():
+    """
+    Seconds left for the job on this thread, None outside of a job
+    """
+    end = getattr(local, 'end', None)
+    if end is None:
+        return None
+    return max(end - time.time(), 0)
+
+
+class Job:
+    def __init__(self, deadline, end: float):
+        self.deadline = deadline
+        self.end = end
+
+    def __enter__(self):
+        self.start = time.time()
+        local.end = self.end
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        local.end = None
+        self.deadline.add(time.time() - self.start, exc_type is DeadlineExceeded)
+        return False
+
+
+class Deadline:
+    """
+    Keep track of how much time the lambda has left and how long jobs
+    are taking so that we stop starting jobs that will not finish.
+    EXPORT_DEADLINE_BUFFER seconds are held back to release whatever
+    we did not get to, and each job gets at most EXPORT_JOB_TIMEOUT
+    seconds. Without a lambda context there is no overall deadline.
+
+        deadline.reset(context)
+        if deadline.can_start():
+            with deadline.job():
+                ...
+                deadline.finish(node, day)
+        deadline.unfinished(rows)
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self, context=None):
+        self.started = time.time()
+        self.end = None
+        if context is not None and hasattr(context, 'get_remaining_time_in_millis'):
+            remaining = context.get_remaining_time_in_millis()/1000
+            self.end = self.started + remaining - settings.EXPORT_DEADLINE_BUFFER
+        self.finished = set()
+        self.jobs = 0
+        self.seconds = 0
+        self.timed_out = 0
+        self.skipped = 0
+
+    def remaining(self):
+        """
+        Seconds left to start/finish jobs, or None if there is no deadline
+        """
+        if self.end is None:
+            return None
+        return max(self.end - time.time(), 0)
+
+    def estimate(self):
+        """
+        How long we expect the next job to take
+        """
+        with self.lock:
+            if self.jobs == 0:
+                return settings.EXPORT_JOB_ESTIMATE
+            return self.seconds/self.jobs
+
+    def can_start(self):
+        remaining = self.remaining()
+        if remaining is None or remaining > self.estimate():
+            return True
+        with self.lock:
+            self.skipped += 1
+        return False
+
+    def job(self):
+        end = time.time() + settings.EXPORT_JOB_TIMEOUT
+        if self.end is not None:
+            end = min(end, self.end)
+        return Job(self, end)
+
+    def add(self, seconds: float, timed_out: bool):
+        with self.lock:
+            self.jobs += 1
+            self.seconds += seconds
+            self.timed_out += int(timed_out)
+
+    def finish(self, node: int, day):
+        """
+        Mark a location/day as done (exported or failed)
+        """
+        with self.lock:
+            self.finished.add((node, day))
+
+    def unfinished(self, rows: list):
+        """
+        The (node, day) rows that were not finished
+        """
+        with self.lock:
+            return [r for r in rows if (r[0], r[1]) not in self.finished]
+
+    def stats(self):
+        return {
+            'jobs': self.jobs,
+            'avg_seconds': round(self.seconds/self.jobs, 2) if self.jobs > 0 else None,
+            'timed_out': self.timed_out,
+            'not_started': self.skipped,
+            'remaining': round(self.remaining(), 1) if self.end is not None else None,
+        }
@@ -1 +1,3 @@
 from open_data_export.db import DB
+
+__all__ = ['DB']
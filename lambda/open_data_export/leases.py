@@ -0,0 +1,201 @@
+import os
+import uuid
+import socket
+import logging
+import threading
+
+from open_data_export.config import settings
+
+
+logger = logging.getLogger('leases')
+
+# Pending location/days (a complete day in the local timezone) that are
+# not queued, or whose lease has run out. A location/day that failed
+# keeps its lease (and exported_on stays NULL) but is left alone, or it
+# would be claimed again every time the lease ran out
+PENDING_SQL = """
+  FROM open_data_export_logs l
+  JOIN sensor_nodes sn ON (l.sensor_nodes_id = sn.sensor_nodes_id)
+  JOIN timezones tz ON (sn.timezones_id = tz.gid)
+  WHERE l.exported_on IS NULL
+  AND (l.has_error IS NULL OR NOT l.has_error)
+  AND (l.queued_on IS NULL OR l.lease_expires_on < now())
+  AND (l.day + '1day'::interval) < timezone(tz.tzid, now())
+"""
+
+# SKIP LOCKED so that workers claiming at the same time get
+# different rows instead of waiting on each other
+CLAIM_SQL = f"""
+WITH pending AS (
+  SELECT l.sensor_nodes_id
+  , l.day
+  {PENDING_SQL}
+  ORDER BY l.day
+  LIMIT :limit
+  FOR UPDATE OF l SKIP LOCKED)
+UPDATE open_data_export_logs l
+SET queued_on = now()
+, lease_worker = :worker
+, lease_expires_on = now() + make_interval(secs => :seconds)
+FROM pending
+WHERE l.sensor_nodes_id = pending.sensor_nodes_id
+AND l.day = pending.day
+RETURNING l.sensor_nodes_id, l.day, l.records
+"""
+
+PENDING_COUNT_SQL = f"""
+SELECT COUNT(1)
+{PENDING_SQL}
+"""
+
+# only touch the rows that are still ours, someone else could have
+# picked them up after our lease ran out
+EXTEND_SQL = """
+UPDATE open_data_export_logs l
+SET lease_expires_on = now() + make_interval(secs => :seconds)
+FROM unnest(
+  (:nodes)::int[]
+, (:days)::date[]
+) as r(sensor_nodes_id, day)
+WHERE l.sensor_nodes_id = r.sensor_nodes_id
+AND l.day = r.day
+AND l.lease_worker = :worker
+AND l.exported_on IS NULL
+RETURNING TRUE
+"""
+
+RELEASE_SQL = """
+UPDATE open_data_export_logs l
+SET queued_on = NULL
+, lease_worker = NULL
+, lease_expires_on = NULL
+FROM unnest(
+  (:nodes)::int[]
+, (:days)::date[]
+) as r(sensor_nodes_id, day)
+WHERE l.sensor_nodes_id = r.sensor_nodes_id
+AND l.day = r.day
+AND l.lease_worker = :worker
+RETURNING TRUE
+"""
+
+
+def worker_id():
+    """
+    Unique to this process, and readable enough to find in the logs
+    """
+    return f"{socket.gethostname()}-{os.getpid()}-{uuid.uuid4().hex[:8]}"
+
+
+class Leases:
+    """
+    Claim location/days for EXPORT_LEASE_SECONDS at a time. A worker
+    that dies (or times out) just lets its leases run out and the rows
+    can be claimed again, and a worker that is still busy extends the
+    leases on what it has left with a heartbeat. Needs the lease columns
+    from schema/leases.sql
+    """
+
+    def __init__(self, db, worker: str = None, seconds: float = None):
+        self.db = db
+        self.worker = worker or worker_id()
+        self.seconds = seconds or settings.EXPORT_LEASE_SECONDS
+        self.lock = threading.Lock()
+        self.claimed = 0
+        self.extended = 0
+        self.released = 0
+
+    def claim(self, limit: int):
+        rows, ms = self.db.rows(
+            CLAIM_SQL,
+            tag='claim',
+            limit=limit,
+            worker=self.worker,
+            seconds=self.seconds,
+        )
+        with self.lock:
+            self.claimed += len(rows)
+        logger.debug(f"{self.worker} claimed {len(rows)} location/days in {ms}ms")
+        return rows, ms
+
+    def update(self, sql: str, rows: list, tag: str):
+        """
+        Run EXTEND_SQL or RELEASE_SQL for a list of (node, day) rows
+        """
+        if len(rows) == 0:
+            return 0
+        updated, ms = self.db.rows(
+            sql,
+            tag=tag,
+            nodes=[r[0] for r in rows],
+            days=[r[1] for r in rows],
+            worker=self.worker,
+            seconds=self.seconds,
+        )
+        return len(updated)
+
+    def extend(self, rows: list):
+        n = self.update(EXTEND_SQL, rows, 'lease-extend')
+        with self.lock:
+            self.extended += n
+        return n
+
+    def release(self, rows: list):
+        n = self.update(RELEASE_SQL, rows, 'lease-release')
+        with self.lock:
+            self.released += n
+        return n
+
+    def heartbeat(self, rows, interval: float = None):
+        """
+        Extend the leases on rows() every `interval` seconds while
+        the block runs
+
+            with leases.heartbeat(lambda: unfinished):
+                ...
+        """
+        return Heartbeat(self, rows, interval or settings.EXPORT_LEASE_HEARTBEAT)
+
+    def stats(self):
+        return {
+            'worker': self.worker,
+            'claimed': self.claimed,
+            'extended': self.extended,
+            'released': self.released,
+        }
+
+
+class Heartbeat:
+    def __init__(self, leases: Leases, rows, interval: float):
+        self.leases = leases
+        self.rows = rows
+        self.interval = interval
+        self.stopped = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(target=self.run, name='lease-heartbeat', daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.stopped.set()
+        if self.thread is not None:
+            self.thread.join()
+
+    def __enter__(self):
+        return self.start()
+
+    def run(self):
+        while not self.stopped.wait(self.interval):
+            try:
+                rows = self.rows()
+                n = self.leases.extend(rows)
+                logger.debug(f"Extended {n} (of {len(rows)}) leases")
+            except Exception as e:
+                # the next beat might work, and if not the lease runs out
+                logger.warning(f"Could not extend the leases: {e}")
+
+    def __exit__(self, exc_type, exc, tb):
+        self.stop()
+        return False
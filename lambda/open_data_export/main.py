@@ -3,21 +3,35 @@ import os
 import csv
 import gzip
 import re
-
-from multiprocessing import Process, Pool
-from concurrent.futures import ThreadPoolExecutor, as_completed
-from open_data_export.pgdb import DB
+import heapq
+import orjson
+
+from concurrent.futures import ThreadPoolExecutor, as_completed, wait, TimeoutError as FutureTimeout
+from open_data_export.pgdb import DB, arrow_field
+from open_data_export.batch import ExportLogBatch, ErrorBatch
+from open_data_export.metadata import MetadataCache, attach, params, copy_params
+from open_data_export.writer import (
+    StreamWriter,
+    write_parquet,
+    write_stats,
+    content_hash,
+)
+from open_data_export.serialize import get_serializer
+from open_data_export.concurrency import AdaptiveConcurrency
+from open_data_export.deadline import Deadline, DeadlineExceeded, check_deadline
+from open_data_export.leases import Leases
+from open_data_export.memory import MemoryBudget, hold, observe, nbytes, node_peak
+from open_data_export.compression import compressor, CSV_FORMATS, FILE_FORMATS
 from open_data_export.config import settings
 from smart_open import open
 
 # import asyncio
 import time
-# import pyarrow
-# from pyarrow import csv
-# import pyarrow.parquet as pq
+import pyarrow as pa
+import pyarrow.compute as pacompute
 from pandas import DataFrame
 from datetime import datetime, timedelta
-from io import StringIO, BytesIO
+from io import StringIO
 from typing import Union
 import botocore
 import boto3
@@ -36,25 +50,76 @@ logging.getLogger('botocore').setLevel(logging.WARNING)
 logging.getLogger('urllib3').setLevel(logging.WARNING)
 
 max_processes =  os.cpu_count() + 4
+# the number of jobs running at once starts at max_processes and is
+# adjusted between CONCURRENCY_MIN and CONCURRENCY_MAX as we go
+controller = AdaptiveConcurrency(initial=max_processes)
+# how much time the lambda has left, see export_pending
+deadline = Deadline()
+memory_budget = MemoryBudget()
 boto_config = botocore.config.Config(
-    max_pool_connections=max_processes,
+    max_pool_connections=controller.maximum,
+)
+s3 = boto3.client(
+    "s3",
+    config=boto_config,
+    endpoint_url=settings.S3_ENDPOINT_URL,
 )
-s3 = boto3.client("s3", config=boto_config)
 cloudwatch = boto3.client("cloudwatch")
 
 db = None
+metadata = None
+leases = None
+# (key, hash, fingerprint) of the last file written for a location/day, see load_export_hashes
+export_hashes = {}
+# the current fingerprint of the data for a location/day, see load_fingerprints
+export_fingerprints = {}
+# how many records we expect for a location/day (from the export log), see schedule_pending
+export_records = {}
 # Iterate the version number when when a change is made
 # version number must be an integer
 FILE_FORMAT_VERSION = 1
 
+# the columns (and order) that end up in the exported file
+EXPORT_FIELDS = [
+    "location_id",
+    "sensors_id",
+    "location",
+    "datetime",
+    "lat",
+    "lon",
+    "parameter",
+    "units",
+    "value"
+]
 
 def get_database():
     global db
     if db is None:
-        db = DB()
+        # the serialize workers are forked, which has to happen
+        # before the connection pool starts its threads
+        if get_serializer() is not None:
+            get_serializer().start()
+        # one connection for each worker thread and keep it around
+        # for the next (warm) invocation
+        db = DB(pool_size=controller.maximum)
     return db
 
 
+def get_metadata():
+    global metadata
+    if metadata is None:
+        # kept around with the database for the next (warm) invocation
+        metadata = MetadataCache(get_database())
+    return metadata
+
+
+def get_leases():
+    global leases
+    if leases is None:
+        leases = Leases(get_database())
+    return leases
+
+
 def put_metric(
         namespace,
         metricname,
@@ -115,7 +180,8 @@ def ping(event, context):
 
 
 def dump_measurements(
-        day: Union[str, datetime.date]
+        day: Union[str, datetime.date],
+        ext: str = settings.DUMP_FILE_FORMAT,
 ):
     """
     Export the 24h (utc) data to the export bucket
@@ -141,7 +207,6 @@ def dump_measurements(
 
     bucket = "openaq-db-backups"
     folder = "testing"
-    ext = "csv.gz"
     nextday = day + timedelta(days=1)
     formatted_start = day.strftime("%Y%m%d%H%M%S")
     formatted_end = nextday.strftime("%Y%m%d%H%M%S")
@@ -154,20 +219,24 @@ def dump_measurements(
 
     data = db.stream(
         sql,
+        write=False,
+        tag='dump',
         day=day,
         nextday=nextday,
-        chunk_size=1000,
     )
     n = 0
 
+    # we do the compression so that the codec and level can be set
+    codec = compressor(ext)
     params = {"buffer_size": 5*1024 ** 2}
-    with open(f"s3://{bucket}/{filepath}.{ext}", "wb", params) as fout:
+    with open(f"s3://{bucket}/{filepath}.{ext}", "wb", compression='disable', transport_params=params) as fout:
         include_header = True
         for chunk in data:
             n += len(chunk)
             csv = chunk.to_csv(header=include_header)
             include_header = False
-            fout.write(csv.encode('UTF-8'))
+            fout.write(codec.compress(csv.encode('UTF-8')))
+        fout.write(codec.flush())
 
         # out = BytesIO()
         # row.to_csv(csv_buffer, index=False, mode="w", encoding="UTF-8")
@@ -175,8 +244,8 @@ def dump_measurements(
         # logger.debug(csv_buffer.read())
 
     logger.info(
-        "dump_measurements (query): day: %s; %s rows; %0.4f seconds",
-        day, n, time.time() - start
+        "dump_measurements (query): day: %s; %s rows; %0.4f seconds; compression: %s",
+        day, n, time.time() - start, codec.stats()
     )
 
     #download_file(bucket, f"{filepath}.{ext}")
@@ -263,9 +332,28 @@ def copy_object(from_location, to_location, delete=False):
         raise
 
 
-def move_objects_handler(event, context=None):
-    start = time.time()
-    db = get_database()
+def split_key(key: str, ext: str = settings.WRITE_FILE_FORMAT):
+    """
+    Split an export log key (s3://bucket/key) into the bucket and key
+    and make sure that the key has the extension
+    """
+    if not key.endswith(ext):
+        key = f"{key}.{ext}"
+
+    pattern = 's3://([a-z-]+)/'
+    if match := re.search(pattern, key, re.IGNORECASE):
+        bucket = match.group(1)
+        key = re.sub(pattern, '', key)
+    else:
+        bucket = settings.OPEN_DATA_BUCKET
+    return bucket, key
+
+
+def move_objects_claim(event: dict):
+    """
+    Build the query that claims a set of files to move and returns
+    the from and to keys
+    """
     limit = 2
     where = "exported_on IS NOT NULL"
     # AND (l.metadata->>'move' IS NOT NULL AND (l.metadata->>'move')::boolean = true)
@@ -293,22 +381,14 @@ def move_objects_handler(event, context=None):
         where += " AND l.sensor_nodes_id = :node"
 
 
-    # determine the extension type
-    if settings.WRITE_FILE_FORMAT == 'csv':
-        ext = 'csv'
-    elif settings.WRITE_FILE_FORMAT == 'csv.gz':
-        ext = 'csv.gz'
-    elif settings.WRITE_FILE_FORMAT == 'parquet':
-        ext = 'parquet'
-    elif settings.WRITE_FILE_FORMAT == 'json':
-        raise Exception("We are not supporting JSON yet")
-    else:
-        raise Exception(f"We are not supporting {settings.WRITE_FILE_FORMAT}")
+    # the files go where export_filepath would put them
+    ext = settings.WRITE_FILE_FORMAT
+    if ext not in FILE_FORMATS:
+        raise Exception(f"We are not supporting {ext}")
 
     # where = " AND l.metadata->>'Bucket' IS NOT NULL"
 
-    days, time_ms = db.rows(
-        f"""
+    sql = f"""
         WITH days AS (
         -----------
         -- get a set of files to move
@@ -317,7 +397,7 @@ def move_objects_handler(event, context=None):
           l.day
         , l.sensor_nodes_id
         , l.key as from_key
-        , FORMAT('records/csv.gz/locationid=%%s/year=%%s/month=%%s/location-%%s-%%s.{ext}'
+        , FORMAT('records/{ext}/locationid=%%s/year=%%s/month=%%s/location-%%s-%%s.{ext}'
           , l.sensor_nodes_id
           , to_char(l.day, 'YYYY')
           , to_char(l.day, 'MM')
@@ -345,21 +425,33 @@ def move_objects_handler(event, context=None):
         -- return the pre-update data
         -----------
         RETURNING days.*;
-        """, **args)
+        """
+    return sql, args
+
 
-    with ThreadPoolExecutor(max_workers=max_processes) as exe:
+def move_objects_handler(event, context=None):
+    start = time.time()
+    db = get_database()
+    sql, args = move_objects_claim(event)
+    days, time_ms = db.rows(sql, tag='move-claim', **args)
+
+    errors = ErrorBatch(db)
+    controller.reset()
+    with ThreadPoolExecutor(max_workers=controller.maximum) as exe:
         jobs = []
         for row in days:
-            jobs.append(exe.submit(move_objects_mp, row))
+            jobs.append(exe.submit(controller.run, move_objects_mp, row, errors, kind='s3'))
 
         count = 0
         for job in as_completed(jobs):
             count += job.result()
 
+    errors.flush()
     sec = time.time() - start
-    logger.info(f'Moved {count} files (of {len(days)}) in {sec} seconds (query: {time_ms/1000}, processes: {max_processes})')
+    logger.info(f'Moved {count} files (of {len(days)}) in {sec} seconds (query: {time_ms/1000}, concurrency: {controller.stats()}, errors: {dict(errors.codes)})')
+    logger.info(f'Concurrency trace: {controller.trace_summary()}')
 
-def move_objects_mp(row):
+def move_objects_mp(row, errors: ErrorBatch = None):
     day = row[0]
     node = row[1]
     from_key = row[2]
@@ -367,16 +459,7 @@ def move_objects_mp(row):
     ext = settings.WRITE_FILE_FORMAT
 
     try:
-        # make sure that we have the extension on the from_key
-        if not from_key.endswith(ext):
-            from_key = f"{from_key}.{ext}"
-
-        pattern = 's3://([a-z-]+)/'
-        if match := re.search(pattern, from_key, re.IGNORECASE):
-            bucket = match.group(1)
-            from_key = re.sub(pattern, '', from_key)
-        else:
-            bucket = settings.OPEN_DATA_BUCKET
+        bucket, from_key = split_key(from_key, ext)
 
         copy_object(
             from_location={
@@ -391,14 +474,18 @@ def move_objects_mp(row):
             )
         return 1
     except Exception as e:
-        submit_move_error(day, node, from_key, f"{e}")
+        controller.failed(e)
+        if errors is not None:
+            errors.append(day, node, e, key=from_key, move=True)
+        else:
+            submit_move_error(day, node, from_key, f"{e}")
         return 0
 
-def check_objects(day=None,node=None,limit=10):
-    start = time.time()
-    db = get_database()
-    args ={}
-    ext = settings.WRITE_FILE_FORMAT
+def check_objects_claim(day=None, node=None, limit=10):
+    """
+    Build the query that claims a set of keys to check
+    """
+    args = {}
 
     where = ""
 
@@ -440,22 +527,55 @@ def check_objects(day=None,node=None,limit=10):
           -----------
           RETURNING keys.*;
           """
+    return sql, args
 
-    keys, time_ms = db.rows(sql, **args)
 
-    with ThreadPoolExecutor(max_workers=max_processes) as exe:
-        jobs = []
-        for row in keys:
-            jobs.append(exe.submit(check_objects_mp, row))
+def check_objects(day=None,node=None,limit=10,context=None):
+    start = time.time()
+    deadline.reset(context)
+    db = get_database()
+    sql, args = check_objects_claim(day, node, limit)
+    keys, time_ms = db.rows(sql, tag='check-claim', **args)
 
-        count = 0
-        for job in as_completed(jobs):
-            count += job.result()
+    errors = ErrorBatch(db)
+    controller.reset()
+    exe = ThreadPoolExecutor(max_workers=controller.maximum)
+    jobs = {}
+    for row in keys:
+        jobs[exe.submit(controller.run, check_objects_job, row, errors, kind='s3')] = [(row[1], row[0])]
 
+    count = 0
+    try:
+        for job in as_completed(jobs, timeout=deadline.remaining()):
+            try:
+                count += job.result()
+            except DeadlineExceeded as e:
+                logger.warning(f'Stopped a check: {e}')
+    except FutureTimeout:
+        logger.warning(f'Out of time with {len([j for j in jobs if not j.done()])} checks still running')
+    finally:
+        exe.shutdown(wait=False, cancel_futures=True)
+
+    errors.flush()
+    # the keys are (day, node, key)
+    released = release_claims(unstarted(jobs, deadline.unfinished([(r[1], r[0]) for r in keys])), 'checked_on')
     sec = time.time() - start
-    logger.info(f'Checked {count} objects (of {len(keys)}) in {sec} seconds (query: {time_ms/1000}, processes: {max_processes})')
+    logger.info(f'Checked {count} objects (of {len(keys)}, {released} released) in {sec} seconds (query: {time_ms/1000}, concurrency: {controller.stats()}, deadline: {deadline.stats()}, errors: {dict(errors.codes)})')
+    logger.info(f'Concurrency trace: {controller.trace_summary()}')
+
+def check_objects_job(row, errors: ErrorBatch = None):
+    """
+    Check an object unless we are out of time
+    """
+    if not deadline.can_start():
+        return 0
+    with deadline.job():
+        count = check_objects_mp(row, errors)
+    deadline.finish(row[1], row[0])
+    return count
 
-def check_objects_mp(row):
+
+def check_objects_mp(row, errors: ErrorBatch = None):
     day = row[0]
     node = row[1]
     key = row[2]
@@ -467,15 +587,7 @@ def check_objects_mp(row):
             logger.warning('Missing key')
             return 0
 
-        if not key.endswith(ext):
-            key = f"{key}.{ext}"
-
-        pattern = 's3://([a-z-]+)/'
-        if match := re.search(pattern, key, re.IGNORECASE):
-            bucket = match.group(1)
-            key = re.sub(pattern, '', key)
-        else:
-            bucket = settings.OPEN_DATA_BUCKET
+        bucket, key = split_key(key, ext)
 
         # temporary until we can figure out the acl perimissions issue
         #info = object_info(Bucket=bucket, Key=key)
@@ -483,14 +595,21 @@ def check_objects_mp(row):
         #return 1
 
         is_public_read = object_is_public_read(Bucket=bucket, Key=key)
+        check_deadline()
         if not is_public_read:
             ## assume it exists but is not public
             logger.warn(f'Updating object acl - {key}')
             s3.put_object_acl(Bucket=bucket, Key=key, ACL='public-read')
 
         return 1
+    except DeadlineExceeded:
+        raise
     except Exception as err:
-        submit_error(day, node, err)
+        controller.failed(err)
+        if errors is not None:
+            errors.append(day, node, err)
+        else:
+            submit_error(day, node, err)
         return 0
 
 
@@ -499,7 +618,7 @@ def update_hourly_data(ts):
     Mark the location/day as exported
     """
     if isinstance(ts, str):
-        day = datetime.fromisoformat(ts)
+        ts = datetime.fromisoformat(ts)
     sql = """
 	SELECT update_hourly_data(:datetime::timestamptz)
     """
@@ -518,7 +637,8 @@ def update_export_log(
         n: int,
         msec: int,
         bucket: str,
-        key: str
+        key: str,
+        metadata: dict = None,
 ):
     """
     Mark the location/day as exported
@@ -532,19 +652,21 @@ def update_export_log(
     , key = :key
     , has_error = :error
 		, version = :version
-    , metadata = jsonb_build_object(
-      'msec', (:msec)::numeric
-    )
+    , metadata = (:metadata)::jsonb
     WHERE day = :day AND sensor_nodes_id = :node
     RETURNING TRUE
     """
+    meta = {'msec': msec}
+    if metadata is not None:
+        meta.update(metadata)
     db = get_database()
     return db.rows(
         sql,
+        tag='log-update',
         day=day,
         node=node,
         n=n,
-        msec=msec,
+        metadata=orjson.dumps(meta).decode(),
 		error=False,
         key=f"s3://{bucket}/{key}",
         version=FILE_FORMAT_VERSION
@@ -580,8 +702,9 @@ def submit_error(day: str, node: int, error):
     RETURNING TRUE
     """
     logger.error(f"error: {node} on {day} - {error}")
+    deadline.finish(node, day)
     db = get_database()
-    return db.rows(sql, day=day, node=node, error=error)
+    return db.rows(sql, tag='error', day=day, node=node, error=error)
 
 def submit_move_error(day: str, node: int, key: str, error: str):
     """
@@ -602,7 +725,7 @@ def submit_move_error(day: str, node: int, key: str, error: str):
     """
     logger.error(f"error: {node} on {day} - {error}")
     db = get_database()
-    return db.rows(sql, day=day, node=node, key=key, error=error)
+    return db.rows(sql, tag='error', day=day, node=node, key=key, error=error)
 
 
 def get_all_location_days():
@@ -632,11 +755,178 @@ def get_pending_location_days(limit=settings.LIMIT):
     get the set of location/days that need to be updated
     """
     logger.debug(f'get_pending_days: {limit}')
-    sql = f"""
+    if settings.EXPORT_LEASES:
+        return get_leases().claim(limit)
+    sql = """
     SELECT * FROM get_pending(:limit)
     """
     db = get_database()
-    return db.rows(sql, limit=limit)
+    return db.rows(sql, tag='pending', limit=limit)
+
+
+def unstarted(jobs: dict, rows: list):
+    """
+    The (node, day) rows that are not part of a job that is still
+    running. A job that is still going when we run out of time could
+    still write its location/days, so those are left queued (or for
+    the lease to run out) instead of letting another worker export
+    them at the same time
+    """
+    running = {row for job, job_rows in jobs.items() if job.running() for row in job_rows}
+    return [r for r in rows if (r[0], r[1]) not in running]
+
+
+def abandoned(jobs: dict, rows: list):
+    """
+    The unfinished (node, day) rows to put back at the end of a run.
+    With leases a job that is stuck keeps its rows until the lease runs
+    out. Without them nothing would ever claim its rows again, so they go
+    back as well and the worst case is that they are exported twice
+    """
+    if settings.EXPORT_LEASES:
+        return unstarted(jobs, rows)
+    return rows
+
+
+def job_results(job):
+    """
+    The results of a finished export job, the concurrency controller
+    is told about each location/day
+    """
+    try:
+        results = job.result()
+    except DeadlineExceeded as e:
+        logger.warning(f'Stopped a job: {e}')
+        return []
+    for n, get_ms, write_ms, update_ms in results:
+        # the errors were passed on by export_data
+        if n >= 0:
+            controller.record(db_ms=get_ms, s3_ms=write_ms)
+        else:
+            controller.record()
+    return results
+
+
+def finish_running(jobs: dict, timeout: float):
+    """
+    Give the jobs that are still running up to `timeout` seconds to stop
+    (at their next check_deadline or when their statement times out) so
+    that what they exported gets into the export log. The executor should
+    be shut down first so that the queued jobs are cancelled. Returns the
+    results of the jobs that finished and the jobs that are stuck
+    """
+    done, stuck = wait([job for job in jobs if not job.done()], timeout=timeout)
+    results = []
+    for job in done:
+        if not job.cancelled():
+            results += job_results(job)
+    return results, stuck
+
+
+def release_claims(rows: list, column: str = 'queued_on'):
+    """
+    Put the claimed (node, day) rows that we did not get to back so
+    that the next run can claim them, in one statement
+    """
+    if len(rows) == 0:
+        return 0
+    if column == 'queued_on' and settings.EXPORT_LEASES:
+        released = get_leases().release(rows)
+        logger.info(f'Released {released} leases')
+        return released
+    sql = f"""
+    UPDATE open_data_export_logs l
+    SET {column} = NULL
+    FROM unnest(
+      (:nodes)::int[]
+    , (:days)::date[]
+    ) as r(sensor_nodes_id, day)
+    WHERE l.sensor_nodes_id = r.sensor_nodes_id
+    AND l.day = r.day
+    RETURNING TRUE
+    """
+    db = get_database()
+    released, ms = db.rows(
+        sql,
+        tag='release',
+        nodes=[r[0] for r in rows],
+        days=[r[1] for r in rows],
+    )
+    logger.info(f'Released {len(released)} claims ({column}) in {ms}ms')
+    return len(released)
+
+
+# how long the recent exports took, from what we stored in the log.
+# The files that were skipped because they had not changed did not cost anything
+ESTIMATE_SQL = """
+WITH recent AS (
+  SELECT records
+  , (metadata->>'msec')::numeric/1000 as seconds
+  , (metadata->>'peak_bytes')::numeric as peak_bytes
+  FROM open_data_export_logs
+  WHERE exported_on > now() - make_interval(secs => :window)
+  AND metadata->>'msec' IS NOT NULL
+  AND metadata->>'unchanged' IS NULL
+  ORDER BY exported_on DESC
+  LIMIT :n)
+SELECT COUNT(1)
+, AVG(seconds)
+, SUM(seconds)/NULLIF(SUM(records), 0)
+, AVG(records)
+, SUM(GREATEST(peak_bytes - :job_bytes, 0))/NULLIF(SUM(records) FILTER (WHERE peak_bytes IS NOT NULL), 0)
+FROM recent
+"""
+
+
+def get_export_estimate():
+    """
+    The rolling estimate of the seconds per location/day and per record,
+    and the memory per record, from the last EXPORT_ESTIMATE_ROWS exports
+    """
+    db = get_database()
+    rows, ms = db.rows(
+        ESTIMATE_SQL,
+        tag='estimate',
+        window=settings.EXPORT_ESTIMATE_WINDOW,
+        n=settings.EXPORT_ESTIMATE_ROWS,
+        job_bytes=settings.EXPORT_MEMORY_PER_JOB,
+        write=False,
+    )
+    n, seconds, record_seconds, records, record_bytes = rows[0]
+    return {
+        'exports': n,
+        'seconds': float(seconds) if seconds is not None else None,
+        'record_seconds': float(record_seconds) if record_seconds is not None else None,
+        'records': float(records) if records is not None else None,
+        'record_bytes': float(record_bytes) if record_bytes is not None else None,
+    }
+
+
+def claim_limit(concurrency: int):
+    """
+    How many location/days we can get through in the time we have left
+    with `concurrency` jobs at a time. Without a deadline (not in lambda)
+    or an estimate it is just LIMIT
+    """
+    remaining = deadline.remaining()
+    if remaining is None:
+        return settings.LIMIT, None
+    estimate = get_export_estimate()
+    seconds = estimate['seconds']
+    if seconds is None or estimate['exports'] < settings.EXPORT_ESTIMATE_MIN_ROWS:
+        seconds = settings.EXPORT_JOB_ESTIMATE
+    limit = int(remaining*concurrency/max(seconds, 0.001)*settings.EXPORT_LIMIT_SAFETY)
+    limit = min(max(limit, settings.EXPORT_LIMIT_MIN), settings.EXPORT_LIMIT_MAX)
+    logger.info(
+        "Claim limit: %s (remaining: %0.1fs, concurrency: %s, %0.3fs per location/day, %s per record, from %s recent exports)",
+        limit,
+        remaining,
+        concurrency,
+        seconds,
+        f"{estimate['record_seconds']:.6f}s" if estimate['record_seconds'] is not None else None,
+        estimate['exports'],
+    )
+    return limit, estimate
 
 
 def get_outdated_location_days():
@@ -647,12 +937,286 @@ def get_outdated_location_days():
     SELECT * FROM outdated_location_days({FILE_FORMAT_VERSION}, {settings.LIMIT})
     """
     db = get_database()
-    return db.rows(sql)
+    return db.rows(sql, tag='outdated')
+
+
+# the sensor metadata comes from the cache (see metadata.py)
+# so we only need to scan the measurements here
+MEASUREMENT_SQL = """
+    WITH sensors AS (
+      SELECT sensors_id, tz, starts, ends
+      FROM unnest(
+        (:sensors_ids)::int[]
+      , (:tzs)::text[]
+      , (:starts)::timestamptz[]
+      , (:ends)::timestamptz[]
+      ) as s(sensors_id, tz, starts, ends))
+    SELECT m.sensors_id
+    , format_timestamp(m.datetime, s.tz) as datetime
+    , m.value
+    , m.lon
+    , m.lat
+    FROM public.measurements m
+    JOIN sensors s ON (m.sensors_id = s.sensors_id
+      AND m.datetime > s.starts
+      AND m.datetime <= s.ends)
+    WHERE m.datetime > (:start)::timestamptz
+    AND m.datetime <= (:end)::timestamptz
+    {limit}
+    """
+
+MEASUREMENT_DATA_SQL = MEASUREMENT_SQL.format(
+    limit="",
+)
+
+# same as above but for a set of nodes (all on the same local day)
+MEASUREMENT_BATCH_SQL = MEASUREMENT_SQL.format(
+    limit="LIMIT :budget",
+)
+
+# the columns that MEASUREMENT_SQL returns, for a batch without any rows
+MEASUREMENT_FIELDS = [
+    arrow_field('sensors_id', 'int4'),
+    arrow_field('datetime', 'text'),
+    arrow_field('value', 'float8'),
+    arrow_field('lon', 'float8'),
+    arrow_field('lat', 'float8'),
+]
+
+
+def csv_float_sql(column: str):
+    """
+    A float8 column as the text that python (and so pandas) writes for
+    it. Postgres (with the default extra_float_digits) leaves the .0 off
+    of whole numbers and switches to an exponent at 1e15 instead of
+    1e16. Missing values and NaN become an empty string, which COPY
+    quotes, to match the "" that pandas writes
+    """
+    text = f"({column})::text"
+    digits = f"replace(replace(split_part({text}, 'e', 1), '-', ''), '.', '')"
+    return f"""CASE
+      WHEN {column} IS NULL OR {column} = 'NaN'::float8 THEN ''
+      WHEN {column} = 'Infinity'::float8 THEN 'inf'
+      WHEN {column} = '-Infinity'::float8 THEN '-inf'
+      WHEN {text} ~ 'e\\+15$' THEN
+        CASE WHEN {column} < 0 THEN '-' ELSE '' END
+        || rpad({digits}, 16, '0')
+        || '.'
+        || COALESCE(NULLIF(substr({digits}, 17), ''), '0')
+      WHEN {text} ~ '[.e]' THEN {text}
+      ELSE {text} || '.0'
+      END"""
+
+
+# the same as MEASUREMENT_SQL but with the metadata passed in as well
+# so that postgres can write out the csv itself (EXPORT_CSV_COPY), with
+# the values formatted the way the other writers do it
+MEASUREMENT_COPY_SQL = f"""
+    WITH sensors AS (
+      SELECT *
+      FROM unnest(
+        (:sensors_ids)::int[]
+      , (:tzs)::text[]
+      , (:starts)::timestamptz[]
+      , (:ends)::timestamptz[]
+      , (:location_ids)::int[]
+      , (:locations)::text[]
+      , (:parameters)::text[]
+      , (:units)::text[]
+      , (:lons)::float8[]
+      , (:lats)::float8[]
+      , (:mobile)::boolean[]
+      ) as s(sensors_id, tz, starts, ends, location_id, location, parameter, units, lon, lat, ismobile))
+    , measurements AS (
+      SELECT s.location_id
+      , m.sensors_id
+      , s.location
+      , format_timestamp(m.datetime, s.tz) as datetime
+      , CASE WHEN s.ismobile
+        THEN m.lat
+        ELSE s.lat
+        END as lat
+      , CASE WHEN s.ismobile
+        THEN m.lon
+        ELSE s.lon
+        END as lon
+      , s.parameter
+      , s.units
+      , m.value
+      FROM public.measurements m
+      JOIN sensors s ON (m.sensors_id = s.sensors_id
+        AND m.datetime > s.starts
+        AND m.datetime <= s.ends)
+      WHERE m.datetime > (:start)::timestamptz
+      AND m.datetime <= (:end)::timestamptz)
+    SELECT location_id
+    , sensors_id
+    , COALESCE(location, '') as location
+    , datetime
+    , {csv_float_sql('lat::float8')} as lat
+    , {csv_float_sql('lon::float8')} as lon
+    , COALESCE(parameter, '') as parameter
+    , COALESCE(units, '') as units
+    , {csv_float_sql('value::float8')} as value
+    FROM measurements
+    """
+
+# quote the text fields to match the other writers, a missing value is
+# an empty string by now and COPY quotes those anyway
+MEASUREMENT_COPY_OPTIONS = "FORMAT csv, FORCE_QUOTE (location, datetime, parameter, units)"
+
+# COPY does not quote the header
+CSV_HEADER = (",".join([f'"{f}"' for f in EXPORT_FIELDS]) + "\r\n").encode()
+
+
+def load_export_hashes(days: list):
+    """
+    Look up the key and content hash of the last export for each
+    location/day (node, day) so that we can skip writing a file
+    that has not changed
+    """
+    if len(days) == 0:
+        return 0
+    sql = """
+    SELECT l.sensor_nodes_id
+    , l.day
+    , l.key
+    , l.metadata->>'hash'
+    , l.metadata->>'fingerprint'
+    , l.records
+    FROM open_data_export_logs l
+    JOIN unnest((:nodes)::int[], (:days)::date[]) as u(sensor_nodes_id, day)
+      ON (l.sensor_nodes_id = u.sensor_nodes_id AND l.day = u.day)
+    """
+    rows, time_ms = get_database().rows(
+        sql,
+        tag='hashes',
+        nodes=[d[0] for d in days],
+        days=[d[1] for d in days],
+    )
+    for row in rows:
+        if row[5] is not None:
+            export_records[(row[0], row[1])] = row[5]
+        if row[3] is not None:
+            export_hashes[(row[0], row[1])] = tuple(row[2:])
+    return time_ms
+
+
+def previous_hash(day, node, key: str):
+    """
+    The hash of the last file for the location/day if it was written to the same key
+    """
+    prev = export_hashes.pop((node, day), None)
+    if prev is not None and prev[0] == key:
+        return prev[1]
+    return None
+
+
+FINGERPRINT_SQL = """
+    WITH sensors AS (
+      SELECT *
+      FROM unnest(
+        (:sensors_ids)::int[]
+      , (:location_ids)::int[]
+      , (:starts)::timestamptz[]
+      , (:ends)::timestamptz[]
+      ) as s(sensors_id, location_id, starts, ends))
+    SELECT s.location_id
+    , COUNT(1) as n
+    , MAX(m.added_on) as added_on
+    , SUM(hashtextextended(m.sensors_id||':'||m.datetime||':'||m.value, 0)) as checksum
+    FROM public.measurements m
+    JOIN sensors s ON (m.sensors_id = s.sensors_id
+      AND m.datetime > s.starts
+      AND m.datetime <= s.ends)
+    WHERE m.datetime > (:start)::timestamptz
+    AND m.datetime <= (:end)::timestamptz
+    GROUP BY s.location_id
+    """
+
+
+def get_fingerprints(day, sensor_nodes_ids: list):
+    """
+    A cheap summary of the data for each node on the day (count, last
+    added_on and a checksum of the values) along with the metadata and
+    file format. If it has not changed neither has the file
+    """
+    nodes = get_metadata().get(sensor_nodes_ids)
+    args = params(nodes, day)
+    rows, time_ms = get_database().rows(
+        FINGERPRINT_SQL,
+        sensors_ids=args['sensors_ids'],
+        location_ids=[s['sensor_nodes_id'] for node in nodes.values() for s in node.sensors],
+        starts=args['starts'],
+        ends=args['ends'],
+        start=args['start'],
+        end=args['end'],
+        write=False,
+        tag='fingerprint',
+    )
+    found = {row[0]: row[1:] for row in rows}
+    fingerprints = {}
+    for node in sensor_nodes_ids:
+        n, added_on, checksum = found.get(node, (0, None, 0))
+        fingerprints[node] = (
+            f"{n}:{added_on.isoformat() if added_on else ''}:{checksum}"
+            f":{nodes[node].digest}:{FILE_FORMAT_VERSION}:{settings.WRITE_FILE_FORMAT}"
+        )
+    return fingerprints
+
+
+def load_fingerprints(days: list):
+    """
+    Get the fingerprint for each location/day (node, day) that has one
+    from its last export, one query per day. The others can not be
+    skipped so there is no point in scanning their data twice, unless
+    EXPORT_FINGERPRINT_NEW is set so that they can be skipped next time
+    """
+    by_day = {}
+    for row in days:
+        prev = export_hashes.get((row[0], row[1]))
+        if settings.EXPORT_FINGERPRINT_NEW or (prev is not None and prev[2] is not None):
+            by_day.setdefault(row[1], []).append(row[0])
+    for day, nodes in by_day.items():
+        for node, fingerprint in get_fingerprints(day, nodes).items():
+            export_fingerprints[(node, day)] = fingerprint
+
+
+def skip_unchanged(days: list, log: ExportLogBatch = None):
+    """
+    Mark the location/days whose fingerprint matches the last export
+    as exported without fetching anything. Returns the rest
+    """
+    export_fingerprints.clear()
+    if not settings.EXPORT_FINGERPRINT or len(days) == 0:
+        return days
+    load_fingerprints(days)
+    remaining = []
+    for row in days:
+        node, day = row[0], row[1]
+        prev = export_hashes.get((node, day))
+        fingerprint = export_fingerprints.get((node, day))
+        if prev is None or prev[2] is None or prev[2] != fingerprint:
+            remaining.append(row)
+            continue
+        key, digest, fingerprint, records = prev
+        export_hashes.pop((node, day))
+        export_fingerprints.pop((node, day))
+        write_stats.add(True, 0)
+        metadata = {'hash': digest, 'fingerprint': fingerprint, 'skipped': True, 'unchanged': True}
+        if log is not None:
+            log.append(day, node, records, 0, key, FILE_FORMAT_VERSION, metadata=metadata)
+        else:
+            bucket, fpath = split_key(key, settings.WRITE_FILE_FORMAT)
+            update_export_log(day, node, records, 0, bucket, fpath, metadata)
+    logger.debug(f'{len(days) - len(remaining)} location/days have not changed')
+    return remaining
 
 
 def get_measurement_data_n(
         sensor_nodes_id: int,
         day: Union[str, datetime.date],
+        response_format: str = settings.EXPORT_RESPONSE_FORMAT,
 ):
     """
     Pull all measurement data for one site and day.
@@ -660,69 +1224,108 @@ def get_measurement_data_n(
     and units is appended to the measurand to ensure that
     there will be no duplicate columns when we convert to long format
     """
-    # db = get_database()
     if isinstance(day, str):
         day = datetime.fromisoformat(day).date()
 
     # Start by getting the sensor node data
+    nodes = get_metadata().get([sensor_nodes_id])
     db = get_database()
 
-    sql = f"""
-    WITH sensors AS (
-      SELECT sensors_id
-      , s.source_id as sensor
-      , sn.site_name||'-'||sy.sensor_systems_id as location
-      , s.measurands_id
-      , p.measurand
-      , p.units
-      , sn.sensor_nodes_id
-      , st_x(geom) as lon
-      , st_y(geom) as lat
-      , sn.ismobile
-      , z.tzid as tz
-      FROM sensors s
-      JOIN measurands p ON (s.measurands_id = p.measurands_id)
-      JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
-      JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
-	  JOIN timezones z ON (sn.timezones_id = z.gid)
-      WHERE sn.sensor_nodes_id = :sensor_nodes_id)
-    SELECT s.sensor_nodes_id as location_id
-    , s.location
-    , s.sensors_id
-    , s.measurands_id
-    , format_timestamp(m.datetime, tz) as datetime
-    , s.measurand as parameter
-    , s.units
-    , m.value
-    , CASE WHEN s.ismobile
-      THEN m.lon
-      ELSE s.lon
-      END as lon
-    , CASE WHEN s.ismobile
-      THEN m.lat
-      ELSE s.lat
-      END as lat
-      FROM public.measurements m
-    JOIN sensors s ON (m.sensors_id = s.sensors_id)
-    AND datetime > timezone(tz, (:day1)::timestamp)
-    AND datetime <= timezone(tz, :day2 + '1day'::interval)
-    """
-
     logger.debug(
         f'Getting measurement data for {sensor_nodes_id} for {day}'
     )
 
     rows, time_ms = db.rows(
-        sql,
-        day1=day,
-        day2=day,
-        sensor_nodes_id=sensor_nodes_id,
-        response_format='DataFrame'
+        MEASUREMENT_DATA_SQL,
+        **params(nodes, day),
+        response_format='Arrow',
+        write=False,
+        tag='fetch',
     )
+    rows = attach(rows, nodes)
+    if response_format == 'DataFrame':
+        rows = rows.to_pandas()
 
     return rows, time_ms
 
 
+def get_measurement_data_batch(
+        sensor_nodes_ids: list,
+        day: Union[str, datetime.date],
+        budget: int = settings.EXPORT_BATCH_ROW_BUDGET,
+):
+    """
+    Pull the measurement data for a set of nodes for the same local day
+    in one query. Returns None if there are more than `budget` rows
+    so that the caller can split the set up. The rows come down through
+    a server side cursor so we stop pulling them as soon as we are over
+    """
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day).date()
+
+    nodes = get_metadata().get(sensor_nodes_ids)
+    start = time.time()
+    chunks = get_database().stream(
+        MEASUREMENT_BATCH_SQL,
+        write=False,
+        tag='fetch-batch',
+        response_format='Arrow',
+        **params(nodes, day),
+        budget=budget + 1,
+    )
+    tables = []
+    n = 0
+    try:
+        for chunk in chunks:
+            n += len(chunk)
+            if n > budget:
+                logger.debug(f'Batch of {len(sensor_nodes_ids)} nodes is over the row budget')
+                return None, round((time.time() - start)*1000)
+            tables.append(chunk)
+    finally:
+        # closes the cursor if we stopped early
+        chunks.close()
+    time_ms = round((time.time() - start)*1000)
+    if len(tables) == 0:
+        tables.append(pa.schema(MEASUREMENT_FIELDS).empty_table())
+    rows = pa.concat_tables(tables)
+    return attach(rows, nodes), time_ms
+
+
+def get_measurement_data_stream(
+        sensor_nodes_id: int,
+        day: Union[str, datetime.date],
+        chunk_size: int = None,
+):
+    """
+    Same as get_measurement_data_n but yields the data in chunks
+    """
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day).date()
+
+    nodes = get_metadata().get([sensor_nodes_id])
+    for chunk in get_database().stream(
+        MEASUREMENT_DATA_SQL,
+        chunk_size=chunk_size,
+        write=False,
+        tag='fetch-stream',
+        response_format='Arrow',
+        **params(nodes, day),
+    ):
+        yield attach(chunk, nodes)
+
+
+def split_nodes(rows: pa.Table, sensor_nodes_ids: list):
+    """
+    Split the batch results into one table per node
+    """
+    location_ids = rows.column('location_id')
+    return {
+        node: rows.filter(pacompute.equal(location_ids, node))
+        for node in sensor_nodes_ids
+    }
+
+
 def get_measurement_data(
         sensor_nodes_id: int,
         day: Union[str, datetime.date],
@@ -736,9 +1339,10 @@ def get_measurement_data(
     if isinstance(day, str):
         day = datetime.fromisoformat(day).date()
 
+    start, end = get_metadata().get([sensor_nodes_id])[sensor_nodes_id].window(day)
     where = {
-        'day1': day,
-        'day2': day,
+        'start': start,
+        'end': end,
         'sensor_nodes_id': f"{sensor_nodes_id}",
     }
 
@@ -761,14 +1365,14 @@ def get_measurement_data(
     , provider
     FROM measurement_data_export
     WHERE sensor_nodes_id = :sensor_nodes_id
-    AND datetime > timezone(tz, (:day1)::timestamp)
-    AND datetime <= timezone(tz, :day2 + '1day'::interval)
+    AND datetime > (:start)::timestamptz
+    AND datetime <= (:end)::timestamptz
     """
     db = get_database()
     logger.debug(
         f'Getting measurement data for {sensor_nodes_id} for {day}'
     )
-    rows, time_ms = db.rows(sql, **where, response_format='DataFrame')
+    rows, time_ms = db.rows(sql, **where, response_format='DataFrame', write=False, tag='fetch')
     logger.info(
         "get_measurement_data: node: %s, day: %s, seconds: %0.4f, results: %s",
         sensor_nodes_id,
@@ -779,11 +1383,37 @@ def get_measurement_data(
     return rows
 
 
-def reshape(rows: Union[DataFrame, dict], fields: list = []):
+def get_measurement_csv(
+        sensor_nodes_id: int,
+        day: Union[str, datetime.date],
+):
+    """
+    Yield the csv rows for one site and day as postgres writes them,
+    with the line endings changed to match the other writers
+    """
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day).date()
+
+    nodes = get_metadata().get([sensor_nodes_id])
+    for data in get_database().copy(
+        MEASUREMENT_COPY_SQL,
+        options=MEASUREMENT_COPY_OPTIONS,
+        write=False,
+        tag='fetch-copy',
+        **copy_params(nodes, day),
+    ):
+        # each chunk is one row
+        yield bytes(data).replace(b"\n", b"\r\n")
+
+
+def reshape(rows: Union[DataFrame, pa.Table, dict], fields: list = []):
     """
     Create a wide format dataframe from either records or a json/dict object
     from the database
     """
+    if isinstance(rows, pa.Table):
+        # select does not copy the data
+        return rows.select(fields)
     if len(rows) > 0:
         rows = rows[fields]
     return rows
@@ -795,30 +1425,54 @@ def write_file(
         bucket: str = settings.OPEN_DATA_BUCKET,
         ext: str = settings.WRITE_FILE_FORMAT,
         location: str = settings.WRITE_FILE_LOCATION,
-        public: bool = True
+        public: bool = True,
+        previous_hash: str = None,
 ):
     """
-    write the results in the given format
+    write the results in the given format. Returns the path, the time
+    it took and the compression stats. Nothing is written to s3 if the
+    content hash matches `previous_hash`. When EXPORT_SERIALIZE_PROCESSES
+    is set the file is serialized in the process pool (see serialize.py)
+    and only the upload happens here
     """
     start = time.time()
+    stats = {}
+    serializer = get_serializer()
 
-    if ext == 'csv':
+    if serializer is not None and ext != 'json':
+        # the cpu heavy part goes to another process
+        mode = 'wb'
+        body, stats = serializer.serialize(tbl, ext)
+    elif isinstance(tbl, pa.Table):
+        with StreamWriter(s3, filepath, ext, bucket, location, public, previous_hash=previous_hash) as writer:
+            writer.write(tbl)
+        return writer.filepath, round(writer.ms*1000), writer.stats()
+    elif ext == 'csv':
         out = StringIO()
         mode = 'w'
         tbl.to_csv(out, index=False, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\r\n")
-    elif ext == 'csv.gz':
-        out = BytesIO()
+        body = out.getvalue()
+    elif ext in CSV_FORMATS:
+        out = StringIO()
         mode = 'wb'
-        tbl.to_csv(out, index=False, compression="gzip", quoting=csv.QUOTE_NONNUMERIC, lineterminator="\r\n")
+        tbl.to_csv(out, index=False, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\r\n")
+        codec = compressor(ext)
+        body = codec.compress(out.getvalue().encode()) + codec.flush()
+        stats = codec.stats()
     elif ext == 'parquet':
-        out = BytesIO()
+        out = pa.BufferOutputStream()
         mode = 'wb'
-        tbl.to_parquet(out, index=False)
+        write_parquet(tbl, out)
+        body = out.getvalue().to_pybytes()
     elif ext == 'json':
         raise Exception("We are not supporting JSON yet")
     else:
         raise Exception(f"We are not supporting {ext}")
 
+    data = body.encode() if isinstance(body, str) else body
+    digest = content_hash()
+    digest.update(data)
+    skipped = False
     if (
         location == 's3'
         and bucket is not None
@@ -828,82 +1482,320 @@ def write_file(
             f"writing file to: {bucket}/{filepath}.{ext}"
         )
         filepath = f"{filepath}.{ext}"
-        s3.put_object(
-            Bucket=bucket,
-            Key=filepath,
-            ACL='public-read' if public else 'private',
-            Body=out.getvalue()
-        )
+        skipped = previous_hash == digest.hexdigest()
+        if not skipped:
+            s3.put_object(
+                Bucket=bucket,
+                Key=filepath,
+                ACL='public-read' if public else 'private',
+                Body=body
+            )
     elif location == 'local':
         filepath = os.path.join(settings.LOCAL_SAVE_DIRECTORY, filepath)
         os.makedirs(os.path.dirname(filepath), exist_ok=True)
         logger.debug(f"writing file to local file in {filepath}.{ext}")
         txt = open(f"{filepath}.{ext}", mode)
-        txt.write(out.getvalue())
+        txt.write(body)
         txt.close()
     else:
         raise Exception(
             f"{settings.WRITE_FILE_LOCATION} is not a valid location"
         )
 
+    write_stats.add(skipped, len(data))
+    stats.update({'hash': digest.hexdigest(), 'skipped': skipped})
     ms = time.time() - start
-    return filepath, round(ms*1000)
-
-
-def export_data(day, node):
+    return filepath, round(ms*1000), stats
 
-    if isinstance(day, str):
-        day = datetime.fromisoformat(day).date()
 
+def export_filepath(day, node, ext: str = settings.WRITE_FILE_FORMAT):
+    """
+    Where the file for a location/day goes, without the extension
+    """
     yr = day.strftime('%Y')
     mn = day.strftime('%m')
     dy = day.strftime('%d')
+    return f"records/{ext}/locationid={node}/year={yr}/month={mn}/location-{node}-{yr}{mn}{dy}"
+
+
+def csv_copy():
+    """
+    Whether postgres writes the csv for us (EXPORT_CSV_COPY)
+    """
+    return settings.EXPORT_CSV_COPY and settings.WRITE_FILE_FORMAT in CSV_FORMATS
+
+
+def export_data(day, node, log: ExportLogBatch = None):
+
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day).date()
 
     try:
+        if csv_copy():
+            # let postgres write the file
+            return export_copy(day, node, log)
+        if settings.EXPORT_RESPONSE_FORMAT == 'Arrow' and get_serializer() is None:
+            # pull down and write out one chunk at a time
+            return export_stream(day, node, log)
 		# using the statement version and not the view
         rows, get_ms = get_measurement_data_n(
             sensor_nodes_id=node,
             day=day,
         )
+        return export_rows(day, node, rows, get_ms, log)
+    except DeadlineExceeded:
+        # not an error, it goes back to the queue
+        raise
+    except Exception as e:
+        controller.failed(e)
+        submit_error(day, node, str(e))
 
-        if len(rows) > 0:
-            df = reshape(
-                rows,
-                fields=[
-                    "location_id",
-                    "sensors_id",
-                    "location",
-                    "datetime",
-                    "lat",
-                    "lon",
-                    "parameter",
-                    "units",
-                    "value"
-                ]
-            )
-            bucket = settings.OPEN_DATA_BUCKET
-            filepath = f"records/{settings.WRITE_FILE_FORMAT}/locationid={node}/year={yr}/month={mn}/location-{node}-{yr}{mn}{dy}"
-            fpath, write_ms = write_file(df, filepath)
+
+def export_rows(day, node, rows, get_ms: int, log: ExportLogBatch = None):
+    """
+    Write the data for one location/day and mark it as exported
+    """
+    check_deadline()
+    if len(rows) > 0:
+        df = reshape(
+            rows,
+            fields=EXPORT_FIELDS
+        )
+        bucket = settings.OPEN_DATA_BUCKET
+        filepath = export_filepath(day, node)
+        fpath, write_ms, stats = write_file(
+            df,
+            filepath,
+            previous_hash=previous_hash(day, node, f"s3://{bucket}/{filepath}.{settings.WRITE_FILE_FORMAT}"),
+        )
+        # what we were holding at once, a table is streamed out a part at a time
+        if isinstance(df, pa.Table) and get_serializer() is None:
+            observe(nbytes(rows), settings.WRITE_PART_SIZE)
         else:
-            fpath = None
-            bucket = None
-            write_ms = 0
+            observe(nbytes(rows), nbytes(df), stats.get('raw_bytes', 0), stats.get('bytes', 0))
+    else:
+        fpath = None
+        bucket = None
+        write_ms = 0
+        stats = None
 
-        res, update_ms = update_export_log(day, node, len(rows), round((get_ms + write_ms)), bucket, f"{fpath}")
+    return log_export(day, node, len(rows), get_ms, write_ms, bucket, fpath, log, stats)
 
-        logger.debug(
-            "export_data: location: %s, day: %s; %s rows; get: %s, write: %s, log: %s",
-            node, f"{yr}-{mn}-{dy}", len(rows), get_ms, write_ms, update_ms
+
+def export_stream(day, node, log: ExportLogBatch = None):
+    """
+    Write the data for one location/day as it comes out of the database
+    so that a large location/day does not have to fit in memory
+    """
+    chunks = (
+        reshape(chunk, fields=EXPORT_FIELDS)
+        for chunk in get_measurement_data_stream(node, day)
+    )
+    return export_chunks(day, node, chunks, log)
+
+
+def export_copy(day, node, log: ExportLogBatch = None):
+    """
+    Same as export_stream but the csv comes straight from postgres
+    and never goes through pandas or arrow
+    """
+    return export_chunks(day, node, get_measurement_csv(node, day), log, header=CSV_HEADER)
+
+
+def export_chunks(day, node, chunks, log: ExportLogBatch = None, header: bytes = None):
+    """
+    Write out arrow tables or csv rows (bytes) as they come in. No file
+    is written if there are no chunks
+    """
+    start = time.time()
+    writer = None
+    try:
+        for chunk in chunks:
+            check_deadline()
+            if writer is None:
+                filepath = export_filepath(day, node)
+                writer = StreamWriter(
+                    s3,
+                    filepath,
+                    previous_hash=previous_hash(day, node, f"s3://{settings.OPEN_DATA_BUCKET}/{filepath}.{settings.WRITE_FILE_FORMAT}"),
+                )
+                if header is not None:
+                    writer.write_bytes(header)
+            if isinstance(chunk, bytes):
+                writer.write_bytes(chunk, rows=1)
+            else:
+                writer.write(chunk)
+            observe(nbytes(chunk), writer.held())
+        if writer is not None:
+            writer.close()
+    except Exception:
+        if writer is not None:
+            writer.abort()
+        raise
+
+    if writer is not None:
+        write_ms = round(writer.ms*1000)
+        n = writer.rows
+        bucket = settings.OPEN_DATA_BUCKET
+        fpath = writer.filepath
+        stats = writer.stats()
+    else:
+        write_ms = 0
+        n = 0
+        bucket = None
+        fpath = None
+        stats = None
+    get_ms = round((time.time() - start)*1000) - write_ms
+    return log_export(day, node, n, get_ms, write_ms, bucket, fpath, log, stats)
+
+
+def log_export(
+        day,
+        node,
+        n: int,
+        get_ms: int,
+        write_ms: int,
+        bucket,
+        fpath,
+        log: ExportLogBatch = None,
+        metadata: dict = None,
+):
+    """
+    Mark the location/day as exported. The metadata (e.g. the
+    compression stats) is stored with the log entry
+    """
+    fingerprint = export_fingerprints.pop((node, day), None)
+    if fingerprint is not None:
+        metadata = {**(metadata or {}), 'fingerprint': fingerprint}
+    # so that the memory estimate can be worked out from the log
+    if n > 0 and (peak := node_peak(n)) is not None:
+        metadata = {**(metadata or {}), 'peak_bytes': peak}
+    deadline.finish(node, day)
+    if log is not None:
+        update_ms = log.append(
+            day,
+            node,
+            n,
+            round((get_ms + write_ms)),
+            f"s3://{bucket}/{fpath}",
+            FILE_FORMAT_VERSION,
+            metadata=metadata,
         )
-        return len(rows), get_ms, write_ms, update_ms
+    else:
+        res, update_ms = update_export_log(day, node, n, round((get_ms + write_ms)), bucket, f"{fpath}", metadata)
+
+    logger.debug(
+        "export_data: location: %s, day: %s; %s rows; get: %s, write: %s, log: %s",
+        node, day, n, get_ms, write_ms, update_ms
+    )
+    return n, get_ms, write_ms, update_ms
+
+
+def export_batch(day, nodes: list, log: ExportLogBatch = None):
+    """
+    Export a set of nodes for the same day using one query. If the
+    set is over the row budget it is split in half and tried again
+    and a single node is always exported on its own. When postgres
+    writes the csv (EXPORT_CSV_COPY) each node is copied out on its own
+    """
+    if isinstance(day, str):
+        day = datetime.fromisoformat(day).date()
+
+    if len(nodes) == 1 or csv_copy():
+        return [export_data_mp((node, day), log) for node in nodes]
+
+    try:
+        rows, get_ms = get_measurement_data_batch(nodes, day)
     except Exception as e:
-        submit_error(day, node, str(e))
+        controller.failed(e)
+        logger.warning(f"Batch fetch failed for {len(nodes)} nodes on {day}: {e}")
+        return [export_data_mp((node, day), log) for node in nodes]
+
+    if rows is None:
+        half = len(nodes)//2
+        return export_batch(day, nodes[:half], log) + export_batch(day, nodes[half:], log)
+
+    # the whole batch stays in memory until the last node is written
+    hold(nbytes(rows), len(rows))
+    results = []
+    # spread the query time over the nodes
+    node_ms = round(get_ms/len(nodes))
+    for node, node_rows in split_nodes(rows, nodes).items():
+        try:
+            results.append(export_rows(day, node, node_rows, node_ms, log))
+        except DeadlineExceeded:
+            raise
+        except Exception as e:
+            controller.failed(e)
+            submit_error(day, node, str(e))
+            results.append((-1, 0, 0, 0))
+    return results
+
+
+def batch_pending(days: list, size: int = settings.EXPORT_BATCH_NODES):
+    """
+    Group the pending location/days by day and then into sets of `size`
+    """
+    nodes = {}
+    for row in days:
+        nodes.setdefault(row[1], []).append(row[0])
+    batches = []
+    for day, ids in nodes.items():
+        for i in range(0, len(ids), size):
+            batches.append((day, ids[i:i + size]))
+    return batches
+
+
+def schedule_pending(days: list, size: int = settings.EXPORT_BATCH_NODES):
+    """
+    Group the pending location/days into (day, nodes, records) jobs,
+    largest first by the records we expect, so that a big location/day
+    does not start last and hold up the whole run. Anything over
+    EXPORT_LARGE_RECORDS gets a job of its own. Also returns the jobs
+    in the order they were claimed so that we can compare the two
+    """
+    size = max(size, 1)
+    known = [export_records[(row[0], row[1])] for row in days if (row[0], row[1]) in export_records]
+    # the average for anything we have not seen before
+    default = sum(known)/len(known) if len(known) > 0 else 0
+
+    def records(row):
+        return export_records.get((row[0], row[1]), default)
+
+    def jobs(rows):
+        out = []
+        for day, nodes in batch_pending(rows, size):
+            out.append((day, nodes, sum([records((node, day)) for node in nodes])))
+        return out
+
+    claimed = jobs(days)
+    if not settings.EXPORT_LARGEST_FIRST:
+        return claimed, claimed
+    large = [row for row in days if records(row) > settings.EXPORT_LARGE_RECORDS]
+    small = [row for row in days if records(row) <= settings.EXPORT_LARGE_RECORDS]
+    # sorted first so that the batches are made of similar sizes
+    scheduled = [(row[1], [row[0]], records(row)) for row in large]
+    scheduled += jobs(sorted(small, key=records, reverse=True))
+    scheduled.sort(key=lambda j: j[2], reverse=True)
+    return scheduled, claimed
+
+
+def makespan(costs: list, workers: int):
+    """
+    When the last job would finish if each one, in order, goes to the
+    first free worker
+    """
+    free = [0]*max(workers, 1)
+    for cost in costs:
+        heapq.heapreplace(free, free[0] + cost)
+    return max(free)
 
-def export_data_mp(p):
+
+def export_data_mp(p, log: ExportLogBatch = None):
     logger.debug(f"Starting {p[0]}/{p[1]} on pid: {os.getpid()}")
     try:
-        n, get_ms, write_ms, update_ms = export_data(p[1], p[0])
-    except Exception as e:
+        n, get_ms, write_ms, update_ms = export_data(p[1], p[0], log)
+    except Exception:
         n = -1
         get_ms = 0
         write_ms = 0
@@ -911,37 +1803,165 @@ def export_data_mp(p):
 
     return n, get_ms, write_ms, update_ms
 
-def export_pending(limit=settings.LIMIT):
+
+def export_job(day, nodes: list, log: ExportLogBatch = None, records: float = 0):
+    """
+    Export a batch once it fits in the memory budget, unless we are
+    out of time by then, in which case it is left for release_claims
+    """
+    with memory_budget.job(records):
+        if not deadline.can_start():
+            return []
+        with deadline.job():
+            return export_batch(day, nodes, log)
+
+
+def export_pending(limit=None, context=None):
     """
     Only export the location/days that are marked for export. Location days
-    will be limited to the value in the LIMIT environmental parameter
+    will be limited to the value in the LIMIT environmental parameter, or
+    with EXPORT_AUTO_LIMIT to what we expect to finish in the time left.
+    With a lambda context we stop starting new jobs before we run out of
+    time and put whatever we did not get to back in the queue
     """
     start = time.time()
+    deadline.reset(context)
+    get_database().reset_stats()
+    get_metadata().reset_stats()
+    estimate = None
+    if limit is None and settings.EXPORT_AUTO_LIMIT:
+        # the concurrency that the last (warm) run ended with
+        limit, estimate = claim_limit(controller.limit)
+    elif limit is None:
+        limit = settings.LIMIT
     days, query_ms = get_pending_location_days(limit)
+    # load the metadata for everything we are about to export in one go
+    get_metadata().get(list({row[0] for row in days}))
+    cache = get_metadata().stats()
+    # and what we wrote last time so that unchanged files can be skipped
+    write_stats.reset()
+    export_hashes.clear()
+    export_records.clear()
+    load_export_hashes(days)
+    if get_serializer() is not None:
+        get_serializer().reset_stats()
+    # collect the export log updates and write them in batches
+    log = None
+    if settings.EXPORT_LOG_BATCH_SIZE > 1:
+        log = ExportLogBatch(get_database())
+    # nothing to do for the location/days that have not changed
+    claimed = len(days)
+    days = skip_unchanged(days, log)
+    unchanged = claimed - len(days)
+
+    heartbeat = None
+    if settings.EXPORT_LEASES:
+        # hold on to what we have not finished yet
+        heartbeat = get_leases().heartbeat(lambda: deadline.unfinished(days)).start()
+
+    # pull down many nodes in one query and write them one by one,
+    # starting with the largest
+    scheduled, claimed_order = schedule_pending(days)
+    workers = controller.limit
+    planned = {
+        'scheduled': makespan([j[2] for j in scheduled], workers),
+        'claimed': makespan([j[2] for j in claimed_order], workers),
+    }
 
-    with ThreadPoolExecutor(max_workers=max_processes) as exe:
-        jobs = []
-        for row in days:
-            jobs.append(exe.submit(export_data_mp, row))
-
-        count = 0
-        getting_ms = 0
-        writing_ms = 0
-        updating_ms = 0
-        for job in as_completed(jobs):
-            n, get_ms, write_ms, update_ms = job.result()
-            count += int(n >= 0)
-            getting_ms += get_ms
-            writing_ms += write_ms
-            updating_ms += update_ms
-
+    controller.reset()
+    memory_budget.reset()
+    if estimate is not None and estimate['exports'] >= settings.EXPORT_ESTIMATE_MIN_ROWS:
+        memory_budget.calibrate(estimate['record_bytes'])
+    # not a with block, we do not want to wait on a job that is stuck
+    exe = ThreadPoolExecutor(max_workers=controller.maximum)
+    jobs = {}
+    for day, nodes, records in scheduled:
+        jobs[exe.submit(controller.run, export_job, day, nodes, log, records)] = [(node, day) for node in nodes]
+
+    results = []
+    stuck = []
+    try:
+        for job in as_completed(jobs, timeout=deadline.remaining()):
+            results += job_results(job)
+    except FutureTimeout:
+        logger.warning(f'Out of time with {len([j for j in jobs if not j.done()])} jobs still running')
+        exe.shutdown(wait=False, cancel_futures=True)
+        # they have run out of time as well so they should stop quickly,
+        # the rest of the buffer is for the log and the release
+        late, stuck = finish_running(jobs, settings.EXPORT_DEADLINE_BUFFER/2)
+        results += late
+        if len(stuck) > 0:
+            logger.warning(f'{len(stuck)} jobs are stuck, their location/days will not be logged')
+    finally:
+        exe.shutdown(wait=False, cancel_futures=True)
+
+    count = 0
+    getting_ms = 0
+    writing_ms = 0
+    updating_ms = 0
+    for n, get_ms, write_ms, update_ms in results:
+        count += int(n >= 0)
+        getting_ms += get_ms
+        writing_ms += write_ms
+        updating_ms += update_ms
+
+    if log is not None:
+        updating_ms += log.flush()
+        logger.debug(f'Export log batches: {log.stats()}')
+
+    # anything we did not get to can be claimed again by the next run
+    if heartbeat is not None:
+        heartbeat.stop()
+    released = release_claims(abandoned(jobs, deadline.unfinished(days)))
+
+    # the unchanged ones were marked as exported as well
+    count += unchanged
     sec = round(time.time() - start)
-    total_ms = getting_ms + writing_ms + updating_ms
+    total_ms = max(getting_ms + writing_ms + updating_ms, 1)
     getting_pct = round(getting_ms/(total_ms/100))
     writing_pct = round(writing_ms/(total_ms/100))
     updating_pct = round(updating_ms/(total_ms/100))
-    rate_ms = round((sec*1000)/count)
-    logger.info(f'Exported {count} (of {len(days)}) in {sec} seconds ({getting_pct}/{writing_pct}/{updating_pct}, rate: {rate_ms}, query: {query_ms}, processes: {max_processes})')
+    rate_ms = round((sec*1000)/max(count, 1))
+    pool = get_database().pool_stats()
+    queries = get_database().query_stats()
+    writes = write_stats.snapshot()
+    concurrency = controller.stats()
+    logger.info(f'Exported {count} (of {claimed}, {unchanged} unchanged, {released} released) in {sec} seconds ({getting_pct}/{writing_pct}/{updating_pct}, rate: {rate_ms}, query: {query_ms}, concurrency: {concurrency["min"]}-{concurrency["max"]} (now {concurrency["limit"]}, {concurrency["overloads"]} overloads), pool wait: {pool["wait_ms"]}ms/{pool["checkouts"]}, replica/primary reads: {pool["replica_reads"]}/{pool["primary_reads"]}, metadata hit rate: {cache["hit_rate"]} ({cache["hits"]}/{cache["hits"] + cache["misses"]}, invalidated: {cache["invalidated"]}), unchanged files: {writes["skipped"]}/{writes["skipped"] + writes["written"]} ({writes["bytes_saved"]} bytes, {writes["aborted"]} aborted after sending {writes["bytes_aborted"]} bytes), queries: {queries})')
+    logger.info(f'Concurrency trace: {controller.trace_summary()}')
+    logger.info(f'Deadline: {deadline.stats()}')
+    rate = estimate['record_seconds'] if estimate is not None else None
+    logger.info(
+        "Schedule: %s jobs (%s large), makespan %s records%s vs %s in claimed order (%sx), %s workers",
+        len(scheduled),
+        len([j for j in scheduled if len(j[1]) == 1 and j[2] > settings.EXPORT_LARGE_RECORDS]),
+        round(planned['scheduled']),
+        f" (~{round(planned['scheduled']*rate)}s)" if rate is not None else '',
+        round(planned['claimed']),
+        round(planned['scheduled']/planned['claimed'], 2) if planned['claimed'] > 0 else None,
+        workers,
+    )
+    memory = memory_budget.stats()
+    logger.info(f'Memory: {memory}')
+    if settings.EXPORT_LEASES:
+        logger.info(f'Leases: {get_leases().stats()}')
+    put_metric('OpenAQ/OpenData', 'PoolWaitTime', pool['avg_wait_ms'], 'Milliseconds')
+    put_metric('OpenAQ/OpenData', 'Concurrency', concurrency['limit'], 'Count')
+    put_metric('OpenAQ/OpenData', 'SkippedWrites', writes['skipped'], 'Count')
+    put_metric('OpenAQ/OpenData', 'ReleasedClaims', released, 'Count')
+    put_metric('OpenAQ/OpenData', 'ClaimLimit', limit, 'Count')
+    put_metric('OpenAQ/OpenData', 'MemoryPeak', memory['process_peak_mb'], 'Megabytes')
+    if estimate is not None and estimate['seconds'] is not None:
+        put_metric('OpenAQ/OpenData', 'SecondsPerLocationDay', estimate['seconds'], 'Seconds')
+    put_metric('OpenAQ/OpenData', 'BytesSaved', writes['bytes_saved'], 'Bytes')
+    put_metric('OpenAQ/OpenData', 'AbortedWrites', writes['aborted'], 'Count')
+    put_metric('OpenAQ/OpenData', 'BytesAborted', writes['bytes_aborted'], 'Bytes')
+    if cache['hit_rate'] is not None:
+        put_metric('OpenAQ/OpenData', 'MetadataHitRate', cache['hit_rate']*100, 'Percent')
+    for tag, stats in queries.items():
+        put_metric('OpenAQ/OpenData', 'QueryTime', stats['p95_ms'], 'Milliseconds', {'Query': tag, 'Statistic': 'p95'})
+    logger.debug(f'Statement cache: {get_database().statement_stats()}')
+    if get_serializer() is not None:
+        logger.debug(f'Serialize pool: {get_serializer().stats()}')
 
     return count
 
@@ -998,7 +2018,7 @@ def update_outdated(event={}, context={}):
 
     start = time.time()
 
-    days = get_outdated_location_days()
+    days, query_ms = get_outdated_location_days()
     logger.info(
         "get_outdated: %s rows; seconds: %0.4f; source: %s",
         len(days),
@@ -1006,20 +2026,32 @@ def update_outdated(event={}, context={}):
         event['source'],
     )
 
+    # most of these will not have changed
+    write_stats.reset()
+    export_hashes.clear()
+    export_records.clear()
+    load_export_hashes(days)
+    claimed = len(days)
+    days = skip_unchanged(days)
+
     for d in days:
         try:
             export_data(d[1], d[0])
         except Exception as e:
             logger.warning(f"Error processing {d[0]}-{d[1]}: {e}")
 
+    writes = write_stats.snapshot()
     logger.info(
-        "update_outdated: %s; seconds: %0.4f; source: %s",
-        len(days),
+        "update_outdated: %s; seconds: %0.4f; source: %s; unchanged: %s (%s aborted); bytes saved: %s",
+        claimed,
         time.time() - start,
         event['source'],
+        writes['skipped'],
+        writes['aborted'],
+        writes['bytes_saved'],
     )
 
-    return len(days)
+    return claimed
 
 
 def export_all():
@@ -1067,14 +2099,14 @@ def handler(event={}, context={}):
         elif event['method'] == 'move':
             return move_objects_handler(args)
         elif event['method'] == 'check':
-            return check_objects(**args)
+            return check_objects(**args, context=context)
         elif event['method'] == 'export':
             if "node" in args.keys():
                 return export_data(**args)
             else:
-                return export_pending(**args)
+                return export_pending(**args, context=context)
     else:
-        return export_pending()
+        return export_pending(context=context)
 
 
 def test():
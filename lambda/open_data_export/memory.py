@@ -0,0 +1,214 @@
+import os
+import time
+import logging
+import resource
+import threading
+
+from open_data_export.config import settings
+from pandas import DataFrame
+import pyarrow as pa
+
+
+logger = logging.getLogger('memory')
+
+# the job running on this thread
+local = threading.local()
+
+
+def nbytes(data):
+    """
+    Roughly how much memory a table/DataFrame/bytes is holding on to
+    """
+    if isinstance(data, (pa.Table, pa.RecordBatch)):
+        return data.nbytes
+    if isinstance(data, DataFrame):
+        return int(data.memory_usage(deep=True).sum())
+    if isinstance(data, (bytes, bytearray, memoryview)):
+        return len(data)
+    return 0
+
+
+def hold(size: int, records: int = 0):
+    """
+    Memory that the job on this thread holds until it is done,
+    e.g. the table for a batch of nodes and the records in it
+    """
+    meter = getattr(local, 'meter', None)
+    if meter is not None:
+        meter.base += size
+        meter.records += records
+        meter.peak = max(meter.peak, meter.base)
+
+
+def observe(*sizes):
+    """
+    Everything the job on this thread is holding right now (on top of
+    what it holds for the whole job). We cannot measure the memory of
+    one thread so the jobs tell us what they have
+    """
+    meter = getattr(local, 'meter', None)
+    if meter is not None:
+        meter.peak = max(meter.peak, meter.base + sum(sizes))
+
+
+def job_peak():
+    """
+    The peak for the job on this thread so far
+    """
+    meter = getattr(local, 'meter', None)
+    return meter.peak if meter is not None else None
+
+
+def node_peak(records: int):
+    """
+    The part of the job peak that goes with a location/day of `records`.
+    A batch holds the rows of all of its nodes so everything over the
+    per job memory is split up by the records of each node, that way the
+    peaks in the export log add up to the job peak again
+    """
+    meter = getattr(local, 'meter', None)
+    if meter is None:
+        return None
+    fixed = settings.EXPORT_MEMORY_PER_JOB
+    total = max(meter.records, records)
+    if total <= 0 or meter.peak <= fixed:
+        return meter.peak
+    return round(fixed + (meter.peak - fixed)*records/total)
+
+
+def process_peak():
+    """
+    The most memory (bytes) this process has used
+    """
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss*1024
+
+
+class Meter:
+    def __init__(self):
+        self.base = 0
+        self.peak = 0
+        self.records = 0
+
+
+class Job:
+    def __init__(self, budget, records: float):
+        self.budget = budget
+        self.records = records
+        self.estimate = budget.estimate(records)
+
+    def __enter__(self):
+        self.budget.acquire(self.estimate)
+        local.meter = Meter()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        meter = local.meter
+        local.meter = None
+        self.budget.release(self.estimate)
+        self.budget.record(self.records, self.estimate, meter.peak)
+        return False
+
+
+class MemoryBudget:
+    """
+    Only start a job while the estimated memory of the running jobs
+    fits in the budget (EXPORT_MEMORY_BUDGET MB, or 60% of the lambda
+    memory). A job is estimated at EXPORT_MEMORY_PER_JOB bytes plus
+    EXPORT_MEMORY_PER_RECORD bytes per record, and the per record value
+    is recalibrated from the peaks that the jobs report. A job is
+    always started if nothing else is running, even if it is over budget.
+
+    The 0.01225 kB/record model in tests/file_test is the size of the
+    csv.gz file, in memory we hold the table, the csv and the compressed
+    file at the same time so it is a lot more than that
+    """
+
+    def __init__(self, budget: int = None):
+        self.budget = budget if budget is not None else default_budget()
+        self.per_record = settings.EXPORT_MEMORY_PER_RECORD
+        self.condition = threading.Condition()
+        self.reset()
+
+    def reset(self):
+        with self.condition:
+            self.used = 0
+            self.running = 0
+            self.high = 0
+            self.jobs = 0
+            self.waits = 0
+            self.wait_seconds = 0
+            self.over = 0
+            self.records = 0
+            self.measured = 0
+
+    def estimate(self, records: float):
+        return settings.EXPORT_MEMORY_PER_JOB + (records or 0)*self.per_record
+
+    def calibrate(self, per_record: float):
+        """
+        Start from a per record value measured elsewhere (e.g. the export log)
+        """
+        if per_record is not None and per_record > 0:
+            self.per_record = per_record
+
+    def job(self, records: float):
+        return Job(self, records)
+
+    def acquire(self, estimate: float):
+        start = time.time()
+        with self.condition:
+            waited = False
+            while (
+                self.budget is not None
+                and self.running > 0
+                and self.used + estimate > self.budget
+            ):
+                waited = True
+                self.condition.wait()
+            self.used += estimate
+            self.running += 1
+            self.high = max(self.high, self.used)
+            if waited:
+                self.waits += 1
+                self.wait_seconds += time.time() - start
+
+    def release(self, estimate: float):
+        with self.condition:
+            self.used -= estimate
+            self.running -= 1
+            self.condition.notify_all()
+
+    def record(self, records: float, estimate: float, peak: int):
+        """
+        Keep the measured peak so that the next estimates are better
+        """
+        with self.condition:
+            self.jobs += 1
+            self.over += int(peak > estimate)
+            if records and peak > 0:
+                self.records += records
+                self.measured += max(peak - settings.EXPORT_MEMORY_PER_JOB, 0)
+                # wait for a few jobs before trusting it
+                if self.jobs >= 5 and self.records > 0:
+                    self.per_record = self.measured/self.records
+
+    def stats(self):
+        return {
+            'budget_mb': round(self.budget/1048576) if self.budget is not None else None,
+            'high_mb': round(self.high/1048576),
+            'jobs': self.jobs,
+            'waits': self.waits,
+            'wait_seconds': round(self.wait_seconds, 1),
+            'over_estimate': self.over,
+            'bytes_per_record': round(self.per_record),
+            'process_peak_mb': round(process_peak()/1048576),
+        }
+
+
+def default_budget():
+    if settings.EXPORT_MEMORY_BUDGET > 0:
+        return settings.EXPORT_MEMORY_BUDGET*1048576
+    lambda_mb = os.environ.get('AWS_LAMBDA_FUNCTION_MEMORY_SIZE')
+    if lambda_mb is not None:
+        return int(int(lambda_mb)*1048576*0.6)
+    return None
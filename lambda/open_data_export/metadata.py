@@ -0,0 +1,342 @@
+import time
+import hashlib
+import logging
+import threading
+
+from open_data_export.config import settings
+from collections import OrderedDict
+from datetime import datetime, date, timedelta, timezone
+from zoneinfo import ZoneInfo
+import pyarrow as pa
+import pyarrow.compute as pacompute
+
+
+logger = logging.getLogger('metadata')
+
+
+SENSOR_ROWS = """
+SELECT sn.sensor_nodes_id
+, s.sensors_id
+, sn.site_name||'-'||sy.sensor_systems_id as location
+, s.measurands_id
+, p.measurand
+, p.units
+, st_x(geom) as lon
+, st_y(geom) as lat
+, sn.ismobile
+, z.tzid as tz
+FROM sensors s
+JOIN measurands p ON (s.measurands_id = p.measurands_id)
+JOIN sensor_systems sy ON (s.sensor_systems_id = sy.sensor_systems_id)
+JOIN sensor_nodes sn ON (sy.sensor_nodes_id = sn.sensor_nodes_id)
+JOIN timezones z ON (sn.timezones_id = z.gid)
+WHERE sn.sensor_nodes_id = ANY(:sensor_nodes_ids)
+"""
+
+# changes when anything we export about the sensors of a node changes,
+# not only when a sensor is added or removed
+MARKER = "hashtextextended(string_agg(m::text, ',' ORDER BY m.sensors_id), 0)"
+
+SENSORS_SQL = f"""
+WITH m AS ({SENSOR_ROWS})
+SELECT m.*
+, v.marker
+FROM m
+JOIN (
+  SELECT sensor_nodes_id, {MARKER} as marker
+  FROM m
+  GROUP BY sensor_nodes_id
+) as v USING (sensor_nodes_id)
+"""
+
+# a cheap way to see if the sensors of a node have changed
+VERSIONS_SQL = f"""
+WITH m AS ({SENSOR_ROWS})
+SELECT sensor_nodes_id
+, COUNT(1) as n
+, MAX(sensors_id) as max_sensors_id
+, {MARKER} as marker
+FROM m
+GROUP BY sensor_nodes_id
+"""
+
+
+def local_midnight(day: date, zone: ZoneInfo):
+    """
+    Midnight on `day` in UTC, resolved the same way postgres does it.
+    A time that happens twice (clocks went back) gets the offset from
+    after the change and a time that never happens (clocks went forward)
+    gets the offset from before the change
+    """
+    dt = datetime.combine(day, datetime.min.time(), tzinfo=zone)
+    later = dt.replace(fold=1)
+    if dt.utcoffset() != later.utcoffset():
+        wall = later.astimezone(timezone.utc).astimezone(zone)
+        if wall.replace(tzinfo=None) == dt.replace(tzinfo=None):
+            dt = later
+    return dt.astimezone(timezone.utc)
+
+
+def utc_window(day: date, tz: str):
+    """
+    The UTC bounds of a local day, which is 23 or 25 hours long
+    when the clocks change
+    """
+    zone = ZoneInfo(tz)
+    return (
+        local_midnight(day, zone),
+        local_midnight(day + timedelta(days=1), zone),
+    )
+
+
+class Node:
+    """
+    The sensor metadata for one node
+    """
+    __slots__ = ('sensors', 'version', 'loaded', 'checked', 'digest')
+
+    def __init__(self, sensors: list, marker: int = None):
+        self.sensors = sensors
+        self.version = (
+            len(sensors),
+            max([s['sensors_id'] for s in sensors], default=None),
+            marker,
+            settings.METADATA_VERSION,
+        )
+        self.loaded = time.time()
+        self.checked = self.loaded
+        # changes when anything that ends up in the file changes
+        self.digest = hashlib.blake2b(repr(sensors).encode(), digest_size=8).hexdigest()
+
+    @property
+    def tz(self):
+        return self.sensors[0]['tz'] if len(self.sensors) > 0 else 'UTC'
+
+    def window(self, day: date):
+        return utc_window(day, self.tz)
+
+
+class MetadataCache:
+    """
+    Sensor metadata by sensor_nodes_id so that the export query
+    only has to scan the measurements. Entries expire after
+    METADATA_CACHE_TTL seconds, the least recently used entries are
+    dropped after METADATA_CACHE_SIZE nodes and an entry is dropped
+    when the sensors for the node change or METADATA_VERSION is changed
+    """
+
+    def __init__(self, db, size: int = None, ttl: float = None):
+        self.db = db
+        self.size = size or settings.METADATA_CACHE_SIZE
+        self.ttl = ttl or settings.METADATA_CACHE_TTL
+        self.nodes = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+        self.invalidated = 0
+
+    def cached(self, node: int):
+        entry = self.nodes.get(node)
+        if entry is None:
+            return None
+        if (
+            time.time() - entry.loaded > self.ttl
+            or entry.version[-1] != settings.METADATA_VERSION
+        ):
+            del self.nodes[node]
+            return None
+        self.nodes.move_to_end(node)
+        return entry
+
+    def get(self, sensor_nodes_ids: list):
+        """
+        Return the metadata for each node, loading whatever we do
+        not have in one query
+        """
+        found = {}
+        stale = []
+        with self.lock:
+            for node in sensor_nodes_ids:
+                entry = self.cached(node)
+                if entry is not None:
+                    found[node] = entry
+                    if time.time() - entry.checked > settings.METADATA_CACHE_CHECK:
+                        stale.append(node)
+
+        if len(stale) > 0:
+            for node in self.validate(stale):
+                found.pop(node, None)
+
+        missing = [n for n in sensor_nodes_ids if n not in found]
+        with self.lock:
+            self.hits += len(found)
+            self.misses += len(missing)
+
+        if len(missing) > 0:
+            found.update(self.load(missing))
+        return found
+
+    def load(self, sensor_nodes_ids: list):
+        rows, ms = self.db.rows(
+            SENSORS_SQL,
+            sensor_nodes_ids=sensor_nodes_ids,
+            write=False,
+            tag='metadata',
+        )
+        sensors = {node: [] for node in sensor_nodes_ids}
+        markers = {}
+        for row in rows:
+            markers[row[0]] = row[10]
+            sensors[row[0]].append({
+                'sensor_nodes_id': row[0],
+                'sensors_id': row[1],
+                'location': row[2],
+                'measurands_id': row[3],
+                'measurand': row[4],
+                'units': row[5],
+                'lon': row[6],
+                'lat': row[7],
+                'ismobile': row[8],
+                'tz': row[9],
+            })
+        nodes = {node: Node(s, markers.get(node)) for node, s in sensors.items()}
+        with self.lock:
+            for node, entry in nodes.items():
+                self.nodes[node] = entry
+                self.nodes.move_to_end(node)
+            while len(self.nodes) > self.size:
+                self.nodes.popitem(last=False)
+        return nodes
+
+    def validate(self, sensor_nodes_ids: list):
+        """
+        Drop any node whose sensors have changed. Returns the dropped nodes
+        """
+        rows, ms = self.db.rows(
+            VERSIONS_SQL,
+            sensor_nodes_ids=sensor_nodes_ids,
+            write=False,
+            tag='metadata-check',
+        )
+        versions = {row[0]: (row[1], row[2], row[3]) for row in rows}
+        dropped = []
+        now = time.time()
+        with self.lock:
+            for node in sensor_nodes_ids:
+                entry = self.nodes.get(node)
+                if entry is None:
+                    continue
+                if versions.get(node, (0, None, None)) != entry.version[:3]:
+                    del self.nodes[node]
+                    dropped.append(node)
+                else:
+                    entry.checked = now
+            self.invalidated += len(dropped)
+        return dropped
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            "size": len(self.nodes),
+            "hits": self.hits,
+            "misses": self.misses,
+            "invalidated": self.invalidated,
+            "hit_rate": round(self.hits/total, 3) if total > 0 else None,
+        }
+
+    def reset_stats(self):
+        with self.lock:
+            self.hits = 0
+            self.misses = 0
+            self.invalidated = 0
+
+
+def params(nodes: dict, day: date):
+    """
+    The sensors, their timezones and their UTC window for the
+    measurement query. The overall window is passed as well so that
+    the database has a constant range to prune with
+    """
+    sensors = []
+    starts = []
+    ends = []
+    tzs = []
+    for node in nodes.values():
+        start, end = node.window(day)
+        for s in node.sensors:
+            sensors.append(s['sensors_id'])
+            tzs.append(s['tz'])
+            starts.append(start)
+            ends.append(end)
+    if len(sensors) == 0:
+        start, end = utc_window(day, 'UTC')
+    else:
+        start, end = min(starts), max(ends)
+    return {
+        'sensors_ids': sensors,
+        'tzs': tzs,
+        'starts': starts,
+        'ends': ends,
+        'start': start,
+        'end': end,
+    }
+
+
+def copy_params(nodes: dict, day: date):
+    """
+    Same as params but with the metadata for each sensor as well
+    so that the database can return the full rows
+    """
+    args = params(nodes, day)
+    sensors = [s for node in nodes.values() for s in node.sensors]
+    args.update({
+        'location_ids': [s['sensor_nodes_id'] for s in sensors],
+        'locations': [s['location'] for s in sensors],
+        'parameters': [s['measurand'] for s in sensors],
+        'units': [s['units'] for s in sensors],
+        'lons': [s['lon'] for s in sensors],
+        'lats': [s['lat'] for s in sensors],
+        'mobile': [s['ismobile'] for s in sensors],
+    })
+    return args
+
+
+def attach(rows: pa.Table, nodes: dict):
+    """
+    Add the sensor metadata to the measurements (sensors_id, datetime,
+    value, lon, lat) and return the columns in the export order
+    """
+    sensors = [s for node in nodes.values() for s in node.sensors]
+    ids = pa.array([s['sensors_id'] for s in sensors], pa.int64())
+    sensors_id = rows.column('sensors_id').combine_chunks()
+    idx = pacompute.index_in(sensors_id.cast(pa.int64()), value_set=ids).cast(pa.int32())
+
+    def take(key, typ):
+        return pa.array([s[key] for s in sensors], typ).take(idx)
+
+    def dictionary(key):
+        # build the dictionary from the sensors instead of encoding each row
+        values = list(dict.fromkeys([s[key] for s in sensors]))
+        codes = [values.index(s[key]) for s in sensors]
+        return pa.DictionaryArray.from_arrays(
+            pa.array(codes, pa.int32()).take(idx),
+            pa.array(values, pa.string()),
+        )
+
+    # a node that is not marked either way uses its own coordinates,
+    # same as the CASE in the sql
+    mobile = pacompute.fill_null(take('ismobile', pa.bool_()), False)
+    lon = pacompute.if_else(mobile, rows.column('lon').combine_chunks(), take('lon', pa.float64()))
+    lat = pacompute.if_else(mobile, rows.column('lat').combine_chunks(), take('lat', pa.float64()))
+    return pa.table({
+        'location_id': take('sensor_nodes_id', pa.int32()),
+        'location': dictionary('location'),
+        'sensors_id': sensors_id,
+        'measurands_id': take('measurands_id', pa.int32()),
+        'datetime': rows.column('datetime').combine_chunks(),
+        'parameter': dictionary('measurand'),
+        'units': dictionary('units'),
+        'value': rows.column('value').combine_chunks(),
+        'lon': lon,
+        'lat': lat,
+    })
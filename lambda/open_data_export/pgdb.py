@@ -1,53 +1,522 @@
+import io
 import psycopg
 import time
 import logging
+import threading
 
 from open_data_export.config import settings
-from buildpg import render
+from open_data_export.deadline import check_deadline, time_left
+from buildpg import render, BuildError
+from buildpg.components import Component
 from pandas import DataFrame
-from psycopg.rows import dict_row
+import pyarrow as pa
+import pyarrow.csv as pacsv
+from psycopg_pool import ConnectionPool
+from contextlib import contextmanager
 import orjson
 import re
-from io import BytesIO
+from collections import OrderedDict
 
 
 logger = logging.getLogger('db')
 
+# postgres type name to the arrow type we want to store it as
+ARROW_TYPES = {
+    'bool': pa.bool_(),
+    'int2': pa.int16(),
+    'int4': pa.int32(),
+    'int8': pa.int64(),
+    'float4': pa.float32(),
+    'float8': pa.float64(),
+    'numeric': pa.float64(),
+    'text': pa.string(),
+    'varchar': pa.string(),
+    'date': pa.date32(),
+    'timestamptz': pa.timestamp('us', tz='UTC'),
+}
+
+# text fields that repeat for every row of a location/day
+DICTIONARY_FIELDS = ('location', 'parameter', 'units')
+
+
+class Param:
+    """
+    Placeholder used to render a query once and record which
+    parameter ends up in which position
+    """
+    __slots__ = ('name',)
+
+    def __init__(self, name: str):
+        self.name = name
+
+
+def arrow_field(name: str, typename: str):
+    """
+    The arrow field for a column given the postgres type name
+    """
+    # anything we dont know about will be written out as text
+    typ = ARROW_TYPES.get(typename, pa.string())
+    if name in DICTIONARY_FIELDS and typ == pa.string():
+        typ = pa.dictionary(pa.int32(), pa.string())
+    return pa.field(name, typ)
+
+
+def arrow_schema(description):
+    """
+    Build an arrow schema from the cursor description
+    """
+    fields = []
+    for desc in description:
+        info = psycopg.postgres.types.get(desc.type_code)
+        fields.append(arrow_field(desc.name, info.name if info else None))
+    return fields
+
+
+def csv_options(fields: list):
+    """
+    How pyarrow should read the csv that postgres writes. An unquoted
+    empty value is a NULL and a quoted one ("") is an empty string
+    """
+    return (
+        pacsv.ReadOptions(column_names=[f.name for f in fields]),
+        pacsv.ConvertOptions(
+            column_types={f.name: f.type for f in fields},
+            null_values=[''],
+            strings_can_be_null=True,
+            quoted_strings_can_be_null=False,
+            true_values=['t'],
+            false_values=['f'],
+        ),
+    )
+
+
+def csv_table(data: bytes, fields: list):
+    """
+    Read all of the csv that postgres wrote into a table
+    """
+    if len(data) == 0:
+        return pa.schema(fields).empty_table()
+    read_options, convert_options = csv_options(fields)
+    tbl = pacsv.read_csv(
+        pa.py_buffer(data),
+        read_options=read_options,
+        convert_options=convert_options,
+    )
+    # each block will have its own dictionary
+    return tbl.unify_dictionaries()
+
+
+def rechunk(batches, size: int):
+    """
+    Regroup record batches into tables of `size` rows, the last one
+    can be smaller. Slicing does not copy the data
+    """
+    held = []
+    n = 0
+    for batch in batches:
+        held.append(batch)
+        n += batch.num_rows
+        while n >= size:
+            tbl = pa.Table.from_batches(held)
+            yield tbl.slice(0, size)
+            rest = tbl.slice(size)
+            held = rest.to_batches()
+            n = rest.num_rows
+    if n > 0:
+        yield pa.Table.from_batches(held)
+
+
+class CopyReader(io.RawIOBase):
+    """
+    A file for pyarrow to read the output of a COPY from. The rows are
+    passed on as they come in and are only held until pyarrow reads them
+    """
+
+    def __init__(self, copy):
+        self.copy = copy
+        self.pending = b''
+        self.done = False
+
+    def readable(self):
+        return True
+
+    def empty(self):
+        if len(self.pending) == 0 and not self.done:
+            self.pending = self.copy.read()
+            self.done = not self.pending
+        return len(self.pending) == 0
+
+    def read(self, size: int = -1):
+        # join the rows once for each block that is asked for
+        parts = [self.pending]
+        n = len(self.pending)
+        while (size is None or size < 0 or n < size) and not self.done:
+            data = self.copy.read()
+            if not data:
+                self.done = True
+                break
+            parts.append(data)
+            n += len(data)
+        data = b''.join(parts)
+        if size is None or size < 0 or len(data) <= size:
+            self.pending = b''
+            return data
+        self.pending = data[size:]
+        return data[:size]
+
+    def readinto(self, buffer):
+        data = self.read(len(buffer))
+        buffer[:len(data)] = data
+        return len(data)
+
+
+# a $n placeholder, or something quoted that we have to step over
+# because a $n inside of it is just text
+PLACEHOLDERS = re.compile(
+    r"'(?:[^']|'')*'"
+    r'|"(?:[^"]|"")*"'
+    r'|\$((?:[A-Za-z_]\w*)?)\$.*?\$\1\$'
+    r'|\$([0-9]+)',
+    re.DOTALL,
+)
+
+
+def positional(rquery: str, args: list):
+    """
+    psycopg3 needs the placeholders to be either %s or %(name)s
+    and render will reuse the same $n for a repeated parameter
+    so we need to repeat the argument for every %s as well
+    """
+    positions = []
+
+    def replace(match):
+        if match.group(2) is None:
+            return match.group(0)
+        positions.append(int(match.group(2)) - 1)
+        return '%s'
+
+    rquery = PLACEHOLDERS.sub(replace, rquery)
+    return rquery, [args[i] for i in positions]
+
+
+class QueryStats:
+    """
+    Latency histogram and row counts for one kind (tag) of query
+    """
+    # upper bounds of the buckets in ms
+    buckets = (5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000)
+
+    def __init__(self):
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.n = 0
+        self.rows = 0
+        self.ms = 0
+        self.max_ms = 0
+
+    def add(self, ms: float, rows: int):
+        i = 0
+        while i < len(self.buckets) and ms > self.buckets[i]:
+            i += 1
+        self.counts[i] += 1
+        self.n += 1
+        self.rows += max(rows, 0)
+        self.ms += ms
+        self.max_ms = max(self.max_ms, ms)
+
+    def percentile(self, pct: float):
+        """
+        The upper bound of the bucket that the percentile falls in
+        """
+        target = self.n * pct / 100
+        total = 0
+        for i, count in enumerate(self.counts):
+            total += count
+            if total >= target and count > 0:
+                return self.buckets[i] if i < len(self.buckets) else round(self.max_ms)
+        return 0
+
+    def snapshot(self):
+        return {
+            "n": self.n,
+            "rows": self.rows,
+            "ms": round(self.ms),
+            "avg_ms": round(self.ms/max(self.n, 1), 1),
+            "p50_ms": self.percentile(50),
+            "p95_ms": self.percentile(95),
+            "max_ms": round(self.max_ms),
+        }
+
 
 class DB:
     response_format = 'Record'
     query_time = 0
+    wait_time = 0
+    checkouts = 0
+    streams = 0
+    replica_reads = 0
+    primary_reads = 0
 
-    def __init__(self, response_format: str = 'Record'):
+    def __init__(
+            self,
+            response_format: str = 'Record',
+            pool_size: int = None,
+    ):
         self.response_format = response_format
+        # the pool should be at least as big as the number of workers
+        # that will be using it or they will just end up waiting
+        self.pool_size = pool_size or settings.DATABASE_POOL_MAX_SIZE
+        self.pools = {}
+        self.statements = OrderedDict()
+        self.statement_hits = 0
+        self.statement_misses = 0
+        self.lag = None
+        self.lag_checked = 0
+        self.tags = {}
+        self.lock = threading.Lock()
+
+    def pool(self, write: bool = True):
+        """
+        Get (or create) the connection pool. The pool lives as long as
+        this object does so keeping the object around between lambda
+        invocations will also keep the connections around
+        """
+        key = 'write' if write else 'read'
+        with self.lock:
+            if key not in self.pools:
+                if write:
+                    cstring = settings.DATABASE_WRITE_URL
+                else:
+                    cstring = settings.DATABASE_READ_URL
+                min_size = min(settings.DATABASE_POOL_MIN_SIZE, self.pool_size)
+                logger.debug(f"Creating {key} pool: {min_size}-{self.pool_size}")
+                self.pools[key] = ConnectionPool(
+                    cstring,
+                    name=f"open-data-{key}",
+                    min_size=min_size,
+                    max_size=self.pool_size,
+                    max_idle=settings.DATABASE_POOL_MAX_IDLE,
+                    timeout=settings.DATABASE_POOL_TIMEOUT,
+                    # make sure that a connection that sat idle between
+                    # invocations is still good before we hand it out
+                    check=ConnectionPool.check_connection,
+                    open=True,
+                )
+            return self.pools[key]
 
-    def get_connection(self, write: bool = True, **kwargs):
+    def replica_lag(self):
+        """
+        How far (in seconds) the read database is behind the primary.
+        This is checked at most every DATABASE_REPLICA_LAG_CHECK seconds
+        and is None if we could not check it
+        """
+        with self.lock:
+            if time.time() - self.lag_checked < settings.DATABASE_REPLICA_LAG_CHECK:
+                return self.lag
+            self.lag_checked = time.time()
+        try:
+            with self.pool(False).connection() as conn:
+                # a replica that has replayed everything it has received
+                # is not behind, even if nothing has been written in a while
+                lag = conn.execute("""
+                SELECT CASE
+                  WHEN NOT pg_is_in_recovery() THEN 0
+                  WHEN pg_last_wal_receive_lsn() = pg_last_wal_replay_lsn() THEN 0
+                  ELSE COALESCE(EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp()), 0)
+                  END
+                """).fetchone()[0]
+                lag = float(lag)
+        except Exception as e:
+            logger.warning(f"Could not check the replica lag: {e}")
+            lag = None
+        with self.lock:
+            self.lag = lag
+        return lag
+
+    def route(self, write: bool = True):
+        """
+        Decide which pool to use. Reads go to the read database unless
+        it is the same as the primary or it has fallen too far behind.
+        Returns True for the write pool
+        """
         if write:
-            cstring = settings.DATABASE_WRITE_URL
-        else:
-            cstring = settings.DATABASE_READ_URL
-        conn = psycopg.connect(cstring, **kwargs)
-        return conn
+            return True
+        if settings.DATABASE_READ_URL == settings.DATABASE_WRITE_URL:
+            return True
+        lag = self.replica_lag()
+        if lag is None or lag > settings.DATABASE_REPLICA_MAX_LAG:
+            logger.debug(f"Reading from the primary, replica lag: {lag}")
+            with self.lock:
+                self.primary_reads += 1
+            return True
+        with self.lock:
+            self.replica_reads += 1
+        return False
+
+    @contextmanager
+    def get_connection(self, write: bool = True):
+        pool = self.pool(self.route(write))
+        start = time.time()
+        with pool.connection() as conn:
+            wait = time.time() - start
+            with self.lock:
+                self.wait_time += wait
+                self.checkouts += 1
+            if wait > settings.DATABASE_POOL_WAIT_WARNING:
+                logger.warning("waited %0.4f seconds for a connection", wait)
+            yield conn
+
+    def pool_stats(self):
+        """
+        Summary of the pool usage, mostly to help us see if the workers
+        are waiting on connections
+        """
+        stats = {
+            "checkouts": self.checkouts,
+            "wait_ms": round(self.wait_time*1000),
+            "avg_wait_ms": round(self.wait_time*1000/max(self.checkouts, 1), 2),
+            "replica_reads": self.replica_reads,
+            "primary_reads": self.primary_reads,
+            "replica_lag": self.lag,
+        }
+        for key, pool in self.pools.items():
+            pstats = pool.get_stats()
+            stats[key] = {
+                "size": pstats.get('pool_size'),
+                "available": pstats.get('pool_available'),
+                "waiting": pstats.get('requests_waiting'),
+                "errors": pstats.get('connections_errors', 0),
+            }
+        return stats
+
+    def statement(self, query: str, params: dict):
+        """
+        Render the query into a psycopg statement and argument list.
+        The rendered statement and the order of the arguments are cached
+        by query text and parameter names so that the same query is only
+        rendered once. Returns the statement, the arguments and the value
+        to pass to psycopg for `prepare`
+        """
+        key = (query, tuple(sorted(params.keys())))
+        with self.lock:
+            entry = self.statements.get(key)
+            if entry is not None:
+                self.statements.move_to_end(key)
+                entry['hits'] += 1
+                self.statement_hits += 1
+
+        if entry is None:
+            if any(isinstance(v, Component) for v in params.values()):
+                # components render sql from their values
+                # so the statement could change with every call
+                rquery, args = render(query, **params)
+                rquery, args = positional(rquery, args)
+                return rquery, args, False
+            try:
+                rquery, args = render(
+                    query,
+                    **{k: Param(k) for k in params.keys()}
+                )
+            except BuildError:
+                # probably using one of the render_ methods
+                rquery, args = render(query, **params)
+                rquery, args = positional(rquery, args)
+                return rquery, args, False
+
+            rquery, args = positional(rquery, args)
+            entry = {
+                'query': rquery,
+                'names': [a.name for a in args],
+                'hits': 0,
+            }
+            with self.lock:
+                self.statement_misses += 1
+                self.statements[key] = entry
+                while len(self.statements) > settings.DATABASE_STATEMENT_CACHE_SIZE:
+                    self.statements.popitem(last=False)
+
+        args = [params[name] for name in entry['names']]
+        # let postgres keep the plan for the queries we keep running
+        # and not waste the prepared slots on ones that we dont
+        threshold = settings.DATABASE_PREPARE_THRESHOLD
+        prepare = threshold is not None and entry['hits'] >= threshold
+        return entry['query'], args, prepare
+
+    def statement_stats(self):
+        return {
+            "size": len(self.statements),
+            "hits": self.statement_hits,
+            "misses": self.statement_misses,
+        }
+
+    def reset_stats(self):
+        with self.lock:
+            self.query_time = 0
+            self.wait_time = 0
+            self.checkouts = 0
+            self.replica_reads = 0
+            self.primary_reads = 0
+            self.tags = {}
+
+    def record(self, tag: str, dur: float, n: int, query: str, args: list):
+        """
+        Keep track of the time and rows for each tag and log anything
+        slower than DATABASE_SLOW_QUERY_MS
+        """
+        ms = dur*1000
+        tag = tag or 'other'
+        with self.lock:
+            self.query_time += dur
+            if tag not in self.tags:
+                self.tags[tag] = QueryStats()
+            self.tags[tag].add(ms, n)
+        if ms > settings.DATABASE_SLOW_QUERY_MS:
+            logger.warning(
+                "slow query (%s): %0.0f ms, %s rows: %s, %s",
+                tag, ms, n, query, args
+            )
+
+    def query_stats(self):
+        """
+        Snapshot of the query stats by tag
+        """
+        with self.lock:
+            return {tag: stats.snapshot() for tag, stats in self.tags.items()}
+
+    def close(self):
+        for pool in self.pools.values():
+            pool.close()
+        self.pools = {}
+
+    def limit(self, conn):
+        """
+        Inside of a job (see deadline.py) a statement can only run for
+        as long as the job has left. The setting only lasts until the
+        connection is committed and given back to the pool
+        """
+        left = time_left()
+        if left is not None:
+            conn.execute(
+                "SELECT set_config('statement_timeout', %s, true)",
+                [str(int(left*1000) + 1)],
+            )
 
     def __query(
             self,
             query: str,
             params: dict,
             method: str = 'rows',
+            write: bool = True,
+            tag: str = None,
     ):
         start = time.time()
-        rquery, args = render(query, **params)
-        # psycopg3 needs the placeholders to be either
-        # %s or %(name)s
-        # and since render will rearrange the arguments
-        # we can get away with this
-        rquery = re.sub(r'\$[0-9]+', '%s', rquery)
+        rquery, args, prepare = self.statement(query, params)
         logger.debug(f"Running query: {rquery}, {args}")
-        with self.get_connection() as conn:
+        with self.get_connection(write) as conn:
             with conn.cursor() as cur:
                 try:
-                    cur.execute(rquery, args)
-                    logger.debug(f"executed query")
+                    self.limit(conn)
+                    cur.execute(rquery, args, prepare=prepare)
+                    logger.debug("executed query")
                     if method == 'row':
                         data = cur.fetchone()
                     elif method == 'value':
@@ -58,24 +527,88 @@ class DB:
                     fields = [desc[0] for desc in cur.description]
                     n = cur.rowcount
                     dur = time.time() - start
-                    self.query_time += dur
+                    self.record(tag, dur, n, rquery, args)
                     logger.debug("query: seconds: %0.4f, results: %s", dur, n)
                     return data, fields, n, round(dur*1000)
                 except Exception as e:
                     logger.warning(f"Query error: {e}")
+                    # a statement that ran out of job time
+                    check_deadline()
                     raise ValueError(f"{e}") from None
                 finally:
                     conn.commit()
 
+    def __describe(self, conn, rquery: str, args: list):
+        """
+        The arrow fields for the columns that the query returns
+        """
+        with conn.cursor() as cur:
+            cur.execute(f"SELECT * FROM (\n{rquery}\n) as q LIMIT 0", args)
+            return arrow_schema(cur.description)
+
+    def __arrow(self, conn, rquery: str, args: list, fields: list):
+        """
+        Yield the results as record batches. Postgres writes the rows
+        as csv (COPY) and pyarrow decodes them a block at a time, so the
+        values never become python objects. Timestamps with a time zone
+        are written in UTC so that pyarrow can read the offsets
+        """
+        if any(pa.types.is_timestamp(f.type) for f in fields):
+            conn.execute("SELECT set_config('TimeZone', 'UTC', true)")
+        read_options, convert_options = csv_options(fields)
+        with conn.cursor() as cur:
+            # the parameters are merged on the client for a copy
+            with cur.copy(f"COPY ({rquery}) TO STDOUT WITH (FORMAT csv)", args) as copy:
+                source = CopyReader(copy)
+                if source.empty():
+                    return
+                yield from pacsv.open_csv(
+                    source,
+                    read_options=read_options,
+                    convert_options=convert_options,
+                )
+
+    def __arrow_table(
+            self,
+            query: str,
+            params: dict,
+            write: bool = True,
+            tag: str = None,
+    ):
+        start = time.time()
+        rquery, args, prepare = self.statement(query, params)
+        logger.debug(f"Running arrow query: {rquery}, {args}")
+        with self.get_connection(write) as conn:
+            try:
+                self.limit(conn)
+                fields = self.__describe(conn, rquery, args)
+                batches = list(self.__arrow(conn, rquery, args, fields))
+            except Exception as e:
+                logger.warning(f"Query error: {e}")
+                # a statement that ran out of job time
+                check_deadline()
+                raise ValueError(f"{e}") from None
+            finally:
+                conn.commit()
+        # each batch will have its own dictionary
+        data = pa.Table.from_batches(batches, schema=pa.schema(fields)).unify_dictionaries()
+        dur = time.time() - start
+        self.record(tag, dur, len(data), rquery, args)
+        return data, round(dur*1000)
+
     def rows(
             self,
             query: str,
             response_format: str = 'default',
+            write: bool = True,
+            tag: str = None,
             **kwargs
     ):
+        if response_format == 'Arrow' or self.response_format == 'Arrow':
+            return self.__arrow_table(query, kwargs, write=write, tag=tag)
         data, fields, n, time_ms = self.__query(
             query,
-            params=kwargs, method='rows'
+            params=kwargs, method='rows', write=write, tag=tag
         )
         if response_format == 'DataFrame' or self.response_format == 'DataFrame':
             data = DataFrame(data, columns=fields)
@@ -85,14 +618,15 @@ class DB:
             self,
             query: str,
             response_format: str = 'default',
+            write: bool = True,
+            tag: str = None,
             **kwargs
     ):
         data, fields, n, time_ms = self.__query(
             query,
-            params=kwargs, method='row'
+            params=kwargs, method='row', write=write, tag=tag
         )
         if response_format == 'DataFrame' or self.response_format == 'DataFrame':
-            print(fields)
             data = DataFrame([data], columns=fields)
         return data, time_ms
 
@@ -100,33 +634,98 @@ class DB:
             self,
             query: str,
             response_format: str = 'default',
+            write: bool = True,
+            tag: str = None,
             **kwargs
     ):
-        data, fields, n, time_ms = self.__query(query, params = kwargs, method='value')
+        data, fields, n, time_ms = self.__query(query, params = kwargs, method='value', write=write, tag=tag)
         if response_format == 'json' or self.response_format == 'json':
             data = orjson.loads(data)
         return data, time_ms
 
-    def stream(
+    def copy(
             self,
             query: str,
-            chunk_size: int = 200,
+            options: str = 'FORMAT csv',
+            write: bool = True,
+            tag: str = None,
             **kwargs
     ):
-        rquery, args = render(query, **kwargs)
-        # psycopg3 needs the placeholders to be either
-        # %s or %(name)s
-        # and since render will rearrange the arguments
-        # we can get away with this
-        rquery = re.sub(r'\$[0-9]+', '%s', rquery)
-        logger.debug(f"Running query: {rquery}, {args}")
-        with self.get_connection(row_factory=dict_row) as conn:
+        """
+        Run the query as COPY (..) TO STDOUT and yield the output, one
+        row at a time, so that postgres does the formatting for us
+        """
+        rquery, args, prepare = self.statement(query, kwargs)
+        logger.debug(f"Running copy: {rquery}, {args}")
+        start = time.time()
+        n = 0
+        with self.get_connection(write) as conn:
             with conn.cursor() as cur:
-                cur.execute(rquery, args)
-                fields = [desc[0] for desc in cur.description]
-                rows = True
-                while rows:
-                    rows = cur.fetchmany(chunk_size)
-                    if rows:
-                        df = DataFrame(rows, columns=fields)
-                        yield df
+                try:
+                    self.limit(conn)
+                    # the parameters are merged on the client for a copy
+                    with cur.copy(f"COPY ({rquery}) TO STDOUT WITH ({options})", args) as copy:
+                        for data in copy:
+                            n += 1
+                            yield data
+                except psycopg.errors.QueryCanceled:
+                    check_deadline()
+                    raise
+                finally:
+                    conn.commit()
+        self.record(tag, time.time() - start, n, rquery, args)
+
+    def stream(
+            self,
+            query: str,
+            chunk_size: int = None,
+            write: bool = True,
+            tag: str = None,
+            response_format: str = 'DataFrame',
+            **kwargs
+    ):
+        """
+        Run the query using a server side (named) cursor and yield the
+        results as DataFrames of at most `chunk_size` rows. Only one chunk
+        is ever pulled down from the database at a time. Arrow tables are
+        read from a COPY instead, which streams as well
+        """
+        if chunk_size is None:
+            chunk_size = settings.DATABASE_STREAM_CHUNK_SIZE
+        rquery, args, prepare = self.statement(query, kwargs)
+        logger.debug(f"Running stream: {rquery}, {args}")
+        start = time.time()
+        n = 0
+        with self.lock:
+            self.streams += 1
+            name = f"open_data_stream_{self.streams}"
+        with self.get_connection(write) as conn:
+            # a named cursor runs as DECLARE .. CURSOR and needs to be
+            # inside of a transaction, which it will be until the
+            # connection is returned to the pool
+            self.limit(conn)
+            if response_format == 'Arrow':
+                try:
+                    fields = self.__describe(conn, rquery, args)
+                    for tbl in rechunk(self.__arrow(conn, rquery, args, fields), chunk_size):
+                        n += len(tbl)
+                        yield tbl
+                except psycopg.errors.QueryCanceled:
+                    check_deadline()
+                    raise
+            else:
+                with conn.cursor(name=name, scrollable=False) as cur:
+                    cur.itersize = chunk_size
+                    try:
+                        cur.execute(rquery, args)
+                        fields = [desc[0] for desc in cur.description]
+                        rows = True
+                        while rows:
+                            rows = cur.fetchmany(chunk_size)
+                            if rows:
+                                n += len(rows)
+                                yield DataFrame(rows, columns=fields)
+                    except psycopg.errors.QueryCanceled:
+                        check_deadline()
+                        raise
+        self.record(tag, time.time() - start, n, rquery, args)
@@ -0,0 +1,149 @@
+import time
+import logging
+import threading
+import multiprocessing
+
+from open_data_export.config import settings
+from open_data_export.writer import write_arrow, parquet_table
+from open_data_export.compression import compressor, Codec, FILE_FORMATS
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+import pyarrow as pa
+
+
+logger = logging.getLogger('serialize')
+
+
+def to_shared(tbl: pa.Table):
+    """
+    Write the table to a block of shared memory as an arrow IPC stream.
+    This is the only copy, the worker reads the columns in place
+    """
+    mock = pa.MockOutputStream()
+    with pa.ipc.new_stream(mock, tbl.schema) as writer:
+        writer.write_table(tbl)
+    size = mock.size()
+    shm = shared_memory.SharedMemory(create=True, size=size)
+    sink = pa.FixedSizeBufferWriter(pa.py_buffer(shm.buf))
+    with pa.ipc.new_stream(sink, tbl.schema) as writer:
+        writer.write_table(tbl)
+    return shm, size
+
+
+def serialize_shared(name: str, size: int, ext: str):
+    """
+    Runs in the worker. Read the table out of shared memory and return
+    the file (bytes) and the compression stats
+    """
+    shm = shared_memory.SharedMemory(name=name)
+    try:
+        tbl = pa.ipc.open_stream(pa.py_buffer(shm.buf)[:size]).read_all()
+        codec = Codec() if ext == 'parquet' else compressor(ext)
+        body = write_arrow(tbl, ext, codec)
+        # the table points at the shared memory and has to go first
+        del tbl
+        return body, codec.stats()
+    finally:
+        shm.close()
+
+
+class SerializePool:
+    """
+    Serialize (and compress) files in a pool of processes so that it is
+    not held up by the GIL. The threads still do all the waiting on the
+    database and s3 and hand the tables over as arrow IPC in shared memory,
+    and only the finished file comes back through a pipe.
+
+    Lambda does not have /dev/shm so this is for the batch hosts, see
+    EXPORT_SERIALIZE_PROCESSES
+    """
+
+    def __init__(self, processes: int = None):
+        self.processes = processes or settings.EXPORT_SERIALIZE_PROCESSES
+        self.executor = None
+        self.lock = threading.Lock()
+        self.reset_stats()
+
+    def start(self):
+        """
+        Start all of the workers. They are forked, so this has to be
+        called before any threads are started (see get_database) or a
+        worker could inherit a lock that one of them was holding
+        """
+        with self.lock:
+            if self.executor is None:
+                if threading.active_count() > 1:
+                    logger.warning(
+                        f"Forking {self.processes} serialize workers with "
+                        f"{threading.active_count() - 1} other threads running"
+                    )
+                # share the parent's tracker, otherwise each worker
+                # starts its own and warns about blocks we have unlinked
+                resource_tracker.ensure_running()
+                self.executor = ProcessPoolExecutor(
+                    max_workers=self.processes,
+                    mp_context=multiprocessing.get_context('fork'),
+                )
+                # the workers are started with the first job
+                self.executor.submit(int).result()
+        return self.executor
+
+    def serialize(self, tbl, ext: str):
+        """
+        Return the file body and the compression stats. A DataFrame
+        is converted to arrow first
+        """
+        if ext not in FILE_FORMATS:
+            raise Exception(f"We are not supporting {ext}")
+        if ext == 'parquet':
+            tbl = parquet_table(tbl)
+        elif not isinstance(tbl, pa.Table):
+            tbl = pa.Table.from_pandas(tbl, preserve_index=False)
+        executor = self.start()
+        start = time.time()
+        shm, size = to_shared(tbl)
+        try:
+            body, stats = executor.submit(serialize_shared, shm.name, size, ext).result()
+        finally:
+            shm.close()
+            shm.unlink()
+        with self.lock:
+            self.jobs += 1
+            self.ipc_bytes += size
+            self.seconds += time.time() - start
+        return body, stats
+
+    def stats(self):
+        return {
+            'processes': self.processes,
+            'jobs': self.jobs,
+            'ipc_bytes': self.ipc_bytes,
+            'avg_ms': round(self.seconds*1000/self.jobs) if self.jobs > 0 else None,
+        }
+
+    def reset_stats(self):
+        self.jobs = 0
+        self.ipc_bytes = 0
+        self.seconds = 0
+
+    def shutdown(self):
+        with self.lock:
+            if self.executor is not None:
+                self.executor.shutdown()
+                self.executor = None
+
+
+serializer = None
+
+
+def get_serializer():
+    """
+    The process pool, or None when EXPORT_SERIALIZE_PROCESSES is 0 and
+    everything is serialized on the export threads
+    """
+    global serializer
+    if settings.EXPORT_SERIALIZE_PROCESSES <= 0:
+        return None
+    if serializer is None:
+        serializer = SerializePool()
+    return serializer
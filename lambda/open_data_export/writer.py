@@ -0,0 +1,533 @@
+import os
+import time
+import hashlib
+import logging
+import tempfile
+import threading
+
+from open_data_export.config import settings
+from open_data_export.compression import compressor, Codec, CSV_FORMATS, FILE_FORMATS
+from concurrent.futures import ThreadPoolExecutor
+import pyarrow as pa
+import pyarrow.compute as pacompute
+import pyarrow.parquet as pq
+
+
+logger = logging.getLogger('writer')
+
+# s3 will not take a part smaller than this (other than the last one)
+MIN_PART_SIZE = 5 * 1024 * 1024
+
+# the exported parquet files, datetime stays a string (with the offset)
+# to match the csv files
+PARQUET_SCHEMA = pa.schema([
+    ('location_id', pa.int64()),
+    ('sensors_id', pa.int64()),
+    ('location', pa.dictionary(pa.int32(), pa.string())),
+    ('datetime', pa.string()),
+    ('lat', pa.float64()),
+    ('lon', pa.float64()),
+    ('parameter', pa.dictionary(pa.int32(), pa.string())),
+    ('units', pa.dictionary(pa.int32(), pa.string())),
+    ('value', pa.float64()),
+])
+
+
+def parquet_table(tbl):
+    """
+    Cast to the export schema, or leave it alone if it is something else
+    """
+    if not isinstance(tbl, pa.Table):
+        tbl = pa.Table.from_pandas(tbl, preserve_index=False)
+    if tbl.schema.names == PARQUET_SCHEMA.names:
+        tbl = tbl.cast(PARQUET_SCHEMA)
+    return tbl
+
+
+def parquet_writer(sink, schema: pa.Schema):
+    """
+    A parquet writer with the settings from config. Every column is
+    dictionary encoded where it helps (the text columns already are
+    dictionaries) and datetime/value get min/max statistics so that
+    readers can skip row groups
+    """
+    return pq.ParquetWriter(
+        sink,
+        schema,
+        compression=settings.PARQUET_COMPRESSION,
+        compression_level=settings.PARQUET_COMPRESSION_LEVEL,
+        use_dictionary=True,
+        write_statistics=[f for f in settings.PARQUET_STATISTICS if f in schema.names] or False,
+        data_page_size=settings.PARQUET_PAGE_SIZE,
+    )
+
+
+def write_parquet(tbl, sink):
+    """
+    Write a whole table in one go
+    """
+    tbl = parquet_table(tbl)
+    with parquet_writer(sink, tbl.schema) as writer:
+        writer.write_table(tbl, row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+
+
+def csv_float(col):
+    """
+    Floats the way python (and so pandas) writes them. Arrow leaves
+    the .0 off of whole numbers and switches to exponents at different
+    sizes, so those few values are formatted in python
+    """
+    text = pacompute.cast(col, pa.string())
+    whole = pacompute.invert(pacompute.match_substring_regex(text, '[.en]'))
+    text = pacompute.if_else(whole, pacompute.binary_join_element_wise(text, '.0', ''), text)
+    size = pacompute.abs(col)
+    odd = pacompute.fill_null(pacompute.or_(
+        pacompute.match_substring(text, 'e'),
+        pacompute.or_(
+            pacompute.and_(pacompute.not_equal(size, 0), pacompute.less(size, 1e-4)),
+            pacompute.greater_equal(size, 1e16),
+        ),
+    ), False)
+    if pacompute.any(odd).as_py():
+        values = text.to_pylist()
+        floats = col.to_pylist()
+        for i in pacompute.indices_nonzero(odd).to_pylist():
+            values[i] = repr(floats[i])
+        text = pa.array(values, pa.string())
+    return text
+
+
+def csv_column(col):
+    """
+    One column as the text that pandas writes with QUOTE_NONNUMERIC,
+    numbers as they are, everything else quoted and missing values
+    (and NaN) as an empty quoted string
+    """
+    if isinstance(col, pa.ChunkedArray):
+        col = col.combine_chunks()
+    if pa.types.is_dictionary(col.type):
+        col = col.dictionary_decode()
+    if pa.types.is_integer(col.type) and col.null_count == 0:
+        return pacompute.cast(col, pa.string())
+    if pa.types.is_integer(col.type) or pa.types.is_floating(col.type):
+        # pandas turns an int column with missing values into floats
+        col = pacompute.cast(col, pa.float64())
+        missing = pacompute.fill_null(pacompute.is_nan(col), True)
+        return pacompute.if_else(missing, '""', csv_float(col))
+    if pa.types.is_boolean(col.type):
+        text = pacompute.if_else(col, 'True', 'False')
+    else:
+        text = pacompute.cast(col, pa.string())
+        text = pacompute.binary_join_element_wise('"', pacompute.replace_substring(text, '"', '""'), '"', '')
+    return pacompute.fill_null(text, '""')
+
+
+def write_csv(tbl: pa.Table, header: bool = True):
+    """
+    The csv for an arrow table, byte for byte what pandas
+    to_csv(quoting=QUOTE_NONNUMERIC, lineterminator="\r\n") writes
+    for the same data
+    """
+    lines = []
+    if header:
+        lines.append(",".join(['"' + name.replace('"', '""') + '"' for name in tbl.column_names]) + "\r\n")
+    if tbl.num_rows > 0:
+        rows = pacompute.binary_join_element_wise(*[csv_column(col) for col in tbl.columns], ',')
+        rows = pacompute.binary_join_element_wise(rows, "\r\n", '')
+        lines.append(pacompute.binary_join(
+            pa.LargeListArray.from_arrays(pa.array([0, len(rows)], pa.int64()), rows.cast(pa.large_string())),
+            pa.scalar('', pa.large_string()),
+        )[0].as_py())
+    return "".join(lines).encode()
+
+
+def write_arrow(tbl: pa.Table, ext: str, codec=None):
+    """
+    Serialize an arrow table without converting it to pandas first.
+    Pass in the codec to get the compression stats back
+    """
+    sink = pa.BufferOutputStream()
+    if ext in CSV_FORMATS:
+        if codec is None:
+            codec = compressor(ext)
+        return codec.compress(write_csv(tbl)) + codec.flush()
+    elif ext == 'parquet':
+        write_parquet(tbl, sink)
+    elif ext == 'json':
+        raise Exception("We are not supporting JSON yet")
+    else:
+        raise Exception(f"We are not supporting {ext}")
+    return sink.getvalue().to_pybytes()
+
+
+def content_hash():
+    """
+    The hash we store with the export log to tell if a file has changed
+    """
+    return hashlib.blake2b(digest_size=16)
+
+
+class WriteStats:
+    """
+    Counts of the files written and skipped (because they had not
+    changed) across all the writers in a run. A skipped file that had
+    already sent parts of a multipart upload is also counted as
+    aborted, and the bytes it sent are not counted as saved
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        self.written = 0
+        self.skipped = 0
+        self.aborted = 0
+        self.bytes_saved = 0
+        self.bytes_aborted = 0
+
+    def add(self, skipped: bool, nbytes: int, uploaded: int = 0):
+        with self.lock:
+            if skipped:
+                self.skipped += 1
+                self.bytes_saved += nbytes - uploaded
+                if uploaded > 0:
+                    self.aborted += 1
+                    self.bytes_aborted += uploaded
+            else:
+                self.written += 1
+
+    def snapshot(self):
+        return {
+            'written': self.written,
+            'skipped': self.skipped,
+            'aborted': self.aborted,
+            'bytes_saved': self.bytes_saved,
+            'bytes_aborted': self.bytes_aborted,
+        }
+
+
+write_stats = WriteStats()
+
+
+class Sink:
+    """
+    The file that the parquet writer writes to, which hands
+    the bytes to the StreamWriter
+    """
+    def __init__(self, writer):
+        self.writer = writer
+        self.position = 0
+        self.closed = False
+
+    def write(self, data):
+        self.position += len(data)
+        self.writer.put(data)
+        return len(data)
+
+    def tell(self):
+        return self.position
+
+    def flush(self):
+        pass
+
+    def close(self):
+        self.closed = True
+
+
+class StreamWriter:
+    """
+    Write a file one chunk (arrow table) at a time. The serialized
+    (and compressed, see compression.py) bytes are collected into parts and each part is
+    uploaded to s3 while the next one is being built, so we never hold
+    more than a couple of parts in memory. When s3 is slower than we are
+    the part being built is moved to WRITE_SPILL_DIRECTORY once it and
+    the part still being sent pass WRITE_SPILL_SIZE. A file that never
+    gets to WRITE_PART_SIZE is sent with a single put_object.
+
+    If the hash of the finished file matches `previous_hash` the file is
+    not replaced and `skipped` is set. The hash is only known at the end,
+    so a file bigger than a part has already sent its parts by then; its
+    multipart upload is aborted and `uploaded` says how much was sent.
+
+        with StreamWriter(s3, 'records/csv.gz/...', ext='csv.gz') as w:
+            for chunk in chunks:
+                w.write(chunk)
+    """
+
+    def __init__(
+            self,
+            s3,
+            filepath: str,
+            ext: str = settings.WRITE_FILE_FORMAT,
+            bucket: str = settings.OPEN_DATA_BUCKET,
+            location: str = settings.WRITE_FILE_LOCATION,
+            public: bool = True,
+            part_size: int = None,
+            spill_size: int = None,
+            previous_hash: str = None,
+    ):
+        if ext not in FILE_FORMATS:
+            raise Exception(f"We are not supporting {ext}")
+        self.s3 = s3
+        self.ext = ext
+        self.bucket = bucket
+        self.location = location
+        self.public = public
+        self.part_size = max(part_size or settings.WRITE_PART_SIZE, MIN_PART_SIZE)
+        self.spill_size = spill_size or settings.WRITE_SPILL_SIZE
+        # parquet does its own compression
+        self.codec = Codec() if ext == 'parquet' else compressor(ext)
+        self.serializer = None
+        self.header = False
+        # parquet chunks are held until there is enough for a row group
+        self.pending = []
+        self.pending_rows = 0
+        self.upload_id = None
+        self.parts = []
+        self.uploading = None
+        self.sending = 0
+        self.rolled = False
+        self.spilled = 0
+        self.executor = None
+        self.rows = 0
+        self.bytes = 0
+        self.uploaded = 0
+        self.ms = 0
+        self.closed = False
+        self.previous_hash = previous_hash
+        self.hash = content_hash()
+        self.skipped = False
+
+        if self.location == 's3' and bucket is not None and bucket != '':
+            self.filepath = f"{filepath}.{ext}"
+            self.buffer = self.new_buffer()
+        elif self.location == 'local':
+            self.filepath = os.path.join(settings.LOCAL_SAVE_DIRECTORY, f"{filepath}.{ext}")
+            os.makedirs(os.path.dirname(self.filepath), exist_ok=True)
+            self.buffer = open(self.filepath, 'wb')
+        else:
+            raise Exception(
+                f"{self.location} is not a valid location"
+            )
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
+        return False
+
+    def new_buffer(self):
+        return tempfile.SpooledTemporaryFile(
+            max_size=self.spill_size,
+            dir=settings.WRITE_SPILL_DIRECTORY,
+        )
+
+    def write(self, tbl: pa.Table):
+        """
+        Serialize the next chunk. The first chunk sets the schema
+        """
+        start = time.time()
+        if self.ext == 'parquet':
+            tbl = parquet_table(tbl)
+        if self.ext == 'parquet':
+            if self.serializer is None:
+                self.serializer = parquet_writer(pa.PythonFile(Sink(self), mode='w'), tbl.schema)
+            self.pending.append(tbl)
+            self.pending_rows += tbl.num_rows
+            if self.pending_rows >= settings.PARQUET_ROW_GROUP_SIZE:
+                self.write_row_groups()
+        else:
+            # the header goes in front of the first chunk
+            self.put(write_csv(tbl, header=not self.header))
+            self.header = True
+        self.rows += tbl.num_rows
+        self.ms += time.time() - start
+
+    def write_row_groups(self):
+        if self.pending_rows > 0:
+            tbl = pa.concat_tables(self.pending).unify_dictionaries()
+            self.serializer.write_table(tbl, row_group_size=settings.PARQUET_ROW_GROUP_SIZE)
+        self.pending = []
+        self.pending_rows = 0
+
+    def write_bytes(self, data, rows: int = 0):
+        """
+        Add data that has already been serialized (e.g. by COPY)
+        """
+        start = time.time()
+        self.put(data)
+        self.rows += rows
+        self.ms += time.time() - start
+
+    def put(self, data, compress: bool = True):
+        if compress:
+            data = self.codec.compress(data)
+        if len(data) == 0:
+            return
+        self.buffer.write(data)
+        self.hash.update(data)
+        self.bytes += len(data)
+        if self.location != 's3':
+            return
+        if self.buffer.tell() >= self.part_size:
+            self.upload_part()
+        # s3 is slower than we are, keep the rest of this part on disk
+        elif (
+            self.uploading is not None
+            and not self.rolled
+            and self.buffer.tell() + self.sending > self.spill_size
+            and not self.uploading.done()
+        ):
+            self.buffer.rollover()
+            self.rolled = True
+            self.spilled += 1
+
+    def upload_part(self, last: bool = False):
+        """
+        Send the current buffer as the next part and start a new buffer.
+        Only one part is in flight at a time
+        """
+        self.wait()
+        if self.upload_id is None:
+            res = self.s3.create_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.filepath,
+                ACL='public-read' if self.public else 'private',
+            )
+            self.upload_id = res['UploadId']
+            self.executor = ThreadPoolExecutor(max_workers=1)
+        buffer = self.buffer
+        number = len(self.parts) + 1
+        self.parts.append(None)
+        self.sending = buffer.tell()
+        self.uploaded += self.sending
+        self.uploading = self.executor.submit(self.send_part, buffer, number)
+        if not last:
+            self.buffer = self.new_buffer()
+            self.rolled = False
+
+    def send_part(self, buffer, number: int):
+        try:
+            buffer.seek(0)
+            res = self.s3.upload_part(
+                Bucket=self.bucket,
+                Key=self.filepath,
+                UploadId=self.upload_id,
+                PartNumber=number,
+                Body=buffer.read(),
+            )
+            self.parts[number - 1] = {'ETag': res['ETag'], 'PartNumber': number}
+        finally:
+            buffer.close()
+
+    def wait(self):
+        if self.uploading is not None:
+            # raises if the upload failed
+            self.uploading.result()
+            self.uploading = None
+            self.sending = 0
+
+    def close(self):
+        """
+        Finish serializing and send whatever is left
+        """
+        if self.closed:
+            return
+        start = time.time()
+        try:
+            if self.serializer is not None and self.ext == 'parquet':
+                self.write_row_groups()
+                self.serializer.close()
+            self.put(self.codec.flush(), compress=False)
+            self.skipped = (
+                self.location == 's3'
+                and self.previous_hash == self.hash.hexdigest()
+            )
+            if self.location == 'local':
+                self.buffer.close()
+            elif self.skipped:
+                # the file has not changed
+                self.buffer.close()
+                if self.upload_id is not None:
+                    self.abort()
+            elif self.upload_id is None:
+                self.buffer.seek(0)
+                self.s3.put_object(
+                    Bucket=self.bucket,
+                    Key=self.filepath,
+                    ACL='public-read' if self.public else 'private',
+                    Body=self.buffer.read(),
+                )
+                self.buffer.close()
+            else:
+                if self.buffer.tell() > 0:
+                    self.upload_part(last=True)
+                else:
+                    self.buffer.close()
+                self.wait()
+                self.s3.complete_multipart_upload(
+                    Bucket=self.bucket,
+                    Key=self.filepath,
+                    UploadId=self.upload_id,
+                    MultipartUpload={'Parts': self.parts},
+                )
+                logger.debug(f"Uploaded {self.filepath} in {len(self.parts)} parts")
+        except Exception:
+            self.abort()
+            raise
+        finally:
+            self.closed = True
+            if self.executor is not None:
+                self.executor.shutdown(wait=False)
+        write_stats.add(self.skipped, self.bytes, self.uploaded)
+        self.ms += time.time() - start
+
+    def held(self):
+        """
+        Roughly how many bytes we are holding in memory: the parquet
+        chunks waiting for a row group, the part being filled (until it
+        spills) and the one being sent
+        """
+        held = sum([tbl.nbytes for tbl in self.pending])
+        if self.location == 's3':
+            if not self.buffer.closed and not self.rolled:
+                held += min(self.buffer.tell(), self.spill_size)
+            if self.uploading is not None and not self.uploading.done():
+                held += self.sending
+        return held
+
+    def stats(self):
+        return {
+            **self.codec.stats(),
+            'hash': self.hash.hexdigest(),
+            'skipped': self.skipped,
+            'uploaded': self.uploaded,
+            'spilled': self.spilled,
+        }
+
+    def abort(self):
+        """
+        Throw away what we have written so far
+        """
+        self.closed = True
+        if not self.buffer.closed:
+            self.buffer.close()
+        if self.location == 'local' and os.path.exists(self.filepath):
+            os.remove(self.filepath)
+        if self.upload_id is not None:
+            try:
+                self.wait()
+            except Exception:
+                pass
+            self.s3.abort_multipart_upload(
+                Bucket=self.bucket,
+                Key=self.filepath,
+                UploadId=self.upload_id,
+            )
+            self.upload_id = None
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
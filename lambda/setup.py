@@ -14,12 +14,15 @@ setup(
     long_description=open("README.md").read(),
     install_requires=[
         "pydantic[dotenv]",
-        "psycopg[binary]",
-        #"asyncpg",
+        "psycopg[binary,pool]",
+        "asyncpg",
+        "aioboto3",
         "buildpg",
-        #"pyarrow",
+        "pyarrow",
         "pandas",
         "orjson",
+        "tzdata",
+        "zstandard",
         #"boto3"
     ],
     extras_require={}
@@ -0,0 +1,40 @@
+import os
+import csv
+from io import StringIO
+
+import pytest
+
+# nothing is sent anywhere, boto just needs a region to create its clients
+os.environ.setdefault('AWS_DEFAULT_REGION', 'us-east-1')
+
+
+def to_csv(df):
+    """
+    The csv that the DataFrame path has always written
+    """
+    out = StringIO()
+    df.to_csv(out, index=False, quoting=csv.QUOTE_NONNUMERIC, lineterminator="\r\n")
+    return out.getvalue().encode()
+
+
+@pytest.fixture
+def pandas_csv():
+    return to_csv
+
+
+@pytest.fixture(scope='session')
+def db():
+    """
+    The database from the settings (.env). The tests that need one
+    are skipped when it cannot be reached
+    """
+    import psycopg
+    from open_data_export.config import settings
+    from open_data_export.pgdb import DB
+    try:
+        psycopg.connect(settings.DATABASE_WRITE_URL, connect_timeout=3).close()
+    except Exception as e:
+        pytest.skip(f"No database to test with: {e}")
+    db = DB()
+    yield db
+    db.close()
@@ -0,0 +1,32 @@
+import asyncio
+from datetime import date
+
+from open_data_export import aio
+from open_data_export.batch import ExportLogBatch
+
+
+class FailingDatabase:
+    def __init__(self):
+        self.calls = 0
+
+    async def rows(self, sql, **params):
+        self.calls += 1
+        if self.calls == 1:
+            raise ValueError('connection lost')
+        return [], 0
+
+
+def test_failed_write_keeps_the_rows(monkeypatch):
+    db = FailingDatabase()
+    monkeypatch.setattr(aio, 'get_database', lambda: db)
+    log = ExportLogBatch(db=db)
+    log.append(date(2024, 1, 1), 1, 10, 10, 'key-1', 1)
+    log.append(date(2024, 1, 1), 2, 20, 10, 'key-2', 1)
+
+    asyncio.run(aio.write_batch(log, force=True))
+    assert len(log.items) == 2
+    assert log.rows == 0
+
+    asyncio.run(aio.write_batch(log, force=True))
+    assert len(log.items) == 0
+    assert log.rows == 2
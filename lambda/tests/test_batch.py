@@ -0,0 +1,137 @@
+import threading
+import time
+from datetime import date
+
+import pytest
+
+from open_data_export.batch import Batch, ErrorBatch
+
+
+class FakeDB:
+    """
+    Records the statements instead of running them, or fails
+    """
+    def __init__(self, fail: bool = False):
+        self.fail = fail
+        self.calls = []
+
+    def rows(self, sql, tag=None, **params):
+        if self.fail:
+            raise ValueError('database is down')
+        self.calls.append(params)
+        return [], 0
+
+
+class KeyBatch(Batch):
+    sql = 'SELECT :values'
+    tag = 'test'
+
+    def params(self, items: list):
+        return {'values': sorted(items)}
+
+
+def test_batch_needs_params():
+    with pytest.raises(TypeError):
+        Batch()
+
+
+def test_ready_at_size():
+    batch = KeyBatch(size=3, seconds=60)
+    assert not batch.ready()
+    batch.add(1, 'a')
+    batch.add(2, 'b')
+    assert not batch.ready()
+    batch.add(3, 'c')
+    assert batch.ready()
+
+
+def test_ready_after_seconds():
+    batch = KeyBatch(size=100, seconds=0.1)
+    batch.add(1, 'a')
+    assert not batch.ready()
+    time.sleep(0.15)
+    assert batch.ready()
+    batch.take()
+    # an empty batch is never ready
+    time.sleep(0.15)
+    assert not batch.ready()
+
+
+def test_add_flushes_at_size():
+    db = FakeDB()
+    batch = KeyBatch(db, size=2, seconds=60)
+    batch.add(1, 'a')
+    assert db.calls == []
+    batch.add(2, 'b')
+    assert db.calls == [{'values': ['a', 'b']}]
+    assert batch.stats()['statements'] == 1
+    assert batch.stats()['rows'] == 2
+    assert batch.stats()['pending'] == 0
+
+
+def test_newer_item_wins_a_duplicate_key():
+    db = FakeDB()
+    batch = KeyBatch(db, size=10, seconds=60)
+    batch.add(1, 'old')
+    batch.add(2, 'b')
+    batch.add(1, 'new')
+    batch.flush()
+    assert db.calls == [{'values': ['b', 'new']}]
+    assert batch.stats()['duplicates'] == 1
+
+
+def test_failed_flush_restores_the_items():
+    db = FakeDB(fail=True)
+    batch = KeyBatch(db, size=10, seconds=60)
+    batch.add(1, 'a')
+    batch.add(2, 'b')
+    batch.flush()
+    assert batch.stats()['pending'] == 2
+    assert batch.stats()['statements'] == 0
+    # something newer came in before the next try
+    batch.add(2, 'c')
+    db.fail = False
+    batch.flush()
+    assert db.calls == [{'values': ['a', 'c']}]
+
+
+def test_restore_keeps_newer_items():
+    batch = KeyBatch()
+    batch.add(1, 'a')
+    items = batch.take()
+    batch.add(1, 'b')
+    batch.restore(items)
+    assert batch.take() == {1: 'b'}
+
+
+def test_error_counts_are_not_lost_between_threads():
+    day = date(2024, 1, 1)
+    batch = ErrorBatch(size=1000000, seconds=60)
+    threads, errors = 8, 500
+    start = threading.Barrier(threads)
+
+    def work():
+        start.wait()
+        for n in range(errors):
+            batch.append(day, 1, ValueError(f'error {n}'))
+
+    workers = [threading.Thread(target=work) for _ in range(threads)]
+    for t in workers:
+        t.start()
+    for t in workers:
+        t.join()
+    items = batch.take()
+    assert list(items) == [(day, 1)]
+    assert items[(day, 1)][5] == threads*errors
+    assert batch.stats()['codes'] == {'ValueError': threads*errors}
+
+
+def test_restored_errors_keep_their_count():
+    day = date(2024, 1, 1)
+    batch = ErrorBatch()
+    batch.append(day, 1, ValueError('first'))
+    batch.append(day, 1, ValueError('second'))
+    items = batch.take()
+    batch.append(day, 1, ValueError('third'))
+    batch.restore(items)
+    assert batch.take()[(day, 1)][2:] == ('third', None, False, 3)
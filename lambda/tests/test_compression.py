@@ -0,0 +1,113 @@
+import gzip
+import zlib
+
+import pytest
+import zstandard
+
+from open_data_export import main
+from open_data_export.config import settings
+from open_data_export.compression import (
+    Codec,
+    Gzip,
+    ParallelGzip,
+    Zstd,
+    compressor,
+    train_dictionary,
+    FILE_FORMATS,
+)
+
+ROWS = b"".join(
+    f'{n},"site-{n % 7}",{n % 500},"2024-01-01T{n % 24:02d}:00:00-05:00","pm25",{n*0.37},"ug/m3",-70.1,41.2\r\n'.encode()
+    for n in range(20000)
+)
+
+
+def compress(codec, data: bytes, size: int = 4096):
+    out = b"".join(codec.compress(data[i:i + size]) for i in range(0, len(data), size))
+    return out + codec.flush()
+
+
+def members(data: bytes):
+    n = 0
+    while data:
+        gz = zlib.decompressobj(wbits=31)
+        gz.decompress(data)
+        data = gz.unused_data
+        n += 1
+    return n
+
+
+@pytest.mark.parametrize('ext,codec', [
+    ('csv', Codec),
+    ('parquet', Codec),
+    ('csv.gz', Gzip),
+    ('csv.zst', Zstd),
+])
+def test_compressor(monkeypatch, ext, codec):
+    monkeypatch.setattr(settings, 'GZIP_THREADS', 1)
+    monkeypatch.setattr(settings, 'ZSTD_DICTIONARY', None)
+    assert ext in FILE_FORMATS
+    assert type(compressor(ext)) is codec
+
+
+def test_gzip_round_trip():
+    codec = Gzip()
+    body = compress(codec, ROWS)
+    assert gzip.decompress(body) == ROWS
+    assert members(body) == 1
+    assert codec.stats()['raw_bytes'] == len(ROWS)
+    assert codec.stats()['bytes'] == len(body)
+
+
+def test_parallel_gzip_members(monkeypatch):
+    monkeypatch.setattr(settings, 'GZIP_THREADS', 4)
+    codec = compressor('csv.gz')
+    assert isinstance(codec, ParallelGzip)
+    codec.block_size = 100000
+    body = compress(codec, ROWS)
+    # any gzip reader reads the members back as one file
+    assert gzip.decompress(body) == ROWS
+    # a block is sent once it is at least block_size
+    assert 1 < members(body) <= len(ROWS)//100000 + 1
+
+
+def test_parallel_gzip_small_and_empty_files():
+    assert gzip.decompress(compress(ParallelGzip(threads=2), b"")) == b""
+    small = compress(ParallelGzip(threads=2), ROWS[:1000])
+    assert members(small) == 1
+    assert gzip.decompress(small) == ROWS[:1000]
+
+
+def test_zstd_round_trip(monkeypatch):
+    monkeypatch.setattr(settings, 'ZSTD_DICTIONARY', None)
+    body = compress(compressor('csv.zst'), ROWS)
+    assert zstandard.ZstdDecompressor().decompressobj().decompress(body) == ROWS
+
+
+def test_zstd_with_a_dictionary(monkeypatch, tmp_path):
+    lines = ROWS.split(b"\r\n")
+    samples = [b"\r\n".join(lines[i:i + 20]) for i in range(0, len(lines), 20)]
+    path = tmp_path / 'csv.dict'
+    path.write_bytes(train_dictionary(samples, size=16384))
+    monkeypatch.setattr(settings, 'ZSTD_DICTIONARY', str(path))
+    codec = compressor('csv.zst')
+    assert codec.name == 'zstd-csv.dict'
+    body = compress(codec, ROWS[:500])
+    dictionary = zstandard.ZstdCompressionDict(path.read_bytes())
+    assert zstandard.ZstdDecompressor(dict_data=dictionary).decompressobj().decompress(body) == ROWS[:500]
+    # and it cannot be read without it
+    with pytest.raises(zstandard.ZstdError):
+        zstandard.ZstdDecompressor().decompressobj().decompress(body)
+
+
+@pytest.mark.parametrize('ext', FILE_FORMATS)
+def test_move_to_the_export_path(monkeypatch, ext):
+    monkeypatch.setattr(settings, 'WRITE_FILE_FORMAT', ext)
+    sql, args = main.move_objects_claim({})
+    assert f"'records/{ext}/locationid=%s/year=%s/month=%s/location-%s-%s.{ext}'" in sql.replace('%%', '%')
+
+
+def test_move_unknown_format(monkeypatch):
+    monkeypatch.setattr(settings, 'WRITE_FILE_FORMAT', 'json')
+    with pytest.raises(Exception, match='not supporting json'):
+        main.move_objects_claim({})
@@ -0,0 +1,113 @@
+import pytest
+from botocore.exceptions import ClientError
+
+from open_data_export.config import settings
+from open_data_export.concurrency import AdaptiveConcurrency, OVERLOAD_CODES
+
+
+@pytest.fixture(autouse=True)
+def window(monkeypatch):
+    monkeypatch.setattr(settings, 'CONCURRENCY_WINDOW', 4)
+    monkeypatch.setattr(settings, 'CONCURRENCY_LATENCY_FACTOR', 2.0)
+    monkeypatch.setattr(settings, 'CONCURRENCY_ERROR_RATE', 0.2)
+
+
+def client_error(code):
+    return ClientError({'Error': {'Code': code, 'Message': ''}}, 'PutObject')
+
+
+def jobs(controller, n, **kwargs):
+    for _ in range(n):
+        controller.record(**kwargs)
+
+
+def test_increases_by_one_per_window():
+    controller = AdaptiveConcurrency(initial=4, minimum=2, maximum=6)
+    jobs(controller, 3, db_ms=100)
+    assert controller.limit == 4
+    jobs(controller, 1, db_ms=100)
+    assert controller.limit == 5
+    jobs(controller, 4, db_ms=100)
+    assert controller.limit == 6
+    # and stops at the maximum
+    jobs(controller, 4, db_ms=100)
+    assert controller.limit == 6
+    assert controller.stats()['increases'] == 2
+
+
+def test_overload_halves_once_per_window():
+    controller = AdaptiveConcurrency(initial=16, minimum=2, maximum=32)
+    controller.record(error=client_error('SlowDown'))
+    # right away, without waiting for the window to end
+    assert controller.limit == 8
+    controller.record(error=client_error('SlowDown'))
+    controller.failed(client_error('Throttling'))
+    jobs(controller, 2)
+    assert controller.limit == 8
+    assert controller.stats()['overloads'] == 3
+    assert controller.stats()['decreases'] == 1
+    # a new window can cut it again
+    controller.record(error=client_error('SlowDown'))
+    assert controller.limit == 4
+
+
+def test_decrease_stops_at_the_minimum():
+    controller = AdaptiveConcurrency(initial=3, minimum=2, maximum=32)
+    controller.record(error=client_error('SlowDown'))
+    assert controller.limit == 2
+    jobs(controller, 3)
+    controller.record(error=client_error('SlowDown'))
+    assert controller.limit == 2
+
+
+def test_error_rate_halves_at_the_end_of_the_window():
+    controller = AdaptiveConcurrency(initial=8, minimum=2, maximum=32)
+    controller.record(error=ValueError('not an overload'))
+    assert controller.limit == 8
+    jobs(controller, 3)
+    # 1 in 4 is over CONCURRENCY_ERROR_RATE
+    assert controller.limit == 4
+
+
+def test_latency_against_the_best_window():
+    controller = AdaptiveConcurrency(initial=8, minimum=2, maximum=32)
+    jobs(controller, 4, s3_ms=200)
+    jobs(controller, 4, s3_ms=100)
+    assert controller.baseline['s3'] == 100
+    assert controller.limit == 10
+    # slower, but within CONCURRENCY_LATENCY_FACTOR of the best window
+    jobs(controller, 4, s3_ms=190)
+    assert controller.limit == 11
+    jobs(controller, 4, s3_ms=500)
+    assert controller.limit == 5
+    assert controller.trace[-1]['reason'] == 's3-latency'
+
+
+def test_baseline_drifts_up():
+    controller = AdaptiveConcurrency(initial=8, minimum=2, maximum=32)
+    jobs(controller, 4, db_ms=100)
+    jobs(controller, 4, db_ms=300)
+    # a tenth of the way to the slower window
+    assert controller.baseline['db'] == pytest.approx(120)
+    limit = controller.limit
+    # the day stays slow and it stops looking like an overload
+    for _ in range(20):
+        jobs(controller, 4, db_ms=300)
+    assert controller.baseline['db'] > 150
+    assert controller.limit > limit // 2
+    assert controller.trace[-1]['reason'] == 'increase'
+
+
+@pytest.mark.parametrize('code', sorted(OVERLOAD_CODES))
+def test_overload_codes(code):
+    controller = AdaptiveConcurrency(initial=8, minimum=2, maximum=32)
+    controller.failed(client_error(code))
+    assert controller.limit == 4
+
+
+def test_other_errors_are_not_overloads():
+    controller = AdaptiveConcurrency(initial=8, minimum=2, maximum=32)
+    controller.failed(client_error('NoSuchKey'))
+    controller.failed(KeyError('x'))
+    assert controller.limit == 8
+    assert controller.stats()['overloads'] == 0
@@ -0,0 +1,67 @@
+import pyarrow as pa
+import pytest
+
+from open_data_export.main import (
+    csv_float_sql,
+    get_measurement_csv,
+    get_measurement_data_n,
+    reshape,
+    CSV_HEADER,
+    EXPORT_FIELDS,
+)
+
+FLOATS = [
+    12.0, -70.0, None, float('nan'), 0.1, -0.0, 0.0, 1e-05, 0.0001,
+    1e15, 1.5e15, -1234567890123456.8, 1e16, 1.2345678901234568e+17,
+    45.123456789012344, -122.41941550000001, 5e-324, 1e300,
+]
+
+
+def copy_csv(db, query: str, **kwargs):
+    return b"".join([bytes(data) for data in db.copy(query, write=False, **kwargs)]).replace(b"\n", b"\r\n")
+
+
+def lines(body: bytes):
+    """
+    The header and the (sorted) rows as they were written, neither
+    query has an order
+    """
+    rows = body.split(b"\r\n")
+    return rows[0], sorted(rows[1:])
+
+
+def test_copy_floats_match_pandas(db, pandas_csv):
+    body = copy_csv(
+        db,
+        f"""
+        SELECT {csv_float_sql('v')} as value
+        FROM unnest((:values)::float8[]) WITH ORDINALITY as t(v, n)
+        ORDER BY n
+        """,
+        values=FLOATS,
+    )
+    expected = pandas_csv(pa.table({'value': pa.array(FLOATS, pa.float64())}).to_pandas())
+    assert b'"value"\r\n' + body == expected
+
+
+def test_copy_matches_pandas(db, pandas_csv):
+    try:
+        days, ms = db.rows(
+            """
+            SELECT sensor_nodes_id, day
+            FROM open_data_export_logs
+            WHERE records > 0
+            ORDER BY exported_on DESC NULLS LAST
+            LIMIT 5
+            """,
+            write=False,
+        )
+    except ValueError as e:
+        pytest.skip(f"Not an openaq database: {e}")
+    if len(days) == 0:
+        pytest.skip("No location/days with data to compare")
+    for node, day in days:
+        rows, ms = get_measurement_data_n(node, day, response_format='DataFrame')
+        expected = pandas_csv(reshape(rows, fields=EXPORT_FIELDS))
+        body = CSV_HEADER + b"".join(get_measurement_csv(node, day))
+        assert lines(body) == lines(expected), f"{node} on {day}"
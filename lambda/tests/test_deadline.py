@@ -0,0 +1,100 @@
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date
+
+from open_data_export.config import settings
+from open_data_export.deadline import Deadline, time_left
+from open_data_export.main import unstarted, abandoned, finish_running
+from open_data_export.pgdb import DB
+
+
+def test_running_jobs_keep_their_claims():
+    day = date(2024, 1, 1)
+    done = threading.Event()
+    exe = ThreadPoolExecutor(max_workers=1)
+    running = exe.submit(done.wait)
+    queued = exe.submit(time.sleep, 0)
+    while not running.running():
+        time.sleep(0.01)
+    exe.shutdown(wait=False, cancel_futures=True)
+    jobs = {running: [(1, day), (2, day)], queued: [(3, day)]}
+    try:
+        assert unstarted(jobs, [(1, day), (3, day), (4, day)]) == [(3, day), (4, day)]
+    finally:
+        done.set()
+
+
+def stuck_run(monkeypatch, leases: bool):
+    monkeypatch.setattr(settings, 'EXPORT_LEASES', leases)
+    day = date(2024, 1, 1)
+    release = threading.Event()
+    started = threading.Event()
+
+    def stuck():
+        started.set()
+        release.wait()
+        return []
+
+    def late():
+        time.sleep(0.2)
+        return [(10, 5, 5, 0)]
+
+    exe = ThreadPoolExecutor(max_workers=2)
+    jobs = {
+        exe.submit(stuck): [(1, day)],
+        exe.submit(late): [(2, day)],
+        exe.submit(time.sleep, 0): [(3, day)],
+    }
+    started.wait(1)
+    # out of time, what has not started is cancelled
+    exe.shutdown(wait=False, cancel_futures=True)
+    try:
+        results, left = finish_running(jobs, 1)
+        rows = abandoned(jobs, [(1, day), (3, day)])
+    finally:
+        release.set()
+    return jobs, results, left, rows
+
+
+def test_stuck_job_is_released_without_leases(monkeypatch):
+    jobs, results, left, rows = stuck_run(monkeypatch, leases=False)
+    # the late job still gets its result counted
+    assert results == [(10, 5, 5, 0)]
+    assert len(left) == 1
+    assert jobs[list(left)[0]] == [(1, date(2024, 1, 1))]
+    # otherwise its queued_on would never be cleared
+    assert rows == [(1, date(2024, 1, 1)), (3, date(2024, 1, 1))]
+
+
+def test_stuck_job_keeps_its_lease(monkeypatch):
+    jobs, results, left, rows = stuck_run(monkeypatch, leases=True)
+    assert len(left) == 1
+    assert rows == [(3, date(2024, 1, 1))]
+
+
+def test_time_left():
+    assert time_left() is None
+    with Deadline().job():
+        assert 0 < time_left() <= settings.EXPORT_JOB_TIMEOUT
+    assert time_left() is None
+
+
+class Connection:
+    def __init__(self):
+        self.statements = []
+
+    def execute(self, query, params=None):
+        self.statements.append((query, params))
+
+
+def test_statements_are_limited_to_the_job_time():
+    db = DB()
+    conn = Connection()
+    db.limit(conn)
+    assert conn.statements == []
+    with Deadline().job():
+        db.limit(conn)
+    query, params = conn.statements[0]
+    assert 'statement_timeout' in query
+    assert 0 < int(params[0]) <= settings.EXPORT_JOB_TIMEOUT*1000 + 1
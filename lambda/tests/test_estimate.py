@@ -0,0 +1,69 @@
+import os
+
+import psycopg
+import pytest
+
+from open_data_export.config import settings
+from open_data_export.main import ESTIMATE_SQL
+from open_data_export.pgdb import DB
+
+SCHEMA = 'open_data_export_test_estimate'
+
+INDEX = os.path.join(os.path.dirname(__file__), '..', '..', 'schema', 'estimate.sql')
+
+
+@pytest.fixture
+def estimate_db(db, monkeypatch):
+    """
+    A DB that sees an export log of its own with the index from
+    schema/estimate.sql
+    """
+    with psycopg.connect(settings.DATABASE_WRITE_URL, autocommit=True) as conn:
+        conn.execute(f"""
+        DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+        CREATE SCHEMA {SCHEMA};
+        SET search_path = {SCHEMA};
+        CREATE TABLE open_data_export_logs (
+          sensor_nodes_id int
+        , day date
+        , records int
+        , exported_on timestamptz
+        , metadata json
+        , PRIMARY KEY (sensor_nodes_id, day));
+        INSERT INTO open_data_export_logs
+        SELECT n, current_date - d, 10, now() - make_interval(hours => d), '{{"msec": 100}}'
+        FROM generate_series(1, 100) n, generate_series(1, 100) d;
+        """)
+        with open(INDEX) as f:
+            conn.execute(f.read())
+        conn.execute("ANALYZE open_data_export_logs")
+    options = f"-c search_path={SCHEMA}"
+    for key in ('DATABASE_WRITE_URL', 'DATABASE_READ_URL'):
+        monkeypatch.setattr(settings, key, psycopg.conninfo.make_conninfo(getattr(settings, key), options=options))
+    estimate_db = DB()
+    yield estimate_db
+    estimate_db.close()
+    monkeypatch.undo()
+    with psycopg.connect(settings.DATABASE_WRITE_URL, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+
+
+def indexes(plan):
+    found = set()
+    if 'Index Name' in plan:
+        found.add(plan['Index Name'])
+    for child in plan.get('Plans', []):
+        found |= indexes(child)
+    return found
+
+
+def test_estimate_reads_the_exported_index(estimate_db):
+    rows, ms = estimate_db.rows(
+        f"EXPLAIN (FORMAT JSON) {ESTIMATE_SQL}",
+        window=86400,
+        n=50,
+        job_bytes=0,
+        write=False,
+    )
+    plan = rows[0][0][0]['Plan']
+    assert 'open_data_export_logs_exported_idx' in indexes(plan)
@@ -0,0 +1,67 @@
+from datetime import date
+
+import pytest
+
+from open_data_export import main
+from open_data_export.config import settings
+from open_data_export.metadata import Node
+
+
+def sensor(node):
+    return {
+        'sensor_nodes_id': node,
+        'sensors_id': node*10,
+        'location': f'site-{node}',
+        'measurands_id': 2,
+        'measurand': 'pm25',
+        'units': 'µg/m³',
+        'lon': 1.5,
+        'lat': 2.5,
+        'ismobile': False,
+        'tz': 'UTC',
+    }
+
+
+class Metadata:
+    def get(self, sensor_nodes_ids):
+        return {node: Node([sensor(node)]) for node in sensor_nodes_ids}
+
+
+class CopyDatabase:
+    def __init__(self):
+        self.copies = []
+
+    def copy(self, query, **kwargs):
+        node = kwargs['location_ids'][0]
+        self.copies.append(node)
+        yield f'{node},"site-{node}"\n'.encode()
+
+
+@pytest.fixture
+def copy_mode(monkeypatch):
+    db = CopyDatabase()
+    written = {}
+
+    def export_chunks(day, node, chunks, log=None, header=None):
+        written[node] = header + b''.join(chunks)
+        return 1, 0, 0, 0
+
+    def batch_fetch(*args, **kwargs):
+        raise AssertionError('the batch query should not be used for COPY')
+
+    monkeypatch.setattr(settings, 'EXPORT_CSV_COPY', True)
+    monkeypatch.setattr(settings, 'WRITE_FILE_FORMAT', 'csv.gz')
+    monkeypatch.setattr(main, 'get_database', lambda: db)
+    monkeypatch.setattr(main, 'get_metadata', lambda: Metadata())
+    monkeypatch.setattr(main, 'get_measurement_data_batch', batch_fetch)
+    monkeypatch.setattr(main, 'export_chunks', export_chunks)
+    return db, written
+
+
+def test_batch_is_copied_out_one_node_at_a_time(copy_mode):
+    db, written = copy_mode
+    results = main.export_batch(date(2024, 1, 1), [1, 2, 3])
+    assert results == [(1, 0, 0, 0)]*3
+    assert db.copies == [1, 2, 3]
+    for node in [1, 2, 3]:
+        assert written[node] == main.CSV_HEADER + f'{node},"site-{node}"\r\n'.encode()
@@ -0,0 +1,76 @@
+from datetime import date
+
+import pyarrow as pa
+
+from open_data_export import main
+from open_data_export.metadata import Node
+
+
+SENSOR = {
+    'sensor_nodes_id': 1,
+    'sensors_id': 10,
+    'location': 'site-1',
+    'measurands_id': 2,
+    'measurand': 'pm25',
+    'units': 'µg/m³',
+    'lon': 1.5,
+    'lat': 2.5,
+    'ismobile': False,
+    'tz': 'UTC',
+}
+
+
+class Metadata:
+    def get(self, sensor_nodes_ids):
+        return {1: Node([SENSOR])}
+
+
+class StreamingDatabase:
+    def __init__(self, chunks: int, size: int):
+        self.chunks = chunks
+        self.size = size
+        self.pulled = 0
+        self.closed = False
+
+    def stream(self, query, **kwargs):
+        try:
+            for i in range(self.chunks):
+                self.pulled += 1
+                yield pa.table({
+                    'sensors_id': pa.array([10]*self.size, pa.int32()),
+                    'datetime': [f'2024-01-01T{i:02d}:00:00+00:00']*self.size,
+                    'value': pa.array([float(j) for j in range(self.size)]),
+                    'lon': pa.array([None]*self.size, pa.float64()),
+                    'lat': pa.array([None]*self.size, pa.float64()),
+                })
+        finally:
+            self.closed = True
+
+
+def fetch(monkeypatch, db, budget):
+    monkeypatch.setattr(main, 'get_database', lambda: db)
+    monkeypatch.setattr(main, 'get_metadata', lambda: Metadata())
+    return main.get_measurement_data_batch([1], date(2024, 1, 1), budget=budget)
+
+
+def test_stops_pulling_rows_once_over_budget(monkeypatch):
+    db = StreamingDatabase(chunks=10, size=3)
+    rows, ms = fetch(monkeypatch, db, budget=4)
+    assert rows is None
+    assert db.pulled == 2
+    assert db.closed
+
+
+def test_batch_within_budget(monkeypatch):
+    db = StreamingDatabase(chunks=2, size=3)
+    rows, ms = fetch(monkeypatch, db, budget=6)
+    assert rows.num_rows == 6
+    assert rows.column('location_id').to_pylist() == [1]*6
+    assert rows.column('lon').to_pylist() == [1.5]*6
+
+
+def test_batch_without_rows(monkeypatch):
+    db = StreamingDatabase(chunks=0, size=0)
+    rows, ms = fetch(monkeypatch, db, budget=6)
+    assert rows.num_rows == 0
+    assert 'location' in rows.column_names
@@ -0,0 +1,29 @@
+from datetime import date
+
+from open_data_export import main
+from open_data_export.config import settings
+
+
+def test_only_fingerprint_what_could_be_skipped(monkeypatch):
+    day = date(2024, 1, 1)
+    scanned = []
+
+    def get_fingerprints(day, nodes):
+        scanned.extend(nodes)
+        return {node: f"fingerprint-{node}" for node in nodes}
+
+    monkeypatch.setattr(main, 'get_fingerprints', get_fingerprints)
+    monkeypatch.setattr(main, 'export_hashes', {
+        (1, day): ('key-1', 'hash-1', 'fingerprint-1', 10),
+        (2, day): ('key-2', 'hash-2', None, 20),
+    })
+    monkeypatch.setattr(main, 'export_fingerprints', {})
+    days = [(1, day), (2, day), (3, day)]
+
+    main.load_fingerprints(days)
+    assert scanned == [1]
+
+    scanned.clear()
+    monkeypatch.setattr(settings, 'EXPORT_FINGERPRINT_NEW', True)
+    main.load_fingerprints(days)
+    assert scanned == [1, 2, 3]
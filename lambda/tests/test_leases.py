@@ -0,0 +1,124 @@
+import threading
+import time
+from datetime import date, timedelta
+
+import psycopg
+import pytest
+
+from open_data_export.config import settings
+from open_data_export.pgdb import DB
+from open_data_export.leases import Leases
+
+SCHEMA = 'open_data_export_test_leases'
+
+TABLES = f"""
+DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+CREATE SCHEMA {SCHEMA};
+CREATE TABLE {SCHEMA}.timezones (gid int PRIMARY KEY, tzid text);
+CREATE TABLE {SCHEMA}.sensor_nodes (sensor_nodes_id int PRIMARY KEY, timezones_id int);
+CREATE TABLE {SCHEMA}.open_data_export_logs (
+  sensor_nodes_id int
+, day date
+, records int
+, queued_on timestamptz
+, exported_on timestamptz
+, has_error boolean
+, lease_worker text
+, lease_expires_on timestamptz
+, PRIMARY KEY (sensor_nodes_id, day));
+INSERT INTO {SCHEMA}.timezones VALUES (1, 'UTC');
+"""
+
+NODES = 50
+DAYS = 4
+# every 10th node has failed and should never be claimed
+ERRORS = {n for n in range(1, NODES + 1) if n % 10 == 0}
+
+
+@pytest.fixture
+def leases_db(db, monkeypatch):
+    """
+    A DB that sees its own copy of the export log (and the tables
+    the claim query joins to) in a schema of its own
+    """
+    with psycopg.connect(settings.DATABASE_WRITE_URL, autocommit=True) as conn:
+        conn.execute(TABLES)
+        with conn.cursor() as cur:
+            cur.executemany(
+                f"INSERT INTO {SCHEMA}.sensor_nodes VALUES (%s, 1)",
+                [(n,) for n in range(1, NODES + 1)],
+            )
+            cur.executemany(
+                f"INSERT INTO {SCHEMA}.open_data_export_logs (sensor_nodes_id, day, records, has_error) VALUES (%s, %s, 10, %s)",
+                [
+                    (n, date.today() - timedelta(days=d + 2), n in ERRORS)
+                    for n in range(1, NODES + 1)
+                    for d in range(DAYS)
+                ],
+            )
+    options = f"-c search_path={SCHEMA}"
+    for key in ('DATABASE_WRITE_URL', 'DATABASE_READ_URL'):
+        monkeypatch.setattr(settings, key, psycopg.conninfo.make_conninfo(getattr(settings, key), options=options))
+    leases_db = DB(pool_size=8)
+    yield leases_db
+    leases_db.close()
+    monkeypatch.undo()
+    with psycopg.connect(settings.DATABASE_WRITE_URL, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+
+
+def test_workers_never_claim_the_same_location_day(leases_db):
+    workers = 8
+    start = threading.Barrier(workers)
+    claimed = [[] for _ in range(workers)]
+
+    def work(n):
+        leases = Leases(leases_db)
+        start.wait()
+        while True:
+            rows, ms = leases.claim(7)
+            if len(rows) == 0:
+                break
+            claimed[n].extend([(r[0], r[1]) for r in rows])
+
+    threads = [threading.Thread(target=work, args=(n,)) for n in range(workers)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+    everything = [row for rows in claimed for row in rows]
+    assert len(everything) == len(set(everything))
+    assert len(everything) == (NODES - len(ERRORS))*DAYS
+    assert not any([node in ERRORS for node, day in everything])
+
+
+def test_expired_leases_can_be_claimed_again(leases_db):
+    first = Leases(leases_db, seconds=1)
+    rows, ms = first.claim(10)
+    assert len(rows) == 10
+    rows = [(r[0], r[1]) for r in rows]
+
+    second = Leases(leases_db, seconds=60)
+    assert not set(rows) & {(r[0], r[1]) for r in second.claim(1000)[0]}
+    time.sleep(1.5)
+    reclaimed, ms = second.claim(1000)
+    assert {(r[0], r[1]) for r in reclaimed} == set(rows)
+    # the first worker lost them and can not extend or release them anymore
+    assert first.extend(rows) == 0
+    assert first.release(rows) == 0
+    assert second.release(rows) == len(rows)
+
+
+def test_failed_location_days_are_not_claimed_again(leases_db):
+    leases = Leases(leases_db, seconds=1)
+    rows, ms = leases.claim(5)
+    node, day = rows[0][0], rows[0][1]
+    leases_db.rows(
+        "UPDATE open_data_export_logs SET has_error = true WHERE sensor_nodes_id = :node AND day = :day RETURNING TRUE",
+        node=node,
+        day=day,
+    )
+    time.sleep(1.5)
+    reclaimed, ms = Leases(leases_db).claim(1000)
+    assert (node, day) not in {(r[0], r[1]) for r in reclaimed}
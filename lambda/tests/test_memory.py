@@ -0,0 +1,109 @@
+import threading
+import time
+
+import pytest
+
+from open_data_export.config import settings
+from open_data_export.memory import MemoryBudget, hold, observe, node_peak, job_peak
+
+MB = 1048576
+
+
+@pytest.fixture(autouse=True)
+def per_job(monkeypatch):
+    monkeypatch.setattr(settings, 'EXPORT_MEMORY_PER_JOB', 5*MB)
+    monkeypatch.setattr(settings, 'EXPORT_MEMORY_PER_RECORD', 1000)
+
+
+def test_estimate():
+    budget = MemoryBudget(100*MB)
+    assert budget.estimate(0) == 5*MB
+    assert budget.estimate(None) == 5*MB
+    assert budget.estimate(1000) == 5*MB + 1000*1000
+
+
+def test_waits_for_room_in_the_budget():
+    budget = MemoryBudget(20*MB)
+    started = []
+    first = budget.job(10000)
+    first.__enter__()
+
+    def second():
+        with budget.job(10000):
+            started.append(time.time())
+
+    thread = threading.Thread(target=second)
+    thread.start()
+    time.sleep(0.1)
+    # 15MB + 15MB does not fit
+    assert started == []
+    first.__exit__(None, None, None)
+    thread.join(1)
+    assert len(started) == 1
+    assert budget.waits == 1
+    assert budget.high == budget.estimate(10000)
+
+
+def test_starts_a_job_that_is_over_budget_on_its_own():
+    budget = MemoryBudget(1*MB)
+    with budget.job(1000000):
+        assert budget.running == 1
+    assert budget.over == 0
+    assert budget.waits == 0
+
+
+def test_calibrate_from_the_export_log():
+    budget = MemoryBudget(100*MB)
+    budget.calibrate(None)
+    budget.calibrate(0)
+    assert budget.per_record == 1000
+    budget.calibrate(250)
+    assert budget.per_record == 250
+    assert budget.estimate(1000) == 5*MB + 250000
+
+
+def test_recalibrates_from_the_measured_peaks():
+    budget = MemoryBudget(100*MB)
+    for i in range(5):
+        budget.record(1000, budget.estimate(1000), 5*MB + 400000)
+        # not trusted until there have been a few jobs
+        assert budget.per_record == (1000 if i < 4 else 400)
+    assert budget.jobs == 5
+    assert budget.over == 0
+    budget.record(1000, budget.estimate(1000), 5*MB + 4000000)
+    assert budget.over == 1
+    assert budget.per_record == pytest.approx((5*400000 + 4000000)/6000)
+
+
+def test_job_records_its_peak():
+    budget = MemoryBudget(100*MB)
+    for i in range(5):
+        with budget.job(1000):
+            hold(5*MB)
+            observe(500000)
+            assert job_peak() == 5*MB + 500000
+    assert budget.per_record == 500
+    assert job_peak() is None
+
+
+def test_batch_peak_is_split_by_records():
+    budget = MemoryBudget(100*MB)
+    with budget.job(1000):
+        # one batch of three nodes
+        hold(20*MB, 1000)
+        observe(1*MB)
+        peaks = [node_peak(n) for n in (500, 300, 200)]
+    fixed = settings.EXPORT_MEMORY_PER_JOB
+    # what the export log estimate adds up
+    assert sum(p - fixed for p in peaks) == pytest.approx(16*MB, abs=2)
+    assert peaks[0] - fixed == pytest.approx(8*MB, abs=1)
+    assert node_peak(100) is None
+
+
+def test_single_node_keeps_the_job_peak():
+    budget = MemoryBudget(100*MB)
+    with budget.job(100):
+        observe(7*MB)
+        assert node_peak(100) == 7*MB
+        observe(4*MB)
+        assert node_peak(100) == 7*MB
@@ -0,0 +1,76 @@
+
+import pyarrow as pa
+
+from open_data_export.config import settings
+from open_data_export.metadata import Node, MetadataCache, SENSORS_SQL, attach
+
+
+def sensor(sensors_id: int, node: int, ismobile):
+    return {
+        'sensor_nodes_id': node,
+        'sensors_id': sensors_id,
+        'location': f"site-{node}",
+        'measurands_id': 2,
+        'measurand': 'pm25',
+        'units': 'µg/m³',
+        'lon': -70.0,
+        'lat': 12.0,
+        'ismobile': ismobile,
+        'tz': 'UTC',
+    }
+
+
+def test_attach_uses_the_node_coordinates_unless_mobile():
+    nodes = {
+        1: Node([sensor(10, 1, True)]),
+        2: Node([sensor(20, 2, False)]),
+        3: Node([sensor(30, 3, None)]),
+    }
+    rows = pa.table({
+        'sensors_id': pa.array([10, 20, 30], pa.int32()),
+        'datetime': pa.array(['2024-01-01T01:00:00+00:00']*3),
+        'value': pa.array([1.0, 2.0, 3.0]),
+        'lon': pa.array([-71.5, -71.5, -71.5]),
+        'lat': pa.array([13.5, 13.5, 13.5]),
+    })
+    tbl = attach(rows, nodes)
+    assert tbl.column('lon').to_pylist() == [-71.5, -70.0, -70.0]
+    assert tbl.column('lat').to_pylist() == [13.5, 12.0, 12.0]
+
+
+FIELDS = ['sensors_id', 'location', 'measurands_id', 'measurand', 'units', 'lon', 'lat', 'ismobile', 'tz']
+
+
+class FakeDB:
+    """
+    Answers the metadata queries from a dict of node: (sensors, marker)
+    """
+    def __init__(self, nodes: dict):
+        self.nodes = nodes
+
+    def rows(self, sql, sensor_nodes_ids, **kwargs):
+        if sql == SENSORS_SQL:
+            rows = []
+            for node in sensor_nodes_ids:
+                sensors, marker = self.nodes[node]
+                rows.extend([(node, *[s[k] for k in FIELDS], marker) for s in sensors])
+        else:
+            rows = [
+                (node, len(sensors), max([s['sensors_id'] for s in sensors]), marker)
+                for node, (sensors, marker) in self.nodes.items()
+                if node in sensor_nodes_ids
+            ]
+        return rows, 0
+
+
+def test_cache_drops_a_node_when_its_marker_changes(monkeypatch):
+    monkeypatch.setattr(settings, 'METADATA_CACHE_CHECK', 0)
+    db = FakeDB({1: ([sensor(10, 1, False)], 111), 2: ([sensor(20, 2, False)], 222)})
+    cache = MetadataCache(db)
+    assert cache.get([1, 2])[1].sensors[0]['location'] == 'site-1'
+    # renamed, same sensors
+    renamed = {**sensor(10, 1, False), 'location': 'renamed'}
+    db.nodes[1] = ([renamed], 333)
+    assert cache.validate([1, 2]) == [1]
+    assert cache.get([1, 2])[1].sensors[0]['location'] == 'renamed'
+    assert cache.stats()['invalidated'] == 1
@@ -0,0 +1,193 @@
+import math
+from datetime import date, datetime, timezone
+
+import pyarrow as pa
+import pyarrow.csv as pacsv
+import pytest
+from buildpg import V, RawDangerous
+
+from open_data_export.config import settings
+from open_data_export.pgdb import (
+    DB,
+    CopyReader,
+    arrow_field,
+    csv_options,
+    csv_table,
+    positional,
+    rechunk,
+)
+
+
+class Copy:
+    """
+    Hands out one row at a time, like a psycopg COPY TO
+    """
+    def __init__(self, rows: list):
+        self.rows = list(rows)
+
+    def read(self):
+        return memoryview(self.rows.pop(0)) if self.rows else b''
+
+
+FIELDS = [
+    arrow_field('id', 'int4'),
+    arrow_field('datetime', 'timestamptz'),
+    arrow_field('value', 'float8'),
+    arrow_field('ok', 'bool'),
+    arrow_field('label', 'text'),
+    arrow_field('location', 'text'),
+    arrow_field('day', 'date'),
+]
+
+# the way postgres writes them with FORMAT csv
+ROWS = [
+    b'1,2024-01-01 00:00:00+00,NaN,t,"",site-1,2024-01-02\n',
+    b'2,2024-03-10 05:30:00.123456+00,Infinity,f,"a ""quoted"", value",site-1,2024-01-03\n',
+    b'3,,-1.5e-05,,,site-2,\n',
+]
+
+
+def test_copy_reader_passes_the_rows_on():
+    source = CopyReader(Copy(ROWS))
+    assert not source.empty()
+    assert source.read(5) == ROWS[0][:5]
+    assert source.read() == b''.join(ROWS)[5:]
+    assert source.read() == b''
+    assert CopyReader(Copy([])).empty()
+
+
+def test_postgres_csv_is_read_by_column():
+    read_options, convert_options = csv_options(FIELDS)
+    tbl = pacsv.read_csv(
+        CopyReader(Copy(ROWS)),
+        read_options=read_options,
+        convert_options=convert_options,
+    )
+    assert tbl.schema == pa.schema(FIELDS)
+    rows = tbl.to_pylist()
+    assert math.isnan(rows[0]['value'])
+    assert rows[1]['value'] == float('inf')
+    assert rows[2]['value'] == -1.5e-05
+    assert rows[0]['datetime'] == datetime(2024, 1, 1, tzinfo=timezone.utc)
+    assert rows[1]['datetime'].microsecond == 123456
+    # an empty string is quoted and a null is not
+    assert [r['label'] for r in rows] == ['', 'a "quoted", value', None]
+    assert [r['ok'] for r in rows] == [True, False, None]
+    assert [r['datetime'] is None for r in rows] == [False, False, True]
+    assert [r['day'] for r in rows] == [date(2024, 1, 2), date(2024, 1, 3), None]
+    assert tbl.column('location').type == pa.dictionary(pa.int32(), pa.string())
+
+
+def test_csv_table():
+    assert csv_table(b'', FIELDS).schema == pa.schema(FIELDS)
+    tbl = csv_table(b''.join(ROWS), FIELDS)
+    assert tbl.column('id').to_pylist() == [1, 2, 3]
+
+
+def test_rechunk():
+    batches = [pa.record_batch({'a': list(range(i*5, i*5 + 5))}) for i in range(5)]
+    tables = list(rechunk(batches, 7))
+    assert [len(t) for t in tables] == [7, 7, 7, 4]
+    assert [v for t in tables for v in t.column('a').to_pylist()] == list(range(25))
+    assert list(rechunk([], 7)) == []
+
+
+QUERY = """
+SELECT g as id
+, '2024-01-01'::timestamptz + g*interval '1 hour' as datetime
+, CASE WHEN g % 7 = 0 THEN NULL ELSE g*0.1::float8 END as value
+, g % 2 = 0 as ok
+, CASE WHEN g % 3 = 0 THEN '' WHEN g % 5 = 0 THEN NULL ELSE 'say "hi", '||g END as label
+, 'site-'||(g % 4) as location
+, '2024-01-01'::date + g as day
+FROM generate_series(1, :n) g
+"""
+
+
+def test_arrow_matches_the_rows(db):
+    rows, ms = db.rows(QUERY, n=1000, write=False)
+    tbl, ms = db.rows(QUERY, n=1000, write=False, response_format='Arrow')
+    assert tbl.schema == pa.schema(FIELDS)
+    assert [tuple(r.values()) for r in tbl.to_pylist()] == [tuple(r) for r in rows]
+    chunks = list(db.stream(QUERY, chunk_size=300, n=1000, write=False, response_format='Arrow'))
+    assert [len(c) for c in chunks] == [300, 300, 300, 100]
+    assert pa.concat_tables(chunks).to_pylist() == tbl.to_pylist()
+    empty, ms = db.rows(QUERY, n=0, write=False, response_format='Arrow')
+    assert empty.schema == pa.schema(FIELDS)
+    assert len(empty) == 0
+
+
+def test_positional_repeats_arguments():
+    rquery, args = positional("SELECT $1, $2 WHERE a = $1", ['a', 'b'])
+    assert rquery == "SELECT %s, %s WHERE a = %s"
+    assert args == ['a', 'b', 'a']
+
+
+def test_positional_leaves_quoted_text_alone():
+    rquery, args = positional(
+        """SELECT $2, '$1 it''s $1', "col$1", $fn$ SELECT $1 $fn$, $$ $2 $$ WHERE a = $1""",
+        ['a', 'b'],
+    )
+    assert rquery == """SELECT %s, '$1 it''s $1', "col$1", $fn$ SELECT $1 $fn$, $$ $2 $$ WHERE a = %s"""
+    assert args == ['b', 'a']
+
+
+@pytest.fixture
+def statements(monkeypatch):
+    """
+    A DB that is only used to render statements, the pool is not
+    created until the first query
+    """
+    monkeypatch.setattr(settings, 'DATABASE_STATEMENT_CACHE_SIZE', 2)
+    monkeypatch.setattr(settings, 'DATABASE_PREPARE_THRESHOLD', 2)
+    return DB()
+
+
+def test_statement_is_rendered_once(statements):
+    query = "SELECT :a::int + :b, '$1', :a"
+    first = statements.statement(query, {'a': 1, 'b': 2})
+    assert first == ("SELECT %s::int + %s, '$1', %s", [1, 2, 1], False)
+    # the same statement with the new values
+    second = statements.statement(query, {'b': 4, 'a': 3})
+    assert second == ("SELECT %s::int + %s, '$1', %s", [3, 4, 3], False)
+    assert statements.statement_stats() == {'size': 1, 'hits': 1, 'misses': 1}
+
+
+def test_statement_is_prepared_after_the_threshold(statements):
+    prepared = [statements.statement("SELECT :a", {'a': n})[2] for n in range(4)]
+    assert prepared == [False, False, True, True]
+
+
+def test_statement_cache_drops_the_least_recently_used(statements):
+    statements.statement("SELECT :a", {'a': 1})
+    statements.statement("SELECT :b", {'b': 1})
+    # used again, so the next one pushes out :b
+    statements.statement("SELECT :a", {'a': 1})
+    statements.statement("SELECT :c", {'c': 1})
+    assert [key[0] for key in statements.statements] == ["SELECT :a", "SELECT :c"]
+    statements.statement("SELECT :b", {'b': 1})
+    assert statements.statement_stats()['misses'] == 4
+
+
+def test_statement_with_a_different_set_of_names_is_another_entry(statements):
+    statements.statement("SELECT :a", {'a': 1})
+    statements.statement("SELECT :a", {'a': 1, 'unused': 2})
+    assert statements.statement_stats() == {'size': 2, 'hits': 0, 'misses': 2}
+
+
+class Columns:
+    """
+    Something that renders its own sql but is not a Component
+    """
+    def render_names(self):
+        yield RawDangerous('a, b')
+
+
+@pytest.mark.parametrize('query,params,expected', [
+    ("SELECT :col, :x", {'col': V('sensors_id'), 'x': 1}, ("SELECT sensors_id, %s", [1], False)),
+    ("SELECT :cols__names, :x", {'cols': Columns(), 'x': 1}, ("SELECT a, b, %s", [1], False)),
+])
+def test_statement_is_not_cached_when_the_sql_depends_on_the_values(statements, query, params, expected):
+    for _ in range(3):
+        assert statements.statement(query, params) == expected
+    assert statements.statement_stats() == {'size': 0, 'hits': 0, 'misses': 0}
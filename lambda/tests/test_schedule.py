@@ -0,0 +1,77 @@
+from datetime import date
+
+import pytest
+
+from open_data_export import main
+from open_data_export.config import settings
+from open_data_export.main import schedule_pending, makespan
+
+DAY = date(2024, 1, 1)
+OTHER = date(2024, 1, 2)
+
+
+@pytest.fixture
+def records(monkeypatch):
+    """
+    The records each location/day had the last time it was exported
+    """
+    monkeypatch.setattr(settings, 'EXPORT_LARGEST_FIRST', True)
+    monkeypatch.setattr(settings, 'EXPORT_LARGE_RECORDS', 1000)
+    known = {}
+    monkeypatch.setattr(main, 'export_records', known)
+    return known
+
+
+def test_largest_jobs_first(records):
+    records.update({(1, DAY): 10, (2, DAY): 500, (3, DAY): 20, (4, OTHER): 900})
+    days = [(1, DAY), (2, DAY), (3, DAY), (4, OTHER)]
+    scheduled, claimed = schedule_pending(days, size=2)
+    assert claimed == [(DAY, [1, 2], 510), (DAY, [3], 20), (OTHER, [4], 900)]
+    # batched by size within a day and then sorted by the total
+    assert scheduled == [(OTHER, [4], 900), (DAY, [2, 3], 520), (DAY, [1], 10)]
+
+
+def test_large_location_days_get_their_own_job(records):
+    records.update({(1, DAY): 5000, (2, DAY): 10, (3, DAY): 2000, (4, DAY): 20})
+    days = [(1, DAY), (2, DAY), (3, DAY), (4, DAY)]
+    scheduled, claimed = schedule_pending(days, size=10)
+    assert claimed == [(DAY, [1, 2, 3, 4], 7030)]
+    assert scheduled == [(DAY, [1], 5000), (DAY, [3], 2000), (DAY, [4, 2], 30)]
+
+
+def test_unknown_location_days_get_the_average(records):
+    records.update({(1, DAY): 100, (2, DAY): 300})
+    days = [(1, DAY), (2, DAY), (3, DAY)]
+    scheduled, claimed = schedule_pending(days, size=1)
+    assert scheduled == [(DAY, [2], 300), (DAY, [3], 200), (DAY, [1], 100)]
+
+
+def test_nothing_known_is_zero(records):
+    scheduled, claimed = schedule_pending([(1, DAY), (2, DAY)], size=1)
+    assert scheduled == claimed == [(DAY, [1], 0), (DAY, [2], 0)]
+
+
+def test_claimed_order_without_largest_first(records, monkeypatch):
+    monkeypatch.setattr(settings, 'EXPORT_LARGEST_FIRST', False)
+    records.update({(1, DAY): 10, (2, DAY): 5000, (3, DAY): 300})
+    days = [(1, DAY), (2, DAY), (3, DAY)]
+    scheduled, claimed = schedule_pending(days, size=2)
+    assert scheduled == claimed == [(DAY, [1, 2], 5010), (DAY, [3], 300)]
+
+
+def test_makespan():
+    assert makespan([], 4) == 0
+    assert makespan([5, 3, 2], 1) == 10
+    # each job goes to the first free worker
+    assert makespan([1, 1, 8], 2) == 9
+    assert makespan([8, 1, 1], 2) == 8
+    assert makespan([3, 3, 3], 0) == 9
+
+
+def test_largest_first_has_the_shorter_makespan(records):
+    records.update({(n, DAY): 1 for n in range(1, 9)})
+    records[(9, DAY)] = 8
+    days = [(n, DAY) for n in range(1, 10)]
+    scheduled, claimed = schedule_pending(days, size=1)
+    assert makespan([j[2] for j in claimed], 2) == 12
+    assert makespan([j[2] for j in scheduled], 2) == 8
@@ -0,0 +1,29 @@
+import gzip
+
+import pyarrow as pa
+
+from open_data_export.config import settings
+from open_data_export import main
+from open_data_export.serialize import SerializePool
+from open_data_export.writer import write_csv
+
+
+def test_pool_is_forked_before_the_database_threads(monkeypatch):
+    monkeypatch.setattr(settings, 'EXPORT_SERIALIZE_PROCESSES', 2)
+    pool = SerializePool()
+
+    class FakeDB:
+        def __init__(self, pool_size):
+            # the pool had to be running by now
+            assert pool.executor is not None
+
+    monkeypatch.setattr(main, 'get_serializer', lambda: pool)
+    monkeypatch.setattr(main, 'DB', FakeDB)
+    monkeypatch.setattr(main, 'db', None)
+    try:
+        main.get_database()
+        tbl = pa.table({'a': list(range(1000)), 'b': ['x']*1000})
+        body, stats = pool.serialize(tbl, 'csv.gz')
+        assert gzip.decompress(body) == write_csv(tbl)
+    finally:
+        pool.shutdown()
@@ -0,0 +1,45 @@
+import os
+import subprocess
+import sys
+
+ROWS = 2000000
+WIDTH = 100
+CHUNK = 10000
+
+# run in its own process so that the peak RSS is only this query
+SCRIPT = f"""
+from open_data_export.pgdb import DB
+from open_data_export.memory import process_peak
+
+QUERY = '''
+SELECT g as id, now() as datetime, g*0.5 as value, repeat('x', {WIDTH}) as label
+FROM generate_series(1, :n) g
+'''
+
+db = DB()
+# warm up the pool and the imports before we take the baseline
+for chunk in db.stream(QUERY, chunk_size={CHUNK}, write=False, n=10):
+    pass
+base = process_peak()
+n = 0
+for chunk in db.stream(QUERY, chunk_size={CHUNK}, write=False, response_format='Arrow', n={ROWS}):
+    n += len(chunk)
+db.close()
+print(n, process_peak() - base)
+"""
+
+
+def test_stream_memory_stays_flat(db):
+    result = subprocess.run(
+        [sys.executable, '-c', SCRIPT],
+        cwd=os.path.dirname(os.path.dirname(os.path.abspath(__file__))),
+        capture_output=True,
+        text=True,
+        timeout=600,
+    )
+    assert result.returncode == 0, result.stderr
+    n, grew = [int(v) for v in result.stdout.split()[-2:]]
+    assert n == ROWS
+    # the label alone is ~200MB for all of the rows, a client side
+    # cursor would have to hold all of it before the first chunk
+    assert grew < ROWS*WIDTH/8, f"peak RSS grew by {grew/1048576:.0f}MB"
@@ -0,0 +1,139 @@
+from datetime import date, datetime, timedelta, timezone
+
+import psycopg
+import pytest
+
+from open_data_export.config import settings
+from open_data_export.main import MEASUREMENT_DATA_SQL, MEASUREMENT_BATCH_SQL
+from open_data_export.metadata import Node, params, utc_window
+
+
+def utc(*args):
+    return datetime(*args, tzinfo=timezone.utc)
+
+
+@pytest.mark.parametrize('tz,day,start,end', [
+    # an ordinary day
+    ('America/New_York', date(2024, 1, 15), utc(2024, 1, 15, 5), utc(2024, 1, 16, 5)),
+    # spring forward at 2am, 23 hours
+    ('America/New_York', date(2024, 3, 10), utc(2024, 3, 10, 5), utc(2024, 3, 11, 4)),
+    # fall back at 2am, 25 hours
+    ('America/New_York', date(2024, 11, 3), utc(2024, 11, 3, 4), utc(2024, 11, 4, 5)),
+    # midnight never happens (00:00 -> 01:00) and takes the offset from before
+    ('America/Havana', date(2024, 3, 9), utc(2024, 3, 9, 5), utc(2024, 3, 10, 5)),
+    ('America/Havana', date(2024, 3, 10), utc(2024, 3, 10, 5), utc(2024, 3, 11, 4)),
+    # midnight happens twice (01:00 -> 00:00) and takes the offset from after
+    ('America/Havana', date(2024, 11, 2), utc(2024, 11, 2, 4), utc(2024, 11, 3, 5)),
+    ('America/Havana', date(2024, 11, 3), utc(2024, 11, 3, 5), utc(2024, 11, 4, 5)),
+    # southern hemisphere, also at midnight
+    ('America/Santiago', date(2024, 4, 6), utc(2024, 4, 6, 3), utc(2024, 4, 7, 4)),
+    ('America/Santiago', date(2024, 4, 7), utc(2024, 4, 7, 4), utc(2024, 4, 8, 4)),
+    ('America/Santiago', date(2024, 9, 7), utc(2024, 9, 7, 4), utc(2024, 9, 8, 4)),
+    ('America/Santiago', date(2024, 9, 8), utc(2024, 9, 8, 4), utc(2024, 9, 9, 3)),
+    ('UTC', date(2024, 3, 10), utc(2024, 3, 10), utc(2024, 3, 11)),
+])
+def test_utc_window(tz, day, start, end):
+    assert utc_window(day, tz) == (start, end)
+
+
+@pytest.mark.parametrize('tz', ['America/New_York', 'America/Havana', 'America/Santiago', 'Asia/Kolkata'])
+def test_utc_window_matches_postgres(db, tz):
+    days = [date(2024, 1, 1) + timedelta(days=d) for d in range(366)]
+    rows, ms = db.rows(
+        """
+        SELECT d, timezone(:tz, d::timestamp), timezone(:tz, (d + 1)::timestamp)
+        FROM unnest((:days)::date[]) as d
+        """,
+        tz=tz,
+        days=days,
+        write=False,
+    )
+    for day, start, end in rows:
+        assert utc_window(day, tz) == (start, end), f"{day} in {tz}"
+
+
+SCHEMA = 'open_data_export_test_pruning'
+
+# one partition per utc day, like the chunks of the measurements table
+PARTITIONS = [date(2024, 3, 8) + timedelta(days=d) for d in range(6)]
+
+
+def partition(day):
+    return f"m_{day:%Y%m%d}"
+
+
+@pytest.fixture
+def partitioned(db):
+    with psycopg.connect(settings.DATABASE_WRITE_URL, autocommit=True) as conn:
+        conn.execute(f"""
+        DROP SCHEMA IF EXISTS {SCHEMA} CASCADE;
+        CREATE SCHEMA {SCHEMA};
+        CREATE TABLE {SCHEMA}.measurements (
+          sensors_id int
+        , datetime timestamptz
+        , value float8
+        , lon float8
+        , lat float8
+        ) PARTITION BY RANGE (datetime);
+        CREATE FUNCTION {SCHEMA}.format_timestamp(timestamptz, text) RETURNS text AS
+        $$ SELECT timezone($2, $1)::text $$ LANGUAGE sql IMMUTABLE;
+        """)
+        for day in PARTITIONS:
+            conn.execute(
+                f"CREATE TABLE {SCHEMA}.{partition(day)} PARTITION OF {SCHEMA}.measurements "
+                f"FOR VALUES FROM ('{day}T00:00:00+00') TO ('{day + timedelta(days=1)}T00:00:00+00')"
+            )
+    yield db
+    with psycopg.connect(settings.DATABASE_WRITE_URL, autocommit=True) as conn:
+        conn.execute(f"DROP SCHEMA {SCHEMA} CASCADE")
+
+
+def sensor(node, tz):
+    return {
+        'sensor_nodes_id': node,
+        'sensors_id': node*10,
+        'location': f'site-{node}',
+        'measurands_id': 2,
+        'measurand': 'pm25',
+        'units': 'µg/m³',
+        'lon': 1.5,
+        'lat': 2.5,
+        'ismobile': False,
+        'tz': tz,
+    }
+
+
+def scanned(plan):
+    """
+    The relations that are left in the plan after pruning
+    """
+    found = set()
+    if 'Relation Name' in plan:
+        found.add(plan['Relation Name'])
+    for child in plan.get('Plans', []):
+        found |= scanned(child)
+    return found
+
+
+def explain(db, sql, **kwargs):
+    sql = (
+        sql.replace('public.measurements', f'{SCHEMA}.measurements')
+        .replace('format_timestamp(', f'{SCHEMA}.format_timestamp(')
+    )
+    rows, ms = db.rows(f"EXPLAIN (FORMAT JSON) {sql}", write=False, **kwargs)
+    return scanned(rows[0][0][0]['Plan'])
+
+
+@pytest.mark.parametrize('tzs,day,expected', [
+    # 05:00 to 04:00 utc the next day, 23 hours
+    (['America/New_York'], date(2024, 3, 10), [date(2024, 3, 10), date(2024, 3, 11)]),
+    (['UTC'], date(2024, 3, 10), [date(2024, 3, 10)]),
+    # the batch covers the earliest start to the latest end
+    (['America/New_York', 'Asia/Kolkata'], date(2024, 3, 10), [date(2024, 3, 9), date(2024, 3, 10), date(2024, 3, 11)]),
+])
+def test_measurement_query_prunes_partitions(partitioned, tzs, day, expected):
+    nodes = {n: Node([sensor(n, tz)]) for n, tz in enumerate(tzs, start=1)}
+    args = params(nodes, day)
+    expected = {partition(d) for d in expected}
+    assert explain(partitioned, MEASUREMENT_DATA_SQL, **args) == expected
+    assert explain(partitioned, MEASUREMENT_BATCH_SQL, budget=1000, **args) == expected
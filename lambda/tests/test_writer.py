@@ -0,0 +1,199 @@
+import gzip
+import os
+import threading
+
+import pyarrow as pa
+import pytest
+
+from open_data_export.config import settings
+from open_data_export.writer import write_csv, write_stats, StreamWriter, MIN_PART_SIZE
+from open_data_export.main import write_file, EXPORT_FIELDS
+
+
+@pytest.fixture
+def measurements():
+    values = [12.0, -70.0, None, float('nan'), 0.1, 1e-05, 123456789012345.6, 1.2345678901234568e+17, -0.0, 7.25]
+    n = len(values)
+    return pa.table({
+        'location_id': pa.array(range(1, n + 1), pa.int64()),
+        'sensors_id': pa.array(range(10, n + 10), pa.int32()),
+        'location': pa.array(['a "b"', 'c,d', 'x\ny', '', None, 'Ünï', 'a', 'b', 'c', 'd']).dictionary_encode(),
+        'datetime': pa.array(['2024-03-10T01:00:00-05:00']*n),
+        'lat': pa.array(values),
+        'lon': pa.array(list(reversed(values))),
+        'parameter': pa.array(['pm25']*n).dictionary_encode(),
+        'units': pa.array(['µg/m³']*n).dictionary_encode(),
+        'value': pa.array([float(i) for i in range(n)]),
+    })
+
+
+def test_csv_matches_pandas(measurements, pandas_csv):
+    assert write_csv(measurements) == pandas_csv(measurements.to_pandas())
+
+
+def test_csv_int_with_missing_values_matches_pandas(pandas_csv):
+    tbl = pa.table({'sensors_id': pa.array([1, None, 3], pa.int64())})
+    assert write_csv(tbl) == pandas_csv(tbl.to_pandas())
+
+
+def test_empty_csv_matches_pandas(measurements, pandas_csv):
+    empty = measurements.slice(0, 0)
+    assert write_csv(empty) == pandas_csv(empty.to_pandas())
+
+
+def test_stream_writer_matches_pandas(measurements, pandas_csv, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_SAVE_DIRECTORY', str(tmp_path))
+    with StreamWriter(None, 'stream', ext='csv', location='local') as writer:
+        for batch in measurements.to_batches(max_chunksize=3):
+            writer.write(pa.Table.from_batches([batch]))
+    assert (tmp_path / 'stream.csv').read_bytes() == pandas_csv(measurements.to_pandas())
+
+
+def test_write_file_is_the_same_for_arrow_and_pandas(measurements, tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'LOCAL_SAVE_DIRECTORY', str(tmp_path))
+    tbl = measurements.select(EXPORT_FIELDS)
+    write_file(tbl, 'arrow', ext='csv', location='local')
+    write_file(tbl.to_pandas(), 'pandas', ext='csv', location='local')
+    assert (tmp_path / 'arrow.csv').read_bytes() == (tmp_path / 'pandas.csv').read_bytes()
+
+
+class FakeS3:
+    """
+    Just enough of the s3 client for the StreamWriter, keeping the
+    objects and the parts of the open multipart uploads in memory
+    """
+    def __init__(self, gate=None):
+        self.objects = {}
+        self.uploads = {}
+        self.aborted = []
+        self.sent = 0
+        # the parts wait for this to be set, like a slow connection
+        self.gate = gate
+
+    def put_object(self, Bucket, Key, Body, **kwargs):
+        self.sent += len(Body)
+        self.objects[Key] = Body
+
+    def create_multipart_upload(self, Bucket, Key, **kwargs):
+        upload_id = f"upload-{len(self.uploads) + 1}"
+        self.uploads[upload_id] = {}
+        return {'UploadId': upload_id}
+
+    def upload_part(self, Bucket, Key, UploadId, PartNumber, Body):
+        if self.gate is not None:
+            assert self.gate.wait(10)
+        self.sent += len(Body)
+        self.uploads[UploadId][PartNumber] = Body
+        return {'ETag': f"etag-{PartNumber}"}
+
+    def complete_multipart_upload(self, Bucket, Key, UploadId, MultipartUpload):
+        parts = self.uploads.pop(UploadId)
+        assert [p['PartNumber'] for p in MultipartUpload['Parts']] == sorted(parts)
+        self.objects[Key] = b''.join([parts[n] for n in sorted(parts)])
+
+    def abort_multipart_upload(self, Bucket, Key, UploadId):
+        self.uploads.pop(UploadId)
+        self.aborted.append(Key)
+
+
+def upload(s3, data, previous_hash=None, chunk=1048576):
+    with StreamWriter(s3, 'file', ext='csv', bucket='bucket', location='s3', previous_hash=previous_hash) as writer:
+        for i in range(0, len(data), chunk):
+            writer.write_bytes(data[i:i + chunk])
+    return writer
+
+
+@pytest.fixture
+def stats():
+    write_stats.reset()
+    yield write_stats
+    write_stats.reset()
+
+
+def test_unchanged_small_file_is_not_sent(stats):
+    s3 = FakeS3()
+    data = os.urandom(1000)
+    first = upload(s3, data)
+    assert s3.objects['file.csv'] == data
+
+    s3 = FakeS3()
+    second = upload(s3, data, previous_hash=first.stats()['hash'])
+    assert second.skipped
+    assert s3.sent == 0
+    assert stats.snapshot() == {
+        'written': 1, 'skipped': 1, 'aborted': 0, 'bytes_saved': 1000, 'bytes_aborted': 0,
+    }
+
+
+def test_unchanged_large_file_counts_as_aborted(stats):
+    s3 = FakeS3()
+    data = os.urandom(MIN_PART_SIZE*2 + 1000)
+    first = upload(s3, data)
+    assert s3.objects['file.csv'] == data
+
+    s3 = FakeS3()
+    second = upload(s3, data, previous_hash=first.stats()['hash'])
+    assert second.skipped
+    assert s3.aborted == ['file.csv'] and s3.uploads == {} and s3.objects == {}
+    # the parts were sent before we knew, only the last one was saved
+    assert second.stats()['uploaded'] == s3.sent
+    assert s3.sent > 0
+    writes = stats.snapshot()
+    assert writes['aborted'] == 1
+    assert writes['bytes_aborted'] == s3.sent
+    assert writes['bytes_saved'] == len(data) - s3.sent
+
+
+def test_multipart_upload_in_order():
+    s3 = FakeS3()
+    # hex compresses to about half, enough for a few parts
+    data = os.urandom(MIN_PART_SIZE*2).hex().encode()
+    with StreamWriter(s3, 'file', ext='csv.gz', bucket='bucket', location='s3', part_size=MIN_PART_SIZE) as writer:
+        for i in range(0, len(data), 65536):
+            writer.write_bytes(data[i:i + 65536])
+    assert len(writer.parts) > 1
+    assert s3.uploads == {}
+    assert gzip.decompress(s3.objects['file.csv.gz']) == data
+
+
+def test_part_spills_while_the_last_one_is_sent(tmp_path, monkeypatch):
+    monkeypatch.setattr(settings, 'WRITE_SPILL_DIRECTORY', str(tmp_path))
+    gate = threading.Event()
+    s3 = FakeS3(gate)
+    data = os.urandom(MIN_PART_SIZE*2 + 1000)
+    chunk = 1048576
+    writer = StreamWriter(
+        s3, 'file', ext='csv', bucket='bucket', location='s3',
+        part_size=MIN_PART_SIZE, spill_size=MIN_PART_SIZE + chunk,
+    )
+    writer.write_bytes(data[:MIN_PART_SIZE])
+    # the first part is stuck on its way, the second fits next to it
+    writer.write_bytes(data[MIN_PART_SIZE:MIN_PART_SIZE + chunk])
+    assert writer.spilled == 0
+    assert writer.held() == MIN_PART_SIZE + chunk
+    # and then it does not
+    writer.write_bytes(data[MIN_PART_SIZE + chunk:MIN_PART_SIZE + 2*chunk])
+    assert writer.spilled == 1
+    assert writer.held() == MIN_PART_SIZE
+    gate.set()
+    writer.write_bytes(data[MIN_PART_SIZE + 2*chunk:])
+    writer.close()
+    assert s3.objects['file.csv'] == data
+    assert writer.stats()['spilled'] == 1
+
+
+def test_part_stays_in_memory_when_s3_keeps_up():
+    s3 = FakeS3()
+    data = os.urandom(MIN_PART_SIZE*3)
+    writer = StreamWriter(
+        s3, 'file', ext='csv', bucket='bucket', location='s3',
+        part_size=MIN_PART_SIZE, spill_size=MIN_PART_SIZE + 1,
+    )
+    chunk = 1048576
+    for i in range(0, len(data), chunk):
+        writer.write_bytes(data[i:i + chunk])
+        # the part that was just sent is out of the way
+        writer.wait()
+    writer.close()
+    assert writer.spilled == 0
+    assert s3.objects['file.csv'] == data
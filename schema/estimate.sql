@@ -0,0 +1,7 @@
+-- the export estimate (ESTIMATE_SQL) reads the most recent exports on
+-- every run, this keeps it from scanning the whole export log. The
+-- predicate has to match the WHERE in the query for postgres to use it
+CREATE INDEX IF NOT EXISTS open_data_export_logs_exported_idx
+  ON open_data_export_logs (exported_on DESC)
+  WHERE metadata->>'msec' IS NOT NULL
+  AND metadata->>'unchanged' IS NULL;
@@ -0,0 +1,11 @@
+-- lease columns for claiming location/days from more than one exporter
+-- at a time (EXPORT_LEASES=true). A location/day that is queued but whose
+-- lease has expired can be claimed again
+ALTER TABLE open_data_export_logs
+  ADD COLUMN IF NOT EXISTS lease_worker text
+, ADD COLUMN IF NOT EXISTS lease_expires_on timestamptz;
+
+-- the claim query only looks at what has not been exported
+CREATE INDEX IF NOT EXISTS open_data_export_logs_pending_idx
+  ON open_data_export_logs (day)
+  WHERE exported_on IS NULL;
@@ -4,6 +4,7 @@
 -- and you have the openaq-db repo cloned (not as a submodule)
 \i ../../openaq-db/openaqdb/tables/exports.sql
 \i ../../openaq-db/openaqdb/idempotent/exports_views.sql
+\i leases.sql
 
 -- and now we can populate the export logs
 -- The reset method will both populate the export log table and